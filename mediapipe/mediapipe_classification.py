@@ -15,135 +15,348 @@ from google.colab import drive
 drive.mount('/content/drive')
 
 import os
-import csv
+import collections
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import sys
 import tempfile
+import threading
+import time
 import tensorflow as tf
 import numpy as np
 import cv2
 import pandas as pd
 import mediapipe as mp
 from mediapipe.python.solutions import pose as mp_pose
-# Initialize MediaPipe drawing module
-mp_drawing = mp.solutions.drawing_utils
+
+
+# Check out this repository for the pipeline module that preprocessing worker
+# processes import, and for the bundled datasets
+!git clone -q https://github.com/durgas4/Pose-Estimation-using-Movenet-and-Mediapipe.git
+REPO_PATH = os.path.join(os.getcwd(), 'Pose-Estimation-using-Movenet-and-Mediapipe')
+sys.path.append(os.path.join(REPO_PATH, 'mediapipe'))
+
+from mediapipe_pipeline import (
+    IMAGE_EXTENSIONS, AsyncWriter, LandmarkCache, LandmarkRowWriter, RunManifest, _init_pose_worker,
+    _merge_worker_metrics, _preprocess_image, _preprocess_image_in_worker, ingest_image, metrics,
+    pose_embeddings, read_image_list, read_landmark_rows, skeleton_renderer, write_image)
+
 
 class MediapipePreprocessor(object):
-    def __init__(self, images_in_folder, images_out_folder, csvs_out_path):
+    def __init__(self, images_in_folder, images_out_folder, csvs_out_path, work_dir=None):
         self._images_in_folder = images_in_folder
         self._images_out_folder = images_out_folder
         self._csvs_out_path = csvs_out_path
         self._messages = []
 
-        # Create a temp dir to store the pose CSVs per class
-        self._csvs_out_folder_per_class = tempfile.mkdtemp()
-
-        # Get list of pose classes and print image statistics
-        self._pose_class_names = sorted(
-            [n for n in os.listdir(self._images_in_folder) if not n.startswith('.')])
-
-    def process(self, per_pose_class_limit=None, detection_threshold=0.1):
-        pose = mp_pose.Pose(static_image_mode=True, min_detection_confidence=detection_threshold)
-
-        for pose_class_name in self._pose_class_names:
-            print('Preprocessing', pose_class_name)
-
-            # Paths for the pose class.
+        # Dir to store the pose landmarks and run manifest per class. Pass a
+        # persistent `work_dir` to resume or update a previous run, otherwise a
+        # temp dir is used.
+        if work_dir is None:
+            work_dir = tempfile.mkdtemp()
+        os.makedirs(work_dir, exist_ok=True)
+        self._landmarks_out_folder_per_class = work_dir
+
+        # Get list of pose classes and print image statistics. The images are
+        # either in a subfolder per class or listed in an image list file.
+        self._class_image_paths = None
+        if os.path.isfile(self._images_in_folder):
+            self._class_image_paths = read_image_list(self._images_in_folder)
+            self._pose_class_names = sorted(self._class_image_paths)
+        else:
+            self._pose_class_names = sorted(
+                [n for n in os.listdir(self._images_in_folder) if not n.startswith('.')])
+
+    def _class_images(self, pose_class_name):
+        """Returns the sorted (image name, image path) pairs of a pose class."""
+        if self._class_image_paths is not None:
+            image_paths = self._class_image_paths[pose_class_name]
+        else:
             images_in_folder = os.path.join(self._images_in_folder, pose_class_name)
-            images_out_folder = os.path.join(self._images_out_folder, pose_class_name)
-            csv_out_path = os.path.join(self._csvs_out_folder_per_class, pose_class_name + '.csv')
-            if not os.path.exists(images_out_folder):
-                os.makedirs(images_out_folder)
-
-            # Detect landmarks in each image and write them to a CSV file
-            with open(csv_out_path, 'w') as csv_out_file:
-                csv_out_writer = csv.writer(csv_out_file, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-                # Get list of images
-                image_names = sorted([n for n in os.listdir(images_in_folder) if not n.startswith('.')])
-                if per_pose_class_limit is not None:
-                    image_names = image_names[:per_pose_class_limit]
-
-                valid_image_count = 0
-
-                # Detect pose landmarks from each image
-                for image_name in image_names:
-                    image_path = os.path.join(images_in_folder, image_name)
-
-                    try:
-                        image = cv2.imread(image_path)
-                        image_height, image_width, _ = image.shape
-                    except:
-                        self._messages.append(f'Skipped {image_path}. Invalid image.')
-                        continue
-
-                    # Convert image to RGB format
-                    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-                    # Run pose estimation on the image
-                    results = pose.process(image_rgb)
-
-                    # Check if landmarks were detected
-                    if not results.pose_landmarks:
-                        self._messages.append(f'Skipped {image_path}. No pose was confidently detected.')
-                        continue
-
-                    valid_image_count += 1
-
-                    # Draw the pose landmarks on the image for debugging
-                    mp_drawing.draw_landmarks(
-                        image, results.pose_landmarks, mp_pose.POSE_CONNECTIONS)
-
-                    # Write the processed image to the output folder
-                    cv2.imwrite(os.path.join(images_out_folder, image_name), image)
-
-                    # Get the landmark coordinates and write them to the CSV file
-                    pose_landmarks = np.array([[lm.x * image_width, lm.y * image_height, lm.z] for lm in results.pose_landmarks.landmark], dtype=np.float32)
-                    coordinates = pose_landmarks.flatten().astype(np.str).tolist()
-                    csv_out_writer.writerow([image_name] + coordinates)
-
-                if not valid_image_count:
-                    raise RuntimeError(f'No valid images found for the "{pose_class_name}" class.')
+            image_paths = [os.path.join(images_in_folder, n)
+                           for n in os.listdir(images_in_folder) if not n.startswith('.')]
+        return sorted((os.path.basename(image_path), image_path) for image_path in image_paths)
+
+    def process(self, per_pose_class_limit=None, detection_threshold=0.1, num_workers=1, cache=None,
+                overlay_mode='all', overlay_every=10, writer_threads=0, max_long_side=None):
+        """Detects landmarks in every image and writes them to the output CSV.
+
+        With `num_workers` > 1 the images are spread over a pool of worker
+        processes, each owning its own Pose graph. Rows and skip messages are
+        collected in image-name order, so the output matches a serial run.
+
+        The outcome of every image is recorded in a `RunManifest` per class in
+        the work dir as soon as it is known. With a persistent work dir, a
+        rerun, e.g. after a crash or once new images were added, only processes
+        the images that are new or changed since they were recorded.
+
+        If a `LandmarkCache` is given, images that were already processed with
+        the same settings skip pose detection.
+
+        `overlay_mode` picks the kept images that get a debug overlay: 'all',
+        'none' (use `render_overlays` to draw them later) or 'sample' for every
+        `overlay_every`-th image of each class.
+
+        With `writer_threads` > 0, overlays and manifest records are written by
+        background threads so that detection doesn't wait on output I/O. Pending
+        writes are flushed at the end of every class. Worker processes always
+        write their overlays themselves, only manifest records go through the
+        writer then.
+
+        If `max_long_side` is set, images with a longer side than that are
+        scaled down before they go to the Pose graph, with reduced-size decoding
+        for JPEG files. Landmarks are still written in original image pixels.
+        """
+        if overlay_mode not in ('all', 'none', 'sample'):
+            raise ValueError(f'Unknown overlay mode: {overlay_mode}')
+
+        # Manifest records made with other settings aren't reused
+        settings = {'model': 'pose_model_complexity_1', 'detection_threshold': detection_threshold}
+        if max_long_side is not None:
+            settings['max_long_side'] = max_long_side
+
+        pool = None
+        if num_workers > 1:
+            # Forking after MediaPipe and TensorFlow started their runtime threads
+            # can deadlock the workers, so they are spawned instead. Spawned
+            # workers can't see functions defined in the notebook, so the
+            # initializer and the per-image work come from `mediapipe_pipeline`.
+            pool = multiprocessing.get_context('spawn').Pool(
+                num_workers, initializer=_init_pose_worker, initargs=(detection_threshold, metrics.enabled))
+        else:
+            pose = mp_pose.Pose(static_image_mode=True, min_detection_confidence=detection_threshold)
+
+        # Manifest records need a single writer thread to keep their order
+        overlay_writer = None
+        row_writer = None
+        if writer_threads:
+            row_writer = AsyncWriter(num_threads=1)
+            if pool is None:
+                overlay_writer = AsyncWriter(num_threads=writer_threads)
+
+        try:
+            for pose_class_name in self._pose_class_names:
+                print('Preprocessing', pose_class_name)
+
+                # Paths for the pose class.
+                images_out_folder = os.path.join(self._images_out_folder, pose_class_name)
+                landmarks_out_prefix = os.path.join(self._landmarks_out_folder_per_class, pose_class_name)
+                if overlay_mode != 'none' and not os.path.exists(images_out_folder):
+                    os.makedirs(images_out_folder)
+
+                # Detect landmarks in each new or changed image and record them
+                # in the run manifest of the class
+                with RunManifest(landmarks_out_prefix, settings) as manifest:
+                    # Get list of images
+                    class_images = self._class_images(pose_class_name)
+                    all_image_names = [image_name for image_name, _ in class_images]
+                    if per_pose_class_limit is not None:
+                        class_images = class_images[:per_pose_class_limit]
+                    image_names = [image_name for image_name, _ in class_images]
+
+                    # Reuse the outcome of images that didn't change since the last run
+                    valid_image_count = 0
+                    tasks = []
+                    task_images = []
+                    for image_index, (image_name, image_path) in enumerate(class_images):
+                        try:
+                            stat = os.stat(image_path)
+                            record = manifest.lookup(image_name, image_path, stat)
+                        except OSError as e:
+                            # E.g. a file deleted since it was listed, or a dangling link
+                            metrics.count('images', outcome='skipped', reason='invalid')
+                            self._messages.append(f'Skipped {image_path}. {e.strerror or e}.')
+                            manifest.discard(image_name)
+                            continue
+                        if record is not None:
+                            metrics.count('images', outcome='reused')
+                            if record['outcome'] == 'kept':
+                                valid_image_count += 1
+                            else:
+                                self._messages.append(record['reason'])
+                            continue
+
+                        image_out_path = os.path.join(images_out_folder, image_name)
+                        if overlay_mode == 'none' or (overlay_mode == 'sample' and image_index % overlay_every):
+                            image_out_path = None
+                        tasks.append((image_path, image_out_path, detection_threshold, cache, max_long_side))
+                        task_images.append((image_name, stat))
+                    if len(tasks) < len(image_names):
+                        print(f'Reusing {len(image_names) - len(tasks)} unchanged images')
+
+                    # Detect pose landmarks from each image, in task order
+                    if pool is None:
+                        results = (_preprocess_image(pose, *task, overlay_writer=overlay_writer)
+                                   for task in tasks)
+                    else:
+                        chunksize = max(1, len(tasks) // (num_workers * 4))
+                        results = _merge_worker_metrics(pool.imap(_preprocess_image_in_worker, tasks, chunksize))
+
+                    for (image_name, stat), result in zip(task_images, results):
+                        if result.cache_hit is not None:
+                            cache.record(result.cache_hit)
+
+                        # Record the outcome of the image in the manifest
+                        if row_writer is None:
+                            manifest.add(image_name, stat, result.digest, result.landmarks, result.message)
+                        else:
+                            row_writer.submit(manifest.add, image_name, stat, result.digest,
+                                              result.landmarks, result.message)
+
+                        if result.landmarks is None:
+                            self._messages.append(result.message)
+                            continue
+
+                        valid_image_count += 1
+
+                    # Finish the writes of this class before its manifest is closed
+                    for writer in (overlay_writer, row_writer):
+                        if writer is not None:
+                            writer.flush()
+
+                    # Write the landmark rows of the class in image-name order
+                    manifest.finish(image_names, all_image_names)
+
+                    # Keep the cache within its size limit
+                    if cache is not None:
+                        cache.trim()
+
+                    if not valid_image_count:
+                        raise RuntimeError(f'No valid images found for the "{pose_class_name}" class.')
+        finally:
+            if pool is not None:
+                pool.terminate()
+            else:
+                pose.close()
+            for writer in (overlay_writer, row_writer):
+                if writer is not None:
+                    writer.close()
 
         # Print the error messages collected during preprocessing.
         print('\n'.join(self._messages))
-
-        # Combine all per-class CSVs into a single output file
-        all_landmarks_df = self._all_landmarks_as_dataframe()
-        all_landmarks_df.to_csv(self._csvs_out_path, index=False)
+        if cache is not None:
+            print(cache.report())
+
+        # Combine all per-class landmarks into a single output file, a binary
+        # landmark store if the output path ends with .npz or a CSV file otherwise
+        with metrics.timer('merge'):
+            if self._csvs_out_path.endswith('.npz'):
+                write_landmark_store(self._csvs_out_path, self._all_landmarks_as_dataframe())
+            else:
+                self._write_all_landmarks_csv(self._csvs_out_path)
 
     def class_names(self):
         """List of classes found in the training dataset."""
         return self._pose_class_names
 
-    def _all_landmarks_as_dataframe(self):
-        """Merge all per-class CSVs into a single dataframe."""
-        total_df = None
-        for class_index, class_name in enumerate(self._pose_class_names):
-            csv_out_path = os.path.join(self._csvs_out_folder_per_class, class_name + '.csv')
-            per_class_df = pd.read_csv(csv_out_path, header=None)
+    def _landmarks_header(self):
+        """Column names of the merged landmarks."""
+        header_name = ['file_name']
+        for bodypart in mp_pose.PoseLandmark:
+            header_name += [f'{bodypart}_x', f'{bodypart}_y', f'{bodypart}_score']
+        return header_name + ['class_no', 'class_name']
 
-            # Add the labels
-            per_class_df['class_no'] = [class_index] * len(per_class_df)
-            per_class_df['class_name'] = [class_name] * len(per_class_df)
+    def _per_class_landmarks(self):
+        """Yields the landmarks of each class as a dataframe with the full header."""
+        header_name = self._landmarks_header()
+        for class_index, class_name in enumerate(self._pose_class_names):
+            landmarks_out_prefix = os.path.join(self._landmarks_out_folder_per_class, class_name)
+            image_names, landmarks = read_landmark_rows(landmarks_out_prefix, len(mp_pose.PoseLandmark) * 3)
+            per_class_df = pd.DataFrame(landmarks, columns=header_name[1:-2])
 
-            # Append the folder name to the filename column (first column)
-            per_class_df[per_class_df.columns[0]] = (os.path.join(class_name, '') +
-                                                     per_class_df[per_class_df.columns[0]].astype(str))
+            # Prepend the folder name to the file names
+            per_class_df.insert(0, 'file_name',
+                                [os.path.join(class_name, image_name) for image_name in image_names])
 
-            if total_df is None:
-                # For the first class, assign its data to the total dataframe
-                total_df = per_class_df
-            else:
-                # Concatenate each class's data into the total dataframe
-                total_df = pd.concat([total_df, per_class_df], axis=0)
+            # Add the labels
+            per_class_df['class_no'] = class_index
+            per_class_df['class_name'] = class_name
 
-        list_name = [[f'{bodypart}_x', f'{bodypart}_y', f'{bodypart}_score'] for bodypart in mp_pose.PoseLandmark]
-        header_name = []
-        for columns_name in list_name:
-            header_name += columns_name
-        header_name = ['file_name'] + header_name
-        header_map = {total_df.columns[i]: header_name[i] for i in range(len(header_name))}
-        total_df.rename(header_map, axis=1, inplace=True)
+            yield per_class_df
 
-        return total_df
+    def _all_landmarks_as_dataframe(self):
+        """Merge all per-class landmarks into a single dataframe."""
+        # A single concat copies each class once, rather than once per later class
+        return pd.concat(self._per_class_landmarks(), ignore_index=True)
+
+    def _write_all_landmarks_csv(self, csv_path):
+        """Writes the merged landmarks to a CSV file one class at a time."""
+        with open(csv_path, 'w', newline='') as csv_file:
+            for class_index, per_class_df in enumerate(self._per_class_landmarks()):
+                per_class_df.to_csv(csv_file, header=class_index == 0, index=False)
+
+def write_landmark_store(path, dataframe):
+    """Writes a merged landmark dataframe as a columnar .npz file.
+
+    The landmarks are stored as one float32 matrix next to the file name and
+    class columns, so `read_landmark_store` loads them without any parsing.
+    """
+    landmark_columns = list(dataframe.columns[1:-2])
+    np.savez(path,
+             file_name=dataframe['file_name'].to_numpy(dtype=str),
+             landmarks=dataframe[landmark_columns].to_numpy(dtype=np.float32),
+             landmark_columns=np.array(landmark_columns),
+             class_no=dataframe['class_no'].to_numpy(dtype=np.int32),
+             class_name=dataframe['class_name'].to_numpy(dtype=str))
+
+
+def read_landmark_store(path):
+    """Loads a .npz landmark store into a dataframe laid out like the CSV."""
+    with np.load(path) as store:
+        dataframe = pd.DataFrame(store['landmarks'], columns=store['landmark_columns'])
+        dataframe.insert(0, 'file_name', store['file_name'])
+        dataframe['class_no'] = store['class_no']
+        dataframe['class_name'] = store['class_name']
+    return dataframe
+
+
+def read_landmarks(path):
+    """Loads the landmarks written by `MediapipePreprocessor`, store or CSV."""
+    if path.endswith('.npz'):
+        return read_landmark_store(path)
+    return pd.read_csv(path)
+
+
+def render_overlays(csv_path, images_in_folder, images_out_folder, file_names=None):
+    """Draws debug overlays from the landmarks written by `MediapipePreprocessor`.
+
+    No pose detection is run, the stored landmarks are drawn onto the original
+    images. `images_in_folder` is the image folder or image list file the
+    landmarks were extracted from. `file_names` restricts rendering to the given
+    `file_name` values, e.g. the misclassified test images.
+    """
+    # Landmarks of listed images are stored under their class and file name
+    listed_image_paths = None
+    if os.path.isfile(images_in_folder):
+        listed_image_paths = {os.path.join(class_name, os.path.basename(image_path)): image_path
+                              for class_name, image_paths in read_image_list(images_in_folder).items()
+                              for image_path in image_paths}
+
+    dataframe = read_landmarks(csv_path)
+    if file_names is not None:
+        dataframe = dataframe[dataframe['file_name'].isin(set(file_names))]
+    landmark_count = len(mp_pose.PoseLandmark)
+    landmarks = dataframe.iloc[:, 1:1 + landmark_count * 3].to_numpy(
+        dtype=np.float32).reshape(-1, landmark_count, 3)
+
+    for file_name, pose_landmarks in zip(dataframe['file_name'], landmarks):
+        if listed_image_paths is None:
+            image_path = os.path.join(images_in_folder, file_name)
+        elif file_name in listed_image_paths:
+            image_path = listed_image_paths[file_name]
+        else:
+            print(f'Skipped {file_name}. Not in the image list.')
+            continue
+        _, image, _ = ingest_image(image_path)
+        if image is None:
+            print(f'Skipped {image_path}. Invalid image.')
+            continue
+
+        image_out_path = os.path.join(images_out_folder, file_name)
+        os.makedirs(os.path.dirname(image_out_path), exist_ok=True)
+        write_image(image_out_path, skeleton_renderer.render(image, pose_landmarks))
 
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
@@ -161,34 +374,76 @@ import os
 import random
 import shutil
 
-def split_into_train_test(images_origin, images_dest, test_split):
+def _link_or_copy(source, destination):
+  """Hardlinks a file, falling back to a symlink and then to a copy."""
+  if os.path.lexists(destination):
+    os.remove(destination)
+  try:
+    os.link(source, destination)
+  except OSError:
+    try:
+      os.symlink(os.path.abspath(source), destination)
+    except OSError:
+      shutil.copyfile(source, destination)
+
+def split_into_train_test(images_origin, images_dest, test_split, mode='copy'):
+  """Splits the images of each class folder into train and test sets.
+
+  `mode` picks how the split is written to `images_dest`:
+    * 'copy': copies the images into `train/<class>` and `test/<class>`.
+    * 'link': same layout, but with hardlinks, or symlinks where hardlinks
+      aren't supported, so that no image data is duplicated.
+    * 'list': writes the image paths to `train.txt` and `test.txt` image list
+      files, which the preprocessors take in place of an images folder.
+  """
+  if mode not in ('copy', 'link', 'list'):
+    raise ValueError(f'Unknown split mode: {mode}')
   _, dirs, _ = next(os.walk(images_origin))
 
   TRAIN_DIR = os.path.join(images_dest, 'train')
   TEST_DIR = os.path.join(images_dest, 'test')
-  os.makedirs(TRAIN_DIR, exist_ok=True)
-  os.makedirs(TEST_DIR, exist_ok=True)
+  if mode == 'list':
+    os.makedirs(images_dest, exist_ok=True)
+    train_paths = []
+    test_paths = []
+  else:
+    os.makedirs(TRAIN_DIR, exist_ok=True)
+    os.makedirs(TEST_DIR, exist_ok=True)
 
   for dir in dirs:
     # Get all filenames for this dir, filtered by filetype
     filenames = os.listdir(os.path.join(images_origin, dir))
     filenames = [os.path.join(images_origin, dir, f) for f in filenames if (
-        f.endswith('.png') or f.endswith('.jpg') or f.endswith('.jpeg') or f.endswith('.bmp'))]
+        os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS)]
     # Shuffle the files, deterministically
     filenames.sort()
     random.seed(42)
     random.shuffle(filenames)
+    test_count = int(len(filenames) * test_split)
+    if mode == 'list':
+      test_paths += [os.path.abspath(file) for file in filenames[:test_count]]
+      train_paths += [os.path.abspath(file) for file in filenames[test_count:]]
+      print(f'Listed {test_count} of {len(filenames)} from class "{dir}" for test.')
+      continue
     # Divide them into train/test dirs
     os.makedirs(os.path.join(TEST_DIR, dir), exist_ok=True)
     os.makedirs(os.path.join(TRAIN_DIR, dir), exist_ok=True)
-    test_count = int(len(filenames) * test_split)
     for i, file in enumerate(filenames):
       if i < test_count:
         destination = os.path.join(TEST_DIR, dir, os.path.split(file)[1])
       else:
         destination = os.path.join(TRAIN_DIR, dir, os.path.split(file)[1])
-      shutil.copyfile(file, destination)
+      if mode == 'link':
+        _link_or_copy(file, destination)
+      else:
+        shutil.copyfile(file, destination)
     print(f'Moved {test_count} of {len(filenames)} from class "{dir}" into test.')
+
+  if mode == 'list':
+    for list_name, image_paths in (('train.txt', train_paths),
+                                   ('test.txt', test_paths)):
+      with open(os.path.join(images_dest, list_name), 'w') as list_file:
+        list_file.write(''.join(image_path + '\n' for image_path in image_paths))
   print(f'Your split dataset is in "{images_dest}"')
 
 dataset_in = '/content/drive/MyDrive/final project/sit-stand'
@@ -203,20 +458,33 @@ else:
 
 IMAGES_ROOT = '/content/split_/content/drive/MyDrive/final project/sit-stand'
 
+# Record stage timings and image outcomes, written out after the evaluation
+metrics.enable()
+
 # Define paths for input data
 images_in_train_folder = os.path.join(IMAGES_ROOT, 'train')
 
 images_out_train_folder = 'pose_images_out_train'
-csvs_out_train_path = 'train_data.csv'
+# Landmarks go to the binary landmark store, CSV files are only exported below
+landmarks_out_train_path = 'train_data.npz'
+# Per-class landmarks and run manifests, kept so that a rerun only processes
+# new or changed images
+landmarks_work_train_dir = 'train_data_work'
+
+# Longer side that large photos are scaled down to before detection, e.g.
+# 1024, or None to detect on the full-size images. Scaling down is faster but
+# changes the extracted landmarks and so the training data.
+MAX_LONG_SIDE = None
 
 # Initialize and run the preprocessor for training data
 preprocessor_train = MediapipePreprocessor(
     images_in_folder=images_in_train_folder,
     images_out_folder=images_out_train_folder,
-    csvs_out_path=csvs_out_train_path
+    csvs_out_path=landmarks_out_train_path,
+    work_dir=landmarks_work_train_dir
 )
 
-preprocessor_train.process(per_pose_class_limit=None)
+preprocessor_train.process(per_pose_class_limit=None, max_long_side=MAX_LONG_SIDE)
 
 import tqdm
 #IMAGES_ROOT = '/content/split_/content/sit-stand'
@@ -225,23 +493,32 @@ import os
 import sys
 images_in_test_folder = os.path.join(IMAGES_ROOT, 'test')
 images_out_test_folder = 'pose_images_out_test'
-csvs_out_test_path = 'test_data.csv'
+landmarks_out_test_path = 'test_data.npz'
+landmarks_work_test_dir = 'test_data_work'
 
 # Initialize and run the preprocessor for test data
 preprocessor_test = MediapipePreprocessor(
     images_in_folder=images_in_test_folder,
     images_out_folder=images_out_test_folder,
-    csvs_out_path=csvs_out_test_path
+    csvs_out_path=landmarks_out_test_path,
+    work_dir=landmarks_work_test_dir
 )
 
-preprocessor_test.process(per_pose_class_limit=None)
+preprocessor_test.process(per_pose_class_limit=None, max_long_side=MAX_LONG_SIDE)
 
-csvs_out_train_path = 'train_data.csv'
-csvs_out_test_path = 'test_data.csv'
+# Export the landmark stores as CSV files for download
+read_landmark_store(landmarks_out_train_path).to_csv('train_data.csv', index=False)
+read_landmark_store(landmarks_out_test_path).to_csv('test_data.csv', index=False)
 
-def load_pose_landmarks(csv_path):
-  # Load the CSV file
-  dataframe = pd.read_csv(csv_path)
+def load_pose_landmarks(csv_path, embeddings=False):
+  """Loads landmarks for training and evaluation.
+
+  With `embeddings`, X holds the `pose_embeddings` of the landmarks rather
+  than the landmarks. They are cached in `<csv_path>.embeddings.npy` and only
+  recomputed when the landmarks file is newer than the cache.
+  """
+  # Load the CSV file or the .npz landmark store
+  dataframe = read_landmarks(csv_path)
   df_to_process = dataframe.copy()
 
   # Drop the file_name columns as you don't need it during training.
@@ -254,14 +531,32 @@ def load_pose_landmarks(csv_path):
   y = df_to_process.pop('class_no')
 
   # Convert the input features and labels into the correct format for training.
-  X = df_to_process.astype('float64')
+  # The landmark store is already float32, which is what the model runs on.
+  if not csv_path.endswith('.npz'):
+    df_to_process = df_to_process.astype('float64')
+  X = df_to_process
   y = keras.utils.to_categorical(y)
 
+  if embeddings:
+    embeddings_path = csv_path + '.embeddings.npy'
+    if (os.path.exists(embeddings_path) and
+        os.path.getmtime(embeddings_path) >= os.path.getmtime(csv_path)):
+      X = np.load(embeddings_path)
+    else:
+      X = pose_embeddings(X.to_numpy(dtype=np.float32))
+      np.save(embeddings_path, X)
+
   return X, y, classes, dataframe
 
 from tensorflow import keras
+# Set to train on embeddings computed once at load time instead of normalizing
+# the landmarks inside the model on every training step. This changes the
+# input of the exported pose_classifier.tflite from the raw 99 landmark values
+# to the embedding, which consumers such as the RPi `Classifier` don't expect.
+TRAIN_ON_EMBEDDINGS = False
+
 # Load the train data
-X, y, class_names, _ = load_pose_landmarks(csvs_out_train_path)
+X, y, class_names, _ = load_pose_landmarks(landmarks_out_train_path, embeddings=TRAIN_ON_EMBEDDINGS)
 
 # Split training data (X, y) into (X_train, y_train) and (X_val, y_val)
 
@@ -269,7 +564,7 @@ X_train, X_val, y_train, y_val = train_test_split(X, y,
                                                   test_size=0.15)
 
 # Load the test data
-X_test, y_test, _, df_test = load_pose_landmarks(csvs_out_test_path)
+X_test, y_test, _, df_test = load_pose_landmarks(landmarks_out_test_path, embeddings=TRAIN_ON_EMBEDDINGS)
 
 import tensorflow as tf
 from tensorflow import keras
@@ -327,22 +622,22 @@ def get_pose_size(landmarks, torso_size_multiplier=2.5):
     # Shoulders center
     shoulders_center = get_center_point(landmarks, BodyPart.LEFT_SHOULDER, BodyPart.RIGHT_SHOULDER)
 
-    # Torso size as the minimum body size
-    torso_size = tf.linalg.norm(shoulders_center - hips_center)
+    # Torso size as the minimum body size, per sample
+    torso_size = tf.linalg.norm(shoulders_center - hips_center, axis=1)
 
     # Pose center
     pose_center_new = get_center_point(landmarks, BodyPart.LEFT_HIP, BodyPart.RIGHT_HIP)
     pose_center_new = tf.expand_dims(pose_center_new, axis=1)
 
     # Dist to pose center
-    d = tf.gather(landmarks - pose_center_new, 0, axis=0)
-    # Max dist to pose center
-    max_dist = tf.reduce_max(tf.linalg.norm(d, axis=0))
+    d = landmarks - pose_center_new
+    # Max dist to pose center of each sample
+    max_dist = tf.reduce_max(tf.linalg.norm(d, axis=2), axis=1)
 
-    # Normalize scale
+    # Normalize scale, shaped to divide the (batch, 33, 2) landmarks
     pose_size = tf.maximum(torso_size * torso_size_multiplier, max_dist)
 
-    return pose_size
+    return tf.reshape(pose_size, [-1, 1, 1])
 
 def normalize_pose_landmarks(landmarks):
     """Normalizes the landmarks translation and scales to a constant pose size."""
@@ -375,9 +670,11 @@ from tensorflow import keras
 
 # Define the model
 class CustomModel(tf.keras.Model):
-    def __init__(self, input_shape=(99), num_classes=None):
+    def __init__(self, input_shape=(99), num_classes=None, precomputed_embeddings=False):
         super(CustomModel, self).__init__()
 
+        # With precomputed embeddings the inputs are `pose_embeddings` output
+        self.precomputed_embeddings = precomputed_embeddings
         self.embedding = landmarks_to_embedding
         self.dense1 = keras.layers.Dense(128, activation=tf.nn.relu6)
         self.dropout1 = keras.layers.Dropout(0.5)
@@ -386,7 +683,7 @@ class CustomModel(tf.keras.Model):
         self.outputs = keras.layers.Dense(num_classes, activation="softmax")
 
     def call(self, inputs):
-        x = self.embedding(inputs)
+        x = inputs if self.precomputed_embeddings else self.embedding(inputs)
         x = self.dense1(x)
         x = self.dropout1(x)
         x = self.dense2(x)
@@ -395,10 +692,11 @@ class CustomModel(tf.keras.Model):
         return x
 
 # Create an instance of the custom model
-model = CustomModel(input_shape=(99), num_classes=len(class_names))
+model = CustomModel(input_shape=(99), num_classes=len(class_names),
+                    precomputed_embeddings=TRAIN_ON_EMBEDDINGS)
 
 # Display a clean model summary without custom TensorFlow operations
-model.build(input_shape=(None, 99))
+model.build(input_shape=(None, X.shape[1]))
 model.summary()
 
 y_train.shape
@@ -422,11 +720,12 @@ earlystopping = keras.callbacks.EarlyStopping(monitor='val_accuracy',
                                               patience=20)
 
 # Start training
-history = model.fit(X_train, y_train,
-                    epochs=200,
-                    batch_size=16,
-                    validation_data=(X_val, y_val),
-                    callbacks=[checkpoint, earlystopping])
+with metrics.timer('train', len(X_train)):
+  history = model.fit(X_train, y_train,
+                      epochs=200,
+                      batch_size=16,
+                      validation_data=(X_val, y_val),
+                      callbacks=[checkpoint, earlystopping])
 
 # Save the model in the SavedModel format
 model.save("custom_model_saved_model")
@@ -533,9 +832,32 @@ for i, id_in_df in enumerate(true_predict):
   plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
 plt.show()
 
-converter = tf.lite.TFLiteConverter.from_keras_model(model)
-converter.optimizations = [tf.lite.Optimize.DEFAULT]
-tflite_model = converter.convert()
+def convert_classifier(model, mode='dynamic', representative_data=None):
+  """Converts the classifier to a TFLite model.
+
+  `mode` picks the quantization:
+    * 'dynamic': int8 weights, float activations.
+    * 'int8': full-integer model with int8 inputs and outputs. Activation
+      ranges are calibrated on the `representative_data` rows.
+    * 'float16': float16 weights.
+  """
+  converter = tf.lite.TFLiteConverter.from_keras_model(model)
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  if mode == 'int8':
+    def representative_dataset():
+      for row in np.asarray(representative_data, dtype=np.float32):
+        yield [row[np.newaxis]]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+  elif mode == 'float16':
+    converter.target_spec.supported_types = [tf.float16]
+  elif mode != 'dynamic':
+    raise ValueError('Unknown quantization mode: {}'.format(mode))
+  return converter.convert()
+
+tflite_model = convert_classifier(model)
 
 print('Model size: %dKB' % (len(tflite_model) / 1024))
 
@@ -545,37 +867,355 @@ with open('pose_classifier.tflite', 'wb') as f:
 with open('pose_labels.txt', 'w') as f:
   f.write('\n'.join(class_names))
 
-def evaluate_model(interpreter, X, y_true):
-  """Evaluates the given TFLite model and return its accuracy."""
-  input_index = interpreter.get_input_details()[0]["index"]
-  output_index = interpreter.get_output_details()[0]["index"]
-
-  # Run predictions on all given poses.
-  y_pred = []
-  for i in range(len(y_true)):
-    # Pre-processing: add batch dimension and convert to float32 to match with
-    # the model's input data format.
-    test_image = X[i: i + 1].astype('float32')
-    interpreter.set_tensor(input_index, test_image)
-
-    # Run inference.
+# Outcome of `evaluate_model`. Latencies are in milliseconds per interpreter
+# invocation, which covers `batch_size` rows when the evaluation is batched.
+EvaluationResult = collections.namedtuple(
+    'EvaluationResult',
+    ['accuracy', 'rows_per_second', 'latency_p50', 'latency_p99', 'batch_size'])
+
+def quantize_classifier_input(input_details, inputs):
+  """Converts float32 rows to the input type of a TFLite classifier.
+
+  Full-integer models take int8 rows, quantized with the scale and zero point
+  of their input tensor. Float models take the rows unchanged.
+  """
+  inputs = np.asarray(inputs, dtype=np.float32)
+  if input_details['dtype'] != np.int8:
+    return inputs
+  scale, zero_point = input_details['quantization']
+  return np.clip(np.round(inputs / scale + zero_point), -128,
+                 127).astype(np.int8)
+
+def dequantize_classifier_output(output_details, outputs):
+  """Converts TFLite classifier outputs back to float32 probabilities."""
+  if output_details['dtype'] != np.int8:
+    return outputs
+  scale, zero_point = output_details['quantization']
+  return (outputs.astype(np.float32) - zero_point) * scale
+
+def _run_classifier(interpreter, input_index, output_index, inputs):
+  """Runs one interpreter invocation, returning (predictions, latency in ms)."""
+  start_time = time.perf_counter()
+  with metrics.timer('classify', len(inputs)):
+    interpreter.set_tensor(input_index, inputs)
     interpreter.invoke()
-
-    # Post-processing: remove batch dimension and find the class with highest
-    # probability.
-    output = interpreter.tensor(output_index)
-    predicted_label = np.argmax(output()[0])
-    y_pred.append(predicted_label)
+    predictions = np.argmax(interpreter.get_tensor(output_index), axis=1)
+  return predictions, (time.perf_counter() - start_time) * 1000
+
+def evaluate_model(interpreter, X, y_true, batch_size=256, model_content=None,
+                   num_threads=4):
+  """Evaluates the given TFLite model and returns an `EvaluationResult`.
+
+  The interpreter input is resized to `batch_size` rows so that each
+  invocation classifies a whole batch. If the model is fixed at batch 1, rows
+  are classified one at a time instead, spread over `num_threads` threads
+  with an interpreter each when the `model_content` is given. Inputs of
+  full-integer models are quantized up front.
+  """
+  X = np.asarray(X, dtype=np.float32)
+  y_true = np.argmax(y_true, axis=1)
+  input_details = interpreter.get_input_details()[0]
+  input_index = input_details['index']
+  output_index = interpreter.get_output_details()[0]['index']
+  X = quantize_classifier_input(input_details, X)
+
+  batched = input_details['shape_signature'][0] == -1
+  if batched:
+    try:
+      interpreter.resize_tensor_input(input_index, [batch_size, X.shape[1]])
+      interpreter.allocate_tensors()
+    except (ValueError, RuntimeError):
+      batched = False
+      interpreter.resize_tensor_input(input_index, [1, X.shape[1]])
+      interpreter.allocate_tensors()
+
+  start_time = time.perf_counter()
+  if batched:
+    y_pred = []
+    latencies = []
+    for start in range(0, len(X), batch_size):
+      batch = X[start:start + batch_size]
+      rows = len(batch)
+      # Pad the last batch up to the input size
+      if rows < batch_size:
+        batch = np.concatenate(
+            [batch, np.zeros((batch_size - rows, X.shape[1]), X.dtype)])
+      predictions, latency = _run_classifier(interpreter, input_index,
+                                             output_index, batch)
+      y_pred.append(predictions[:rows])
+      latencies.append(latency)
+    y_pred = np.concatenate(y_pred) if y_pred else np.zeros(0, np.int64)
+  else:
+    batch_size = 1
+    if model_content is None or num_threads <= 1:
+      outcomes = [_run_classifier(interpreter, input_index, output_index,
+                                  X[i:i + 1])
+                  for i in range(len(X))]
+    else:
+      # An interpreter can't be shared between threads, give each its own
+      local = threading.local()
+      def classify_row(i):
+        if not hasattr(local, 'interpreter'):
+          local.interpreter = tf.lite.Interpreter(model_content=model_content)
+          local.interpreter.allocate_tensors()
+        return _run_classifier(local.interpreter, input_index, output_index,
+                               X[i:i + 1])
+      with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        outcomes = list(executor.map(classify_row, range(len(X))))
+    y_pred = np.array([predictions[0] for predictions, _ in outcomes])
+    latencies = [latency for _, latency in outcomes]
+  elapsed = time.perf_counter() - start_time
 
   # Compare prediction results with ground truth labels to calculate accuracy.
-  y_pred = keras.utils.to_categorical(y_pred)
-  return accuracy_score(y_true, y_pred)
-
-# Evaluate the accuracy of the converted TFLite model
+  p50, p99 = np.percentile(latencies, [50, 99]) if latencies else (0.0, 0.0)
+  return EvaluationResult(accuracy_score(y_true, y_pred),
+                          len(X) / elapsed if elapsed else 0.0,
+                          p50, p99, batch_size)
+
+def print_evaluation(name, result):
+  """Prints an `EvaluationResult`."""
+  print('%s: accuracy %.4f, %.0f rows/s, latency p50 %.3f ms, p99 %.3f ms '
+        '(batch size %d)' % (name, result.accuracy, result.rows_per_second,
+                             result.latency_p50, result.latency_p99,
+                             result.batch_size))
+
+# Evaluate the converted TFLite model
 classifier_interpreter = tf.lite.Interpreter(model_content=tflite_model)
 classifier_interpreter.allocate_tensors()
-print('Accuracy of TFLite model: %s' %
-      evaluate_model(classifier_interpreter, X_test, y_test))
+print_evaluation('TFLite model',
+                 evaluate_model(classifier_interpreter, X_test, y_test,
+                                model_content=tflite_model))
+
+# Export the pipeline metrics recorded since preprocessing started
+metrics.write('metrics.prom', 'metrics.json')
+
+def compare_classifier_variants(model, X_train, X_test, y_test,
+                                modes=('dynamic', 'int8', 'float16'),
+                                representative_count=200,
+                                report_path='tflite_variants_report.csv'):
+  """Exports the classifier in each quantization mode and compares them.
+
+  Each variant is written to `pose_classifier_<mode>.tflite`. The report holds
+  its size, test accuracy and single-row latency, and the error of any
+  variant that failed to convert. The int8 variant is calibrated on
+  `representative_count` random training rows.
+  """
+  X_train = np.asarray(X_train, dtype=np.float32)
+  rng = np.random.default_rng(42)
+  representative_data = X_train[rng.permutation(len(X_train))[
+      :representative_count]]
+
+  report = []
+  for mode in modes:
+    try:
+      variant = convert_classifier(model, mode, representative_data)
+    except Exception as e:
+      report.append({'mode': mode, 'error': str(e)})
+      continue
+    with open('pose_classifier_%s.tflite' % mode, 'wb') as f:
+      f.write(variant)
+
+    interpreter = tf.lite.Interpreter(model_content=variant)
+    interpreter.allocate_tensors()
+    result = evaluate_model(interpreter, X_test, y_test, batch_size=1)
+    report.append({'mode': mode,
+                   'size_kb': len(variant) / 1024,
+                   'accuracy': result.accuracy,
+                   'latency_p50_ms': result.latency_p50,
+                   'latency_p99_ms': result.latency_p99})
+
+  report = pd.DataFrame(report)
+  report.to_csv(report_path, index=False)
+  return report
+
+# Compare the quantized variants to pick the cheapest one that is accurate
+# enough for the target device
+print(compare_classifier_variants(model, X_train, X_test, y_test))
+
+class StageTimer(object):
+  """Collects the wall time of named pipeline stages.
+
+  Use `with timer.stage(name, items):` around one run of a stage, where
+  `items` is the number of images or rows that run handled.
+  """
+
+  def __init__(self):
+    self._durations = collections.defaultdict(list)
+    self._items = collections.Counter()
+
+  @contextlib.contextmanager
+  def stage(self, name, items=1):
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      self._durations[name].append(time.perf_counter() - start_time)
+      self._items[name] += items
+
+  def summary(self):
+    """Returns the throughput and latency percentiles of every stage."""
+    summary = {}
+    for name, durations in self._durations.items():
+      total = sum(durations)
+      p50, p90, p99 = np.percentile(durations, [50, 90, 99]) * 1000
+      summary[name] = {'runs': len(durations),
+                       'items': self._items[name],
+                       'total_seconds': total,
+                       'items_per_second': (self._items[name] / total
+                                            if total else 0.0),
+                       'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99}
+    return summary
+
+def benchmark_image_paths(image_folders, limit=None):
+  """Lists the images in the given folders and their subfolders.
+
+  Raises a ValueError if a folder doesn't exist or if none of them holds any
+  images, so that a benchmark never silently measures nothing. Folders
+  without images, such as the Dataset2 placeholder, are reported and skipped.
+  """
+  image_paths = []
+  for image_folder in image_folders:
+    if not os.path.isdir(image_folder):
+      raise ValueError(f'Benchmark folder {image_folder} does not exist.')
+    folder_image_paths = []
+    for dirpath, dirnames, filenames in os.walk(image_folder):
+      dirnames.sort()
+      folder_image_paths += [os.path.join(dirpath, filename)
+                             for filename in sorted(filenames)
+                             if os.path.splitext(filename)[1].lower()
+                             in IMAGE_EXTENSIONS]
+    if not folder_image_paths:
+      print(f'Benchmark folder {image_folder} holds no images, skipping it.')
+    image_paths += folder_image_paths
+  if not image_paths:
+    raise ValueError(f'None of the benchmark folders {", ".join(image_folders)} holds images.')
+  return image_paths[:limit]
+
+def compare_benchmark(results, baseline_path, tolerance=0.2):
+  """Checks benchmark results against a stored baseline.
+
+  Returns a message for every stage whose p50 latency grew, or whose
+  throughput dropped, by more than `tolerance` relative to the baseline.
+  """
+  with open(baseline_path) as baseline_file:
+    baseline = json.load(baseline_file)
+  regressions = []
+  for name, stage in baseline['stages'].items():
+    current = results['stages'].get(name)
+    if current is None:
+      continue
+    if current['p50_ms'] > stage['p50_ms'] * (1 + tolerance):
+      regressions.append(f'{name}: p50 {current["p50_ms"]:.3f} ms vs {stage["p50_ms"]:.3f} ms')
+    if current['items_per_second'] < stage['items_per_second'] * (1 - tolerance):
+      regressions.append(f'{name}: {current["items_per_second"]:.1f} items/s vs '
+                         f'{stage["items_per_second"]:.1f} items/s')
+  return regressions
+
+def benchmark_pipeline(image_folders, classifier_model=None, limit=None,
+                       detection_threshold=0.1,
+                       results_path='benchmark_mediapipe.json',
+                       baseline_path=None, tolerance=0.2):
+  """Times each stage of the MediaPipe pipeline over the given image folders.
+
+  The stages are file read, decode, pose detection, overlay rendering, image
+  write, landmark row write, merge into a CSV, embedding and, if the TFLite
+  `classifier_model` content is given, classifier inference. Outputs go to a
+  temp dir. The results are written as JSON to `results_path`. If
+  `baseline_path` is given, a RuntimeError is raised when a stage regressed
+  by more than `tolerance`, see `compare_benchmark`.
+  """
+  timer = StageTimer()
+  image_paths = benchmark_image_paths(image_folders, limit)
+  output_folder = tempfile.mkdtemp()
+  landmarks_out_prefix = os.path.join(output_folder, 'landmarks')
+  start_time = time.perf_counter()
+
+  pose = mp_pose.Pose(static_image_mode=True, min_detection_confidence=detection_threshold)
+  try:
+    with LandmarkRowWriter(landmarks_out_prefix) as landmarks_out_writer:
+      for image_index, image_path in enumerate(image_paths):
+        with timer.stage('read'):
+          with open(image_path, 'rb') as f:
+            contents = f.read()
+        with timer.stage('decode'):
+          image = cv2.imdecode(np.frombuffer(contents, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+          continue
+        image_height, image_width, _ = image.shape
+
+        with timer.stage('detect'):
+          results = pose.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        if not results.pose_landmarks:
+          continue
+        pose_landmarks = np.array(
+            [[lm.x * image_width, lm.y * image_height, lm.z]
+             for lm in results.pose_landmarks.landmark], dtype=np.float32)
+        visibility = [lm.visibility for lm in results.pose_landmarks.landmark]
+
+        with timer.stage('render'):
+          output_frame = skeleton_renderer.render(image, pose_landmarks, visibility)
+        with timer.stage('write_image'):
+          write_image(os.path.join(output_folder, f'{image_index}.jpg'), output_frame)
+        with timer.stage('write_row'):
+          landmarks_out_writer.writerow(os.path.basename(image_path), pose_landmarks)
+  finally:
+    pose.close()
+
+  image_names, landmarks = read_landmark_rows(landmarks_out_prefix, len(mp_pose.PoseLandmark) * 3)
+  with timer.stage('merge', len(landmarks)):
+    header_name = ['file_name'] + [f'{bodypart}{suffix}' for bodypart in mp_pose.PoseLandmark
+                                   for suffix in ('_x', '_y', '_score')]
+    merged_df = pd.DataFrame(landmarks, columns=header_name[1:])
+    merged_df.insert(0, 'file_name', image_names)
+    merged_df.to_csv(os.path.join(output_folder, 'landmarks.csv'), index=False)
+
+  # Nothing is left to embed or classify if no pose was found
+  if len(landmarks):
+    with timer.stage('embedding', len(landmarks)):
+      embeddings = pose_embeddings(landmarks)
+
+  if classifier_model is not None and len(landmarks):
+    interpreter = tf.lite.Interpreter(model_content=classifier_model)
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    output_index = interpreter.get_output_details()[0]['index']
+    # Models trained on embeddings take (x, y) pairs rather than triples
+    inputs = embeddings if input_details['shape'][-1] == embeddings.shape[1] else landmarks
+    for row in inputs:
+      with timer.stage('classify'):
+        interpreter.set_tensor(input_details['index'],
+                               quantize_classifier_input(input_details, row[np.newaxis]))
+        interpreter.invoke()
+        interpreter.get_tensor(output_index)
+
+  results = {'backend': 'mediapipe',
+             'image_folders': list(image_folders),
+             'images': len(image_paths),
+             'kept_images': len(landmarks),
+             'total_seconds': time.perf_counter() - start_time,
+             'stages': timer.summary()}
+  with open(results_path, 'w') as results_file:
+    json.dump(results, results_file, indent=2)
+
+  if baseline_path is not None and os.path.exists(baseline_path):
+    regressions = compare_benchmark(results, baseline_path, tolerance)
+    if regressions:
+      raise RuntimeError(f'Benchmark regressed against {baseline_path}:\n' + '\n'.join(regressions))
+  return results
+
+# Benchmark the pipeline on the images bundled with the repository checkout.
+# Copy a run's results to the baseline file to make it the reference for later
+# runs.
+BENCHMARK_IMAGE_FOLDERS = [
+    os.path.join(REPO_PATH, folder)
+    for folder in ('Dataset', 'Dataset1', 'Dataset2')]
+benchmark_results = benchmark_pipeline(
+    BENCHMARK_IMAGE_FOLDERS,
+    classifier_model=tflite_model,
+    baseline_path='benchmark_mediapipe_baseline.json')
+for stage_name, stage in benchmark_results['stages'].items():
+  print('%-14s %8.1f items/s  p50 %8.3f ms  p99 %8.3f ms' %
+        (stage_name, stage['items_per_second'], stage['p50_ms'], stage['p99_ms']))
 
 !zip pose_classifier.zip pose_labels.txt pose_classifier.tflite
 
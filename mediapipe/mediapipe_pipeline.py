@@ -0,0 +1,852 @@
+"""Importable part of the MediaPipe pose classification notebook.
+
+Preprocessing workers are spawned processes, which can't load functions
+defined in the notebook's `__main__`, so everything they run lives here:
+metrics, the landmark cache, image ingest, overlays and the per-image
+preprocessing, together with the run manifest and writers of
+`MediapipePreprocessor`. The NumPy pose embeddings live here too, so that they
+can be tested outside the notebook. The notebook imports this module from its
+checkout of the repository.
+"""
+
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import resource
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+from mediapipe.python.solutions import pose as mp_pose
+
+
+class Metrics(object):
+    """Stage timers, counters and histograms of the pose pipeline.
+
+    Metrics are off until `enable()` is called. While they are off, every
+    recording call returns right away, so the instrumentation can stay in hot
+    loops. Worker processes hand their metrics over to the parent process with
+    `drain()` and `merge()`. `write()` exports them as Prometheus text and as a
+    JSON summary, together with the peak RSS.
+    """
+
+    # Histogram bucket upper bounds of stage durations in seconds, and of
+    # keypoint visibilities
+    SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    SCORE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+    def __init__(self, prefix='pose'):
+        self.enabled = False
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._histograms = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def count(self, name, value=1, **labels):
+        """Adds `value` to a counter."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, values, buckets, **labels):
+        """Adds a value, or an array of values, to a histogram."""
+        if not self.enabled:
+            return
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        bucket_counts = np.bincount(np.searchsorted(buckets, values), minlength=len(buckets) + 1)
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [tuple(buckets), np.zeros(len(buckets) + 1, np.int64), 0.0]
+            histogram[1] += bucket_counts
+            histogram[2] += float(values.sum())
+
+    def timer(self, stage, items=1):
+        """Returns a context manager that times one run of a stage."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageMetricsTimer(self, stage, items)
+
+    def drain(self):
+        """Returns the metrics recorded so far and resets them."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            state = (self._counters, self._histograms)
+            self._counters = collections.Counter()
+            self._histograms = {}
+        return state
+
+    def merge(self, state):
+        """Adds metrics returned by `drain()`, e.g. in a worker process."""
+        if state is None:
+            return
+        counters, histograms = state
+        with self._lock:
+            self._counters.update(counters)
+            for key, (buckets, bucket_counts, total) in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    self._histograms[key] = [buckets, bucket_counts.copy(), total]
+                else:
+                    histogram[1] += bucket_counts
+                    histogram[2] += total
+
+    @staticmethod
+    def peak_rss_bytes():
+        """Peak RSS of this process and of its largest finished child process."""
+        # ru_maxrss is in kilobytes on Linux
+        return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024}
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+            for name, value in labels) + '}'
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f'{self._prefix}_{name}_total'
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric}{self._format_labels(labels)} {value}')
+        for (name, labels), (buckets, bucket_counts, total) in histograms:
+            metric = f'{self._prefix}_{name}'
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f'# TYPE {metric} histogram')
+            cumulative_counts = np.cumsum(bucket_counts)
+            for bound, cumulative_count in zip([repr(bound) for bound in buckets] + ['+Inf'],
+                                               cumulative_counts):
+                lines.append(f'{metric}_bucket{self._format_labels(labels + (("le", bound),))} '
+                             f'{cumulative_count}')
+            lines.append(f'{metric}_sum{self._format_labels(labels)} {total!r}')
+            lines.append(f'{metric}_count{self._format_labels(labels)} {cumulative_counts[-1]}')
+        metric = f'{self._prefix}_peak_rss_bytes'
+        lines.append(f'# TYPE {metric} gauge')
+        for process, rss in self.peak_rss_bytes().items():
+            lines.append(f'{metric}{{process="{process}"}} {rss}')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """Returns a JSON-serializable summary of the metrics."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+        summary = {'counters': [], 'histograms': [], 'peak_rss_bytes': self.peak_rss_bytes()}
+        for (name, labels), value in counters:
+            summary['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+        for (name, labels), (buckets, bucket_counts, total) in histograms:
+            count = int(bucket_counts.sum())
+            summary['histograms'].append(
+                {'name': name, 'labels': dict(labels), 'count': count, 'sum': total,
+                 'mean': total / count if count else 0.0, 'buckets': list(buckets),
+                 'bucket_counts': bucket_counts.tolist()})
+        return summary
+
+    def write(self, prometheus_path=None, json_path=None):
+        """Writes the metrics to a Prometheus text file and/or a JSON file."""
+        if prometheus_path is not None:
+            with open(prometheus_path, 'w') as prometheus_file:
+                prometheus_file.write(self.to_prometheus())
+        if json_path is not None:
+            with open(json_path, 'w') as json_file:
+                json.dump(self.to_json(), json_file, indent=2)
+
+
+class _StageMetricsTimer(object):
+    """Records the duration and item count of one stage run in `Metrics`."""
+
+    def __init__(self, metrics, stage, items):
+        self._metrics = metrics
+        self._stage = stage
+        self._items = items
+
+    def __enter__(self):
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics.observe('stage_seconds', time.perf_counter() - self._start_time,
+                              Metrics.SECONDS_BUCKETS, stage=self._stage)
+        self._metrics.count('stage_items', self._items, stage=self._stage)
+
+
+_NULL_TIMER = contextlib.nullcontext()
+
+# Metrics of this process
+metrics = Metrics()
+
+
+class LandmarkCache(object):
+    """On-disk landmark cache keyed by image content and detection settings.
+
+    Each entry is a .npy file named after the SHA-256 of the image bytes, the
+    backend, the model variant and the detection parameters, so a hit can be
+    used in place of running pose detection. Reading an entry refreshes its
+    mtime, and `trim()` evicts the least recently used entries once the cache
+    grows past `max_bytes`.
+
+    The same cache directory can be shared by the MoveNet and MediaPipe
+    preprocessors since the backend is part of the key.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, image_bytes, backend, model, **params):
+        """Returns the cache key of an image under the given detection settings."""
+        digest = hashlib.sha256(image_bytes)
+        settings = [backend, model] + [f'{name}={value!r}' for name, value in sorted(params.items())]
+        digest.update('\0'.join(settings).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self._cache_dir, key[:2], key + '.npy')
+
+    def get(self, key):
+        """Returns the cached landmarks for `key`, or None on a miss."""
+        entry_path = self._entry_path(key)
+        try:
+            landmarks = np.load(entry_path)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            return None
+        return landmarks
+
+    def put(self, key, landmarks):
+        """Stores the landmarks detected for `key`."""
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        # Write to a temp file first so that readers never see a partial entry
+        tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, landmarks)
+        os.replace(tmp_path, entry_path)
+
+    def record(self, hit):
+        """Counts a lookup made by this process or by a worker process."""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def _entries(self):
+        """Returns (mtime, size, path) for every entry in the cache."""
+        entries = []
+        for dirpath, _, filenames in os.walk(self._cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.npy'):
+                    continue
+                entry_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(entry_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return entries
+
+    def trim(self):
+        """Evicts least recently used entries until the cache fits `max_bytes`."""
+        entries = sorted(self._entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total_bytes <= self._max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Returns lookup counters and the current size of the cache."""
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'size_bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self._max_bytes,
+        }
+
+    def report(self):
+        """Formats `stats()` as a one-line summary."""
+        stats = self.stats()
+        return ('Landmark cache: {hits} hits, {misses} misses ({hit_rate:.1%}), '
+                '{evictions} evicted, {entries} entries, '
+                '{size_bytes} of {max_bytes} bytes'.format(**stats))
+
+
+# Image file extensions picked up from the dataset folders, in lower case so
+# that mixed-case names such as "sit (175).JPG" are matched as well.
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+# JPEG start-of-frame markers, which carry the image size and component count
+_JPEG_SOF_MARKERS = frozenset([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+
+ImageHeader = collections.namedtuple('ImageHeader', ['format', 'width', 'height'])
+
+
+def read_image_header(contents):
+    """Parses the size of a JPEG or PNG file without decoding any pixels.
+
+    Returns an `ImageHeader`, or None if `contents` isn't a well-formed JPEG or
+    PNG file.
+    """
+    if contents[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(contents) < 24 or contents[12:16] != b'IHDR':
+            return None
+        width, height = struct.unpack('>II', contents[16:24])
+        return ImageHeader('png', width, height)
+
+    if contents[:2] != b'\xff\xd8':
+        return None
+
+    # Walk the JPEG marker segments up to the frame header
+    offset = 2
+    while offset + 4 <= len(contents):
+        if contents[offset] != 0xFF:
+            return None
+        marker = contents[offset + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Markers without a length field
+            offset += 2
+            continue
+        if marker == 0xDA:
+            # Start of scan without a frame header
+            return None
+        if marker in _JPEG_SOF_MARKERS:
+            if offset + 9 > len(contents):
+                return None
+            height, width = struct.unpack('>HH', contents[offset + 5:offset + 9])
+            return ImageHeader('jpeg', width, height)
+        segment_length, = struct.unpack('>H', contents[offset + 2:offset + 4])
+        offset += 2 + segment_length
+    return None
+
+
+# `cv2.imdecode` flags that decode JPEG files at 1/8, 1/4 and 1/2 of their size
+_REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                         (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def ingest_image(image_path, max_long_side=None):
+    """Reads an image file once and decodes it to a BGR array.
+
+    The format is detected from the file content rather than the extension.
+    If `max_long_side` is set, larger images are scaled down so that their
+    longer side is that long. JPEG files are decoded at 1/2, 1/4 or 1/8 scale
+    straight from their DCT coefficients, which skips most of the decoding work
+    and memory, and what remains is resized with `cv2.INTER_AREA`.
+
+    Returns a (contents, image, original_size) tuple where `image` is None if
+    the file could not be read or decoded, and `original_size` is the
+    (width, height) of the full-size image.
+    """
+    try:
+        with open(image_path, 'rb') as f:
+            contents = f.read()
+    except OSError:
+        return None, None, None
+
+    flags = cv2.IMREAD_COLOR
+    header = None
+    if max_long_side is not None:
+        header = read_image_header(contents)
+        if header is not None and header.format == 'jpeg':
+            long_side = max(header.width, header.height)
+            flags = next((reduced_flags for ratio, reduced_flags in _REDUCED_DECODE_FLAGS
+                          if long_side / ratio >= max_long_side), flags)
+    image = cv2.imdecode(np.frombuffer(contents, dtype=np.uint8), flags)
+    if image is None:
+        return contents, None, None
+
+    image_height, image_width, _ = image.shape
+    if header is None:
+        original_size = (image_width, image_height)
+    elif (image_width > image_height) == (header.width > header.height):
+        original_size = (header.width, header.height)
+    else:
+        # OpenCV applied a 90 degree EXIF rotation
+        original_size = (header.height, header.width)
+
+    if max_long_side is not None and max(image_height, image_width) > max_long_side:
+        scale = max_long_side / max(image_height, image_width)
+        image = cv2.resize(image, (max(1, round(image_width * scale)), max(1, round(image_height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    return contents, image, original_size
+
+
+class SkeletonRenderer(object):
+    """Draws pose skeletons with OpenCV into a reusable image buffer.
+
+    Overlays look like those of `mp_drawing.draw_landmarks`, but rendering
+    works on landmark arrays of pixel [x, y, z] rows, so overlays can also be
+    drawn from cached or stored landmarks, and all edges are drawn with a single
+    `cv2.polylines` call. Like `mp_drawing.draw_landmarks`, landmarks with a
+    visibility below `visibility_threshold` and their edges are left out.
+    """
+
+    def __init__(self, connections, edge_color=(224, 224, 224), landmark_color=(0, 0, 255),
+                 visibility_threshold=0.5):
+        self._edge_color = edge_color
+        self._landmark_color = landmark_color
+        self._visibility_threshold = visibility_threshold
+        self._starts, self._ends = np.array(sorted(connections), dtype=np.int32).T
+        self._buffer = np.empty(0, dtype=np.uint8)
+
+    def render(self, image, landmarks, visibility=None):
+        """Returns a copy of the BGR `image` with the skeleton drawn on top.
+
+        `visibility` holds the MediaPipe visibility of each landmark. Stored
+        landmarks come without it, and are all drawn. The result is a view of the
+        renderer's buffer and is only valid until the next call.
+        """
+        if self._buffer.size < image.size:
+            self._buffer = np.empty(image.size, dtype=np.uint8)
+        output = self._buffer[:image.size].reshape(image.shape)
+        np.copyto(output, image)
+
+        # Scale the strokes with the image so they stay visible on large photos
+        thickness = max(2, round(max(image.shape[:2]) / 500))
+        points = np.round(landmarks[:, :2]).astype(np.int32)
+        if visibility is None:
+            visible = np.ones(len(points), dtype=bool)
+        else:
+            visible = np.asarray(visibility) >= self._visibility_threshold
+
+        # Draw the connections between visible landmarks, then the landmarks on top
+        drawn = visible[self._starts] & visible[self._ends]
+        lines = np.stack([points[self._starts[drawn]], points[self._ends[drawn]]], axis=1)
+        if len(lines):
+            cv2.polylines(output, list(lines), False, self._edge_color, thickness)
+        for x, y in points[visible].tolist():
+            cv2.circle(output, (x, y), thickness, self._landmark_color, -1)
+
+        return output
+
+
+# Overlay renderer of this process
+skeleton_renderer = SkeletonRenderer(mp_pose.POSE_CONNECTIONS)
+
+
+def write_image(image_path, image):
+    """Writes an image file, raising an error if OpenCV fails to write it."""
+    if not cv2.imwrite(image_path, image):
+        raise IOError(f'Could not write {image_path}')
+
+
+class AsyncWriter(object):
+    """Runs output writes on background threads behind a bounded queue.
+
+    `submit()` blocks once `max_pending` writes are waiting, so a slow disk
+    throttles the producer instead of filling up memory. A writer with a single
+    thread performs writes in submission order. The first error raised by a
+    write is re-raised by the next `submit()` or `flush()`, and later writes are
+    dropped.
+    """
+
+    def __init__(self, num_threads=1, max_pending=64):
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(num_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None:
+                    write, args = item
+                    write(*args)
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('Background write failed.') from self._error
+
+    def submit(self, write, *args):
+        """Queues `write(*args)`, waiting while the queue is full."""
+        self._raise_error()
+        self._queue.put((write, args))
+
+    def flush(self):
+        """Waits until every queued write is done."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Stops the writer threads once the queued writes are done."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class LandmarkRowWriter(object):
+    """Appends landmark rows of one pose class to a pair of binary files.
+
+    Image names go to `<prefix>.names`, one per line, and landmarks to
+    `<prefix>.f32` as raw float32 rows, so they can be read back with
+    `read_landmark_rows` without any text parsing.
+    """
+
+    def __init__(self, path_prefix):
+        self._names_file = open(path_prefix + '.names', 'w')
+        self._landmarks_file = open(path_prefix + '.f32', 'wb')
+
+    def writerow(self, image_name, landmarks):
+        self._names_file.write(image_name + '\n')
+        self._landmarks_file.write(landmarks.astype(np.float32).tobytes())
+
+    def close(self):
+        self._names_file.close()
+        self._landmarks_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_landmark_rows(path_prefix, row_size):
+    """Reads back the (image names, landmarks) written by `LandmarkRowWriter`."""
+    with open(path_prefix + '.names') as names_file:
+        image_names = names_file.read().splitlines()
+    landmarks = np.fromfile(path_prefix + '.f32', dtype=np.float32)
+    return image_names, landmarks.reshape(-1, row_size)
+
+
+class RunManifest(object):
+    """Persistent record of the images of one pose class that were processed.
+
+    Every processed image gets a JSON line in `<prefix>.manifest` with its
+    mtime, size and SHA-256, and its outcome: 'kept' with its landmarks, or
+    'skipped' with the reason. Lines are appended and flushed as soon as an
+    image is done, so a run that is killed partway through keeps its work. An
+    image whose file didn't change since it was recorded can be reused instead
+    of being processed again. If only its mtime changed, its hash decides.
+
+    The first line holds the detection settings. Records made with other
+    settings are discarded.
+
+    `finish()` writes the kept landmarks in image-name order to
+    `<prefix>.names` and `<prefix>.f32` for `read_landmark_rows`, and compacts
+    the manifest.
+    """
+
+    def __init__(self, path_prefix, settings):
+        self._path_prefix = path_prefix
+        self._manifest_path = path_prefix + '.manifest'
+        self._settings = settings
+        self._records = {}
+
+        try:
+            with open(self._manifest_path) as manifest_file:
+                lines = manifest_file.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+
+        if lines and self._parse(lines[0]) == {'settings': settings}:
+            for line in lines[1:]:
+                record = self._parse(line)
+                # A partly written last line is left by a run that was killed
+                if record is not None:
+                    self._records[record['name']] = record
+
+        # Start over from the records read so far, without stale or partial lines
+        self._rewrite(self._records)
+        self._manifest_file = open(self._manifest_path, 'a')
+
+    @staticmethod
+    def _parse(line):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    def _rewrite(self, records):
+        tmp_path = f'{self._manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as manifest_file:
+            manifest_file.write(json.dumps({'settings': self._settings}) + '\n')
+            for record in records.values():
+                manifest_file.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self._manifest_path)
+
+    def _append(self, record):
+        self._records[record['name']] = record
+        self._manifest_file.write(json.dumps(record) + '\n')
+        self._manifest_file.flush()
+
+    def lookup(self, image_name, image_path, stat):
+        """Returns the record of an unchanged image, or None if it needs processing.
+
+        `stat` is the `os.stat` result of the image file.
+        """
+        record = self._records.get(image_name)
+        if record is None or record['size'] != stat.st_size:
+            return None
+        if record['mtime_ns'] != stat.st_mtime_ns:
+            with open(image_path, 'rb') as image_file:
+                digest = hashlib.sha256(image_file.read()).hexdigest()
+            if digest != record['sha256']:
+                return None
+            # Same contents, remember the new mtime to skip hashing next time
+            record = dict(record, mtime_ns=stat.st_mtime_ns)
+            self._append(record)
+        return record
+
+    def add(self, image_name, stat, digest, landmarks, message):
+        """Records the outcome of processing an image.
+
+        `landmarks` is None if the image was skipped, `message` then says why.
+        """
+        record = {'name': image_name, 'mtime_ns': stat.st_mtime_ns,
+                  'size': stat.st_size, 'sha256': digest}
+        if landmarks is None:
+            record.update(outcome='skipped', reason=message)
+        else:
+            record.update(outcome='kept', landmarks=landmarks.tolist())
+        self._append(record)
+
+    def discard(self, image_name):
+        """Forgets the record of an image that can no longer be read."""
+        self._records.pop(image_name, None)
+
+    def finish(self, image_names, retained_names):
+        """Writes the landmark rows of `image_names` and compacts the manifest.
+
+        Records of images not in `retained_names`, e.g. deleted files, are
+        dropped.
+        """
+        with LandmarkRowWriter(self._path_prefix) as writer:
+            for image_name in image_names:
+                record = self._records.get(image_name)
+                if record is not None and record['outcome'] == 'kept':
+                    writer.writerow(image_name, np.array(record['landmarks']))
+
+        self._manifest_file.close()
+        retained_names = set(retained_names)
+        self._records = {name: record for name, record in self._records.items()
+                         if name in retained_names}
+        self._rewrite(self._records)
+
+    def close(self):
+        self._manifest_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Outcome of preprocessing one image. `landmarks` is the (33, 3) array of
+# pixel [x, y, z] rows to store, or None if the image was skipped, in which
+# case `message` explains why. `cache_hit` is None when no cache is used.
+# `digest` is the SHA-256 of the image file, or None if it couldn't be read.
+PreprocessResult = collections.namedtuple(
+    'PreprocessResult', ['landmarks', 'message', 'cache_hit', 'digest'],
+    defaults=[None, None, None])
+
+# Pose graph owned by a preprocessing worker process
+_worker_pose = None
+
+
+def _init_pose_worker(detection_threshold, metrics_enabled=False):
+    """Creates the private MediaPipe Pose graph of a worker process.
+
+    Workers are spawned rather than forked, so they start without the parent's
+    MediaPipe and TensorFlow runtimes and only get the state passed in here.
+    They import the worker functions from this module, since a spawned process
+    can't load functions defined in the notebook.
+    """
+    global _worker_pose
+    _worker_pose = mp_pose.Pose(static_image_mode=True, min_detection_confidence=detection_threshold)
+    # Start from empty metrics, recorded only if the parent records them
+    metrics.enable(metrics_enabled)
+    metrics.drain()
+
+
+def _preprocess_image(pose, image_path, image_out_path, detection_threshold, cache=None,
+                      max_long_side=None, overlay_writer=None):
+    """Detects the pose in one image and writes its debug overlay.
+
+    No overlay is written if `image_out_path` is None, and it is written in the
+    background if an `AsyncWriter` is given. If a `LandmarkCache` is given,
+    landmarks stored for the same image and settings are reused instead of
+    running the Pose graph. If `max_long_side` is set, the pose is detected on
+    an image scaled down to that size, the landmarks are still stored in
+    original image pixels and the overlay is drawn at the scaled size.
+    """
+    with metrics.timer('ingest'):
+        contents, image, original_size = ingest_image(image_path, max_long_side)
+    digest = hashlib.sha256(contents).hexdigest() if contents is not None else None
+    if image is None:
+        metrics.count('images', outcome='skipped', reason='invalid')
+        return PreprocessResult(None, f'Skipped {image_path}. Invalid image.', digest=digest)
+    # Landmarks are stored in the pixels of the original image
+    image_width, image_height = original_size
+
+    pose_landmarks = None
+    cache_hit = None
+    if cache is not None:
+        params = {'detection_threshold': detection_threshold}
+        if max_long_side is not None:
+            params['max_long_side'] = max_long_side
+        cache_key = cache.key(contents, 'mediapipe', 'pose_model_complexity_1', **params)
+        pose_landmarks = cache.get(cache_key)
+        cache_hit = pose_landmarks is not None
+
+    if not cache_hit:
+        # Convert image to RGB format
+        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+        # Run pose estimation on the image
+        with metrics.timer('detect'):
+            results = pose.process(image_rgb)
+
+        # Get the landmark coordinates, with the visibility of each landmark
+        # as a fourth column for the overlay. An empty array records that no
+        # pose was found, so that cache hits can skip those images too.
+        if results.pose_landmarks:
+            pose_landmarks = np.array([[lm.x * image_width, lm.y * image_height, lm.z, lm.visibility]
+                                       for lm in results.pose_landmarks.landmark], dtype=np.float32)
+            metrics.observe('keypoint_score', pose_landmarks[:, 3], Metrics.SCORE_BUCKETS)
+        else:
+            pose_landmarks = np.zeros((0, 4), dtype=np.float32)
+        if cache is not None:
+            cache.put(cache_key, pose_landmarks)
+
+    visibility = pose_landmarks[:, 3]
+    pose_landmarks = pose_landmarks[:, :3]
+
+    # Check if landmarks were detected
+    if not len(pose_landmarks):
+        metrics.count('images', outcome='skipped', reason='low_confidence')
+        return PreprocessResult(None, f'Skipped {image_path}. No pose was confidently detected.', cache_hit,
+                                digest)
+
+    if image_out_path is not None:
+        with metrics.timer('overlay'):
+            # Draw the pose landmarks on the image for debugging, at its scaled size
+            scale = np.array([image.shape[1] / image_width, image.shape[0] / image_height, 1],
+                             dtype=np.float32)
+            output_frame = skeleton_renderer.render(image, pose_landmarks * scale, visibility)
+
+            # Write the processed image to the output folder. The frame lives in the
+            # renderer's buffer, so a background write needs its own copy.
+            if overlay_writer is None:
+                write_image(image_out_path, output_frame)
+            else:
+                overlay_writer.submit(write_image, image_out_path, output_frame.copy())
+
+    metrics.count('images', outcome='kept')
+    return PreprocessResult(pose_landmarks, None, cache_hit, digest)
+
+
+def _preprocess_image_in_worker(task):
+    """Runs `_preprocess_image` with the worker's own Pose graph.
+
+    Returns the result together with the metrics the worker recorded for it.
+    """
+    return _preprocess_image(_worker_pose, *task), metrics.drain()
+
+
+def _merge_worker_metrics(outcomes):
+    """Yields the results of worker outcomes after merging their metrics."""
+    for result, worker_metrics in outcomes:
+        metrics.merge(worker_metrics)
+        yield result
+
+
+def read_image_list(list_path):
+    """Reads an image list file written by `split_into_train_test`.
+
+    The file has one image path per line, and the name of the folder an image
+    is in is its class. Returns a dict of class name to image paths.
+    """
+    class_image_paths = collections.defaultdict(list)
+    with open(list_path) as list_file:
+        for image_path in list_file.read().splitlines():
+            if image_path:
+                class_name = os.path.basename(os.path.dirname(image_path))
+                class_image_paths[class_name].append(image_path)
+    return dict(class_image_paths)
+
+
+def pose_embeddings(landmarks_and_scores, torso_size_multiplier=2.5,
+                    hips=(mp_pose.PoseLandmark.LEFT_HIP, mp_pose.PoseLandmark.RIGHT_HIP),
+                    shoulders=(mp_pose.PoseLandmark.LEFT_SHOULDER,
+                               mp_pose.PoseLandmark.RIGHT_SHOULDER)):
+    """Computes the pose embeddings of a batch of flat landmark rows with NumPy.
+
+    Does what `landmarks_to_embedding` does in the model, for any number of
+    [x, y, z] landmarks per row: 33 for MediaPipe, or 17 for MoveNet with its
+    hip and shoulder indices. The pose size is computed per sample.
+    Returns a float32 array of the flattened normalized (x, y) coordinates.
+    """
+    landmarks_and_scores = np.asarray(landmarks_and_scores, dtype=np.float32)
+    landmarks = landmarks_and_scores.reshape(len(landmarks_and_scores), -1, 3)[:, :, :2]
+
+    # Move landmarks so that the hips center becomes (0,0)
+    hips_center = (landmarks[:, int(hips[0])] + landmarks[:, int(hips[1])]) * 0.5
+    shoulders_center = (landmarks[:, int(shoulders[0])] + landmarks[:, int(shoulders[1])]) * 0.5
+    landmarks = landmarks - hips_center[:, np.newaxis]
+
+    # Pose size is the larger of the scaled torso size and the maximum distance
+    # from the center to any landmark
+    torso_size = np.linalg.norm(shoulders_center - hips_center, axis=1)
+    max_dist = np.max(np.linalg.norm(landmarks, axis=2), axis=1)
+    pose_size = np.maximum(torso_size * torso_size_multiplier, max_dist)
+
+    # Avoid dividing by zero for rows without any landmark spread
+    pose_size = np.maximum(pose_size, np.finfo(np.float32).eps)
+    landmarks /= pose_size[:, np.newaxis, np.newaxis]
+
+    return landmarks.reshape(len(landmarks), -1)
@@ -0,0 +1,1581 @@
+"""Importable part of the MoveNet pose classification notebook.
+
+Preprocessing workers are spawned processes, which can't load functions
+defined in the notebook's `__main__`, so everything they run lives here:
+metrics, MoveNet detection, image decoding, the landmark cache, overlays and
+the per-image preprocessing, together with the run manifest and writers of
+`MoveNetPreprocessor`. The NumPy pose embeddings, the landmark filter of the
+video classifier and the micro-batcher of the classification service live here
+too, so that they can be tested outside the notebook. The notebook imports this
+module from its checkout of the repository.
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import cv2
+import hashlib
+import json
+import numpy as np
+import os
+import queue
+import resource
+import struct
+import sys
+import threading
+import time
+
+import tensorflow as tf
+
+# Metrics
+
+class Metrics(object):
+  """Stage timers, counters and histograms of the pose pipeline.
+
+  Metrics are off until `enable()` is called. While they are off, every
+  recording call returns right away, so the instrumentation can stay in hot
+  loops. Worker processes hand their metrics over to the parent process with
+  `drain()` and `merge()`. `write()` exports them as Prometheus text and as a
+  JSON summary, together with the peak RSS.
+  """
+
+  # Histogram bucket upper bounds of stage durations in seconds, and of
+  # keypoint scores
+  SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                     1.0, 2.5, 5.0, 10.0)
+  SCORE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+  def __init__(self, prefix='pose'):
+    self.enabled = False
+    self._prefix = prefix
+    self._lock = threading.Lock()
+    self._counters = collections.Counter()
+    self._histograms = {}
+
+  def enable(self, enabled=True):
+    self.enabled = enabled
+
+  def count(self, name, value=1, **labels):
+    """Adds `value` to a counter."""
+    if not self.enabled:
+      return
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      self._counters[key] += value
+
+  def observe(self, name, values, buckets, **labels):
+    """Adds a value, or an array of values, to a histogram."""
+    if not self.enabled:
+      return
+    values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+    bucket_counts = np.bincount(np.searchsorted(buckets, values),
+                                minlength=len(buckets) + 1)
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = self._histograms[key] = [
+            tuple(buckets), np.zeros(len(buckets) + 1, np.int64), 0.0]
+      histogram[1] += bucket_counts
+      histogram[2] += float(values.sum())
+
+  def timer(self, stage, items=1):
+    """Returns a context manager that times one run of a stage."""
+    if not self.enabled:
+      return _NULL_TIMER
+    return _StageMetricsTimer(self, stage, items)
+
+  def drain(self):
+    """Returns the metrics recorded so far and resets them."""
+    if not self.enabled:
+      return None
+    with self._lock:
+      state = (self._counters, self._histograms)
+      self._counters = collections.Counter()
+      self._histograms = {}
+    return state
+
+  def merge(self, state):
+    """Adds metrics returned by `drain()`, e.g. in a worker process."""
+    if state is None:
+      return
+    counters, histograms = state
+    with self._lock:
+      self._counters.update(counters)
+      for key, (buckets, bucket_counts, total) in histograms.items():
+        histogram = self._histograms.get(key)
+        if histogram is None:
+          self._histograms[key] = [buckets, bucket_counts.copy(), total]
+        else:
+          histogram[1] += bucket_counts
+          histogram[2] += total
+
+  @staticmethod
+  def peak_rss_bytes():
+    """Peak RSS of this process and of its largest finished child process."""
+    # ru_maxrss is in kilobytes on Linux
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'children': (resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+                         * 1024)}
+
+  @staticmethod
+  def _format_labels(labels):
+    if not labels:
+      return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"'))
+        for name, value in labels) + '}'
+
+  def to_prometheus(self):
+    """Returns the metrics in the Prometheus text exposition format."""
+    with self._lock:
+      counters = sorted(self._counters.items())
+      histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+    lines = []
+    declared = set()
+    for (name, labels), value in counters:
+      metric = '{}_{}_total'.format(self._prefix, name)
+      if metric not in declared:
+        declared.add(metric)
+        lines.append('# TYPE {} counter'.format(metric))
+      lines.append('{}{} {}'.format(metric, self._format_labels(labels), value))
+    for (name, labels), (buckets, bucket_counts, total) in histograms:
+      metric = '{}_{}'.format(self._prefix, name)
+      if metric not in declared:
+        declared.add(metric)
+        lines.append('# TYPE {} histogram'.format(metric))
+      cumulative_counts = np.cumsum(bucket_counts)
+      for bound, cumulative_count in zip(
+          [repr(bound) for bound in buckets] + ['+Inf'], cumulative_counts):
+        lines.append('{}_bucket{} {}'.format(
+            metric, self._format_labels(labels + (('le', bound),)),
+            cumulative_count))
+      lines.append('{}_sum{} {!r}'.format(metric, self._format_labels(labels),
+                                          total))
+      lines.append('{}_count{} {}'.format(metric, self._format_labels(labels),
+                                          cumulative_counts[-1]))
+    metric = '{}_peak_rss_bytes'.format(self._prefix)
+    lines.append('# TYPE {} gauge'.format(metric))
+    for process, rss in self.peak_rss_bytes().items():
+      lines.append('{}{{process="{}"}} {}'.format(metric, process, rss))
+    return '\n'.join(lines) + '\n'
+
+  def to_json(self):
+    """Returns a JSON-serializable summary of the metrics."""
+    with self._lock:
+      counters = sorted(self._counters.items())
+      histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+    summary = {'counters': [], 'histograms': [],
+               'peak_rss_bytes': self.peak_rss_bytes()}
+    for (name, labels), value in counters:
+      summary['counters'].append(
+          {'name': name, 'labels': dict(labels), 'value': value})
+    for (name, labels), (buckets, bucket_counts, total) in histograms:
+      count = int(bucket_counts.sum())
+      summary['histograms'].append(
+          {'name': name, 'labels': dict(labels), 'count': count,
+           'sum': total, 'mean': total / count if count else 0.0,
+           'buckets': list(buckets), 'bucket_counts': bucket_counts.tolist()})
+    return summary
+
+  def write(self, prometheus_path=None, json_path=None):
+    """Writes the metrics to a Prometheus text file and/or a JSON file."""
+    if prometheus_path is not None:
+      with open(prometheus_path, 'w') as prometheus_file:
+        prometheus_file.write(self.to_prometheus())
+    if json_path is not None:
+      with open(json_path, 'w') as json_file:
+        json.dump(self.to_json(), json_file, indent=2)
+
+class _StageMetricsTimer(object):
+  """Records the duration and item count of one stage run in `Metrics`."""
+
+  def __init__(self, metrics, stage, items):
+    self._metrics = metrics
+    self._stage = stage
+    self._items = items
+
+  def __enter__(self):
+    self._start_time = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    self._metrics.observe('stage_seconds',
+                          time.perf_counter() - self._start_time,
+                          Metrics.SECONDS_BUCKETS, stage=self._stage)
+    self._metrics.count('stage_items', self._items, stage=self._stage)
+
+_NULL_TIMER = contextlib.nullcontext()
+
+# Metrics of this process
+metrics = Metrics()
+
+# MoveNet
+
+# Input resolution of the single-pose MoveNet variants
+MOVENET_INPUT_SIZES = {'movenet_lightning': 192, 'movenet_thunder': 256}
+
+# Checkout of the TensorFlow examples with the `Movenet` wrapper, which the
+# notebook clones into its working directory
+pose_sample_rpi_path = os.path.join(
+    os.getcwd(), 'examples/lite/examples/pose_estimation/raspberry_pi')
+
+def load_movenet(model_name):
+  """Loads a MoveNet variant with the `Movenet` wrapper of the examples.
+
+  The wrapper is only imported here, so the rest of the module works without
+  the examples checkout.
+  """
+  if pose_sample_rpi_path not in sys.path:
+    sys.path.append(pose_sample_rpi_path)
+  from ml import Movenet
+  return Movenet(model_name)
+
+# Single-pose MoveNet of this process that `detect()` runs, set by
+# `use_movenet`
+movenet = None
+movenet_model_name = None
+
+def use_movenet(model_name):
+  """Makes `detect()` run the given MoveNet variant, loading it if needed."""
+  global movenet, movenet_model_name
+  if model_name != movenet_model_name:
+    movenet = load_movenet(model_name)
+    movenet_model_name = model_name
+
+# Define function to run pose estimation using MoveNet Thunder.
+
+def detect(input_tensor, inference_count=3):
+  image = input_tensor.numpy()
+
+  # Detect pose using the full input image
+  with metrics.timer('movenet_pass'):
+    person = movenet.detect(image, reset_crop_region=True)
+
+  # Repeatedly using previous detection result to identify the region of
+
+  for _ in range(inference_count - 1):
+    with metrics.timer('movenet_pass'):
+      person = movenet.detect(image,
+                              reset_crop_region=False)
+
+  return person
+
+def detect_until_converged(input_tensor, max_inference_count=3,
+                           tolerance=0.01, detection_threshold=None,
+                           detector=None):
+  """Runs the crop refinement of `detect` until the keypoints stop moving.
+
+  Refinement stops once no keypoint moves further than `tolerance`, given as a
+  fraction of the longer image side, between two passes. If
+  `detection_threshold` is set and a keypoint of the full-frame pass scores
+  below it, no refinement is done since the image will be discarded.
+  `detector` is the `Movenet` model to run, this process's `movenet` if None.
+
+  Returns a (person, passes) tuple with the number of MoveNet passes used.
+  """
+  if detector is None:
+    detector = movenet
+  image = input_tensor.numpy()
+  image_height, image_width, _ = image.shape
+  max_shift = tolerance * max(image_height, image_width)
+
+  # Detect pose using the full input image
+  with metrics.timer('movenet_pass'):
+    person = detector.detect(image, reset_crop_region=True)
+  passes = 1
+  if detection_threshold is not None and min(
+      [keypoint.score for keypoint in person.keypoints]) < detection_threshold:
+    return person, passes
+
+  coordinates = np.array(
+      [[keypoint.coordinate.x, keypoint.coordinate.y]
+       for keypoint in person.keypoints], dtype=np.float32)
+  while passes < max_inference_count:
+    with metrics.timer('movenet_pass'):
+      person = detector.detect(image, reset_crop_region=False)
+    passes += 1
+
+    refined_coordinates = np.array(
+        [[keypoint.coordinate.x, keypoint.coordinate.y]
+         for keypoint in person.keypoints], dtype=np.float32)
+    shift = np.max(np.linalg.norm(refined_coordinates - coordinates, axis=1))
+    coordinates = refined_coordinates
+    if shift <= max_shift:
+      break
+
+  return person, passes
+
+class BatchedMovenet(object):
+  """MoveNet detection engine that runs crops of many images per invocation.
+
+  In every refinement pass the crops of all images still being refined are
+  stacked and run through the interpreter `batch_size` at a time, then the
+  keypoints are scattered back to their images. Crop regions are computed with
+  the helpers of the `Movenet` wrapper, so the results match `detect()`. If the
+  model can't be resized to a batch input, crops are run one at a time.
+  """
+
+  def __init__(self, model_name='movenet_thunder', batch_size=8):
+    # The wrapper is only used for its crop region helpers
+    self._movenet = load_movenet(model_name)
+    self.model_name = model_name
+
+    _, ext = os.path.splitext(model_name)
+    self._model_path = model_name if ext else model_name + '.tflite'
+    self._interpreter = tf.lite.Interpreter(model_path=self._model_path)
+    input_details = self._interpreter.get_input_details()[0]
+    self._input_index = input_details['index']
+    self._input_dtype = input_details['dtype']
+    self._input_height = int(input_details['shape'][1])
+    self._input_width = int(input_details['shape'][2])
+    self._output_index = self._interpreter.get_output_details()[0]['index']
+
+    self.max_batch_size = batch_size
+    self.batch_size = batch_size
+    try:
+      self._interpreter.resize_tensor_input(
+          self._input_index,
+          [batch_size, self._input_height, self._input_width, 3])
+      self._interpreter.allocate_tensors()
+      self._invoke(np.zeros(
+          (batch_size, self._input_height, self._input_width, 3),
+          dtype=self._input_dtype))
+    except (RuntimeError, ValueError):
+      # The graph is fixed at batch 1, so run one crop per invocation
+      self.batch_size = 1
+      self._interpreter = tf.lite.Interpreter(model_path=self._model_path)
+      self._interpreter.allocate_tensors()
+
+  def _invoke(self, batch):
+    """Runs one interpreter invocation on a full batch of crops."""
+    self._interpreter.set_tensor(self._input_index, batch)
+    self._interpreter.invoke()
+    keypoints_with_scores = self._interpreter.get_tensor(self._output_index)
+    if keypoints_with_scores.shape[0] != len(batch):
+      raise ValueError('Model output is not batched.')
+    return keypoints_with_scores.reshape(len(batch), -1, 3)
+
+  def _run_detector(self, crops):
+    """Runs MoveNet on a stack of crops of any length."""
+    outputs = []
+    for start in range(0, len(crops), self.batch_size):
+      batch = crops[start:start + self.batch_size]
+      count = len(batch)
+      if count < self.batch_size:
+        # Pad the last batch rather than resizing the interpreter again
+        padding = np.zeros((self.batch_size - count,) + batch.shape[1:],
+                           dtype=batch.dtype)
+        batch = np.concatenate([batch, padding])
+      outputs.append(self._invoke(batch)[:count])
+    return np.concatenate(outputs)
+
+  def detect(self, images, inference_count=3, tolerance=None,
+             detection_threshold=None):
+    """Detects the pose in each of the given RGB images.
+
+    Refinement works like `detect()`, or like `detect_until_converged()` when
+    `tolerance` is set, in which case images leave the batch as soon as they
+    converge or fall below `detection_threshold` on the full-frame pass.
+
+    Returns a list of (person, passes) tuples in the order of `images`.
+    """
+    # Importable once `load_movenet` added the examples to the path
+    from data import person_from_keypoints_with_scores
+
+    crop_size = (self._input_height, self._input_width)
+    crop_regions = [self._movenet.init_crop_region(image.shape[0],
+                                                   image.shape[1])
+                    for image in images]
+    keypoints = [None] * len(images)
+    passes = [0] * len(images)
+
+    active = list(range(len(images)))
+    for pass_index in range(inference_count):
+      if not active:
+        break
+      crops = np.stack([
+          self._movenet._crop_and_resize(images[i], crop_regions[i], crop_size)
+          for i in active]).astype(self._input_dtype)
+      with metrics.timer('movenet_batch_pass', len(crops)):
+        batch_keypoints = self._run_detector(crops)
+
+      still_active = []
+      for i, keypoints_with_scores in zip(active, batch_keypoints):
+        image_height, image_width, _ = images[i].shape
+        crop_region = crop_regions[i]
+
+        # Map the keypoints from the crop back to the whole image
+        keypoints_with_scores[:, 0] = (
+            crop_region['y_min'] +
+            crop_region['height'] * keypoints_with_scores[:, 0])
+        keypoints_with_scores[:, 1] = (
+            crop_region['x_min'] +
+            crop_region['width'] * keypoints_with_scores[:, 1])
+
+        previous_keypoints = keypoints[i]
+        keypoints[i] = keypoints_with_scores
+        passes[i] += 1
+        crop_regions[i] = self._movenet._determine_crop_region(
+            keypoints_with_scores, image_height, image_width)
+
+        if tolerance is not None:
+          if (pass_index == 0 and detection_threshold is not None and
+              np.min(keypoints_with_scores[:, 2]) < detection_threshold):
+            continue
+          if previous_keypoints is not None:
+            shift = np.max(np.hypot(
+                (keypoints_with_scores[:, 0] - previous_keypoints[:, 0])
+                * image_height,
+                (keypoints_with_scores[:, 1] - previous_keypoints[:, 1])
+                * image_width))
+            if shift <= tolerance * max(image_height, image_width):
+              continue
+        still_active.append(i)
+      active = still_active
+
+    return [(person_from_keypoints_with_scores(
+                 keypoints[i], images[i].shape[0], images[i].shape[1]),
+             passes[i])
+            for i in range(len(images))]
+
+# Batched engine of this process, created on first use
+batched_movenet = None
+
+def get_batched_movenet(batch_size, model_name='movenet_thunder'):
+  """Returns this process's `BatchedMovenet`, loading it if needed."""
+  global batched_movenet
+  if (batched_movenet is None or batched_movenet.max_batch_size != batch_size
+      or batched_movenet.model_name != model_name):
+    batched_movenet = BatchedMovenet(model_name, batch_size)
+  return batched_movenet
+
+# MediaPipe Pose landmark index of each MoveNet `BodyPart`
+MEDIAPIPE_TO_MOVENET = (0, 2, 5, 7, 8, 11, 12, 13, 14, 15, 16, 23, 24, 25, 26,
+                        27, 28)
+
+# Tiers of `MovenetCascade`, from the cheapest to the most expensive, and
+# 'none' for images on which no tier produced an accepted pose
+CASCADE_TIERS = ('lightning', 'thunder', 'mediapipe', 'none')
+
+class MovenetCascade(object):
+  """Pose detector that only runs the expensive models on hard images.
+
+  Every image gets a single MoveNet Lightning pass. If all of its keypoints
+  score at least `high_confidence`, that result is accepted. Otherwise the
+  image is escalated to MoveNet Thunder with crop refinement, and if that
+  still isn't confident, to MediaPipe Pose, whose landmarks are mapped onto
+  the MoveNet body parts with the landmark visibility as score. The Thunder
+  and MediaPipe results are compared on their lowest keypoint score and the
+  better one is kept, and the Thunder result is kept if MediaPipe finds no
+  pose. Thunder and MediaPipe are only loaded once an image needs them.
+  """
+
+  def __init__(self, high_confidence=0.5, inference_count=3,
+               convergence_tolerance=None):
+    self.high_confidence = high_confidence
+    self.inference_count = inference_count
+    self.convergence_tolerance = convergence_tolerance
+    self._lightning = load_movenet('movenet_lightning')
+    self._thunder = None
+    self._mediapipe_pose = None
+
+  def _mediapipe_landmarks(self, image):
+    """Returns MediaPipe Pose landmarks as a (17, 3) array, or None."""
+    if self._mediapipe_pose is None:
+      from mediapipe.python.solutions import pose as mp_pose
+      self._mediapipe_pose = mp_pose.Pose(static_image_mode=True)
+    with metrics.timer('mediapipe'):
+      results = self._mediapipe_pose.process(image)
+    if not results.pose_landmarks:
+      return None
+    image_height, image_width, _ = image.shape
+    landmarks = results.pose_landmarks.landmark
+    return np.array([[landmarks[i].x * image_width,
+                      landmarks[i].y * image_height,
+                      landmarks[i].visibility]
+                     for i in MEDIAPIPE_TO_MOVENET], dtype=np.float32)
+
+  def detect(self, input_tensor):
+    """Detects the pose in an RGB image tensor.
+
+    Returns a (landmarks, tier, passes) tuple, with the (17, 3) array of pixel
+    [x, y, score] rows, the name of the tier that produced them and the number
+    of MoveNet passes run. If MediaPipe finds no pose either, the
+    unconfident Thunder landmarks are returned with the tier 'none'.
+    """
+    image = input_tensor.numpy()
+    with metrics.timer('movenet_pass'):
+      person = self._lightning.detect(image, reset_crop_region=True)
+    landmarks = _person_landmarks(person)
+    if np.min(landmarks[:, 2]) >= self.high_confidence:
+      return landmarks, 'lightning', 1
+
+    if self._thunder is None:
+      self._thunder = load_movenet('movenet_thunder')
+    # Without a tolerance, refine until the keypoints stop moving at all
+    person, passes = detect_until_converged(
+        input_tensor, self.inference_count, self.convergence_tolerance or 0.0,
+        detector=self._thunder)
+    landmarks = _person_landmarks(person)
+    if np.min(landmarks[:, 2]) >= self.high_confidence:
+      return landmarks, 'thunder', passes + 1
+
+    mediapipe_landmarks = self._mediapipe_landmarks(image)
+    if mediapipe_landmarks is None:
+      return landmarks, 'none', passes + 1
+    # Keep whichever pose has the more confident weakest keypoint, so that an
+    # image Thunder alone would keep isn't lost to a worse MediaPipe pose
+    if np.min(mediapipe_landmarks[:, 2]) > np.min(landmarks[:, 2]):
+      return mediapipe_landmarks, 'mediapipe', passes + 1
+    return landmarks, 'thunder', passes + 1
+
+def _person_landmarks(person):
+  """Returns the keypoints of a `Person` as a (17, 3) array of [x, y, score]."""
+  return np.array(
+      [[keypoint.coordinate.x, keypoint.coordinate.y, keypoint.score]
+       for keypoint in person.keypoints],
+      dtype=np.float32)
+
+# Cascade of this process, created on first use
+movenet_cascade = None
+
+def get_movenet_cascade(high_confidence, inference_count=3,
+                        convergence_tolerance=None):
+  """Returns this process's `MovenetCascade`, loading it if needed."""
+  global movenet_cascade
+  if movenet_cascade is None:
+    movenet_cascade = MovenetCascade(high_confidence, inference_count,
+                                     convergence_tolerance)
+  else:
+    # The models stay loaded, only the thresholds change
+    movenet_cascade.high_confidence = high_confidence
+    movenet_cascade.inference_count = inference_count
+    movenet_cascade.convergence_tolerance = convergence_tolerance
+  return movenet_cascade
+
+# Pre-processing
+
+class SkeletonRenderer(object):
+  """Draws pose skeletons with OpenCV into a reusable image buffer.
+
+  Rendering works on landmark arrays of pixel [x, y, score] rows rather than
+  `Person` objects, so overlays can also be drawn from cached or stored
+  landmarks. Edges are grouped by color and drawn with one `cv2.polylines`
+  call per color.
+  """
+
+  def __init__(self, edge_colors, keypoint_color=(0, 255, 0),
+               keypoint_threshold=0.05):
+    self._keypoint_color = keypoint_color
+    self._keypoint_threshold = keypoint_threshold
+
+    # Edge endpoints grouped by color, as (color, start indices, end indices)
+    edges_by_color = collections.defaultdict(list)
+    for edge, color in edge_colors.items():
+      edges_by_color[color].append(edge)
+    self._edge_groups = [(color,) + tuple(np.array(edges, dtype=np.int32).T)
+                         for color, edges in edges_by_color.items()]
+
+    self._buffer = np.empty(0, dtype=np.uint8)
+
+  def render(self, image, landmarks, color_conversion=None):
+    """Returns `image` with the skeleton of `landmarks` drawn on top.
+
+    `landmarks` is one skeleton or a stack of skeletons, e.g. all figures found
+    in a panel. The image is copied into the renderer's buffer, converted with
+    `color_conversion` (a `cv2.COLOR_*` code) on the way if given. The result
+    is a view of that buffer and is only valid until the next call.
+    """
+    if self._buffer.size < image.size:
+      self._buffer = np.empty(image.size, dtype=np.uint8)
+    output = self._buffer[:image.size].reshape(image.shape)
+    if color_conversion is None:
+      np.copyto(output, image)
+    else:
+      cv2.cvtColor(image, color_conversion, dst=output)
+
+    # Scale the strokes with the image so they stay visible on large photos
+    thickness = max(2, round(max(image.shape[:2]) / 500))
+    for skeleton in np.reshape(landmarks, (-1,) + np.shape(landmarks)[-2:]):
+      points = np.round(skeleton[:, :2]).astype(np.int32)
+      visible = skeleton[:, 2] >= self._keypoint_threshold
+
+      # Draw all the edges
+      for color, starts, ends in self._edge_groups:
+        drawn = visible[starts] & visible[ends]
+        if np.any(drawn):
+          lines = np.stack([points[starts[drawn]], points[ends[drawn]]],
+                           axis=1)
+          cv2.polylines(output, list(lines), False, color, thickness)
+
+      # Draw all the landmarks
+      for x, y in points[visible].tolist():
+        cv2.circle(output, (x, y), thickness, self._keypoint_color, -1)
+
+    return output
+
+# MoveNet skeleton edges, with the colors used by `utils.visualize` given in
+# BGR order since overlays are written with OpenCV.
+MOVENET_EDGE_COLORS = {
+    (0, 1): (255, 20, 147),
+    (0, 2): (0, 255, 255),
+    (1, 3): (255, 20, 147),
+    (2, 4): (0, 255, 255),
+    (0, 5): (255, 20, 147),
+    (0, 6): (0, 255, 255),
+    (5, 7): (255, 20, 147),
+    (7, 9): (255, 20, 147),
+    (6, 8): (0, 255, 255),
+    (8, 10): (0, 255, 255),
+    (5, 6): (255, 255, 0),
+    (5, 11): (255, 20, 147),
+    (6, 12): (0, 255, 255),
+    (11, 12): (255, 255, 0),
+    (11, 13): (255, 20, 147),
+    (13, 15): (255, 20, 147),
+    (12, 14): (0, 255, 255),
+    (14, 16): (0, 255, 255),
+}
+
+# Overlay renderer of this process
+skeleton_renderer = SkeletonRenderer(MOVENET_EDGE_COLORS)
+
+# Image file extensions picked up from the dataset folders, in lower case so
+# that mixed-case names such as "sit (175).JPG" are matched as well.
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+# JPEG start-of-frame markers, which carry the image size and component count
+_JPEG_SOF_MARKERS = frozenset(
+    [0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+     0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+
+# Channels after decoding for each PNG color type. Palette images (type 3)
+# decode to RGB.
+_PNG_COLOR_TYPE_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+ImageHeader = collections.namedtuple(
+    'ImageHeader', ['format', 'width', 'height', 'channels'])
+
+def read_image_header(contents):
+  """Parses the size and channel count of a JPEG or PNG file.
+
+  Only the header bytes are looked at, no pixels are decoded. Returns an
+  `ImageHeader`, or None if `contents` isn't a well-formed JPEG or PNG file.
+  """
+  if contents[:8] == b'\x89PNG\r\n\x1a\n':
+    if len(contents) < 26 or contents[12:16] != b'IHDR':
+      return None
+    width, height = struct.unpack('>II', contents[16:24])
+    channels = _PNG_COLOR_TYPE_CHANNELS.get(contents[25])
+    if channels is None:
+      return None
+    return ImageHeader('png', width, height, channels)
+
+  if contents[:2] != b'\xff\xd8':
+    return None
+
+  # Walk the JPEG marker segments up to the frame header
+  offset = 2
+  while offset + 4 <= len(contents):
+    if contents[offset] != 0xFF:
+      return None
+    marker = contents[offset + 1]
+    if marker == 0xFF:
+      # Fill byte before a marker
+      offset += 1
+      continue
+    if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+      # Markers without a length field
+      offset += 2
+      continue
+    if marker == 0xDA:
+      # Start of scan without a frame header
+      return None
+    if marker in _JPEG_SOF_MARKERS:
+      if offset + 10 > len(contents):
+        return None
+      height, width = struct.unpack('>HH', contents[offset + 5:offset + 9])
+      return ImageHeader('jpeg', width, height, contents[offset + 9])
+    segment_length, = struct.unpack('>H', contents[offset + 2:offset + 4])
+    offset += 2 + segment_length
+  return None
+
+# Scale denominators of the DCT-scaled JPEG decoding of `tf.io.decode_jpeg`
+_JPEG_DCT_RATIOS = (8, 4, 2)
+
+# Why `decode_image` rejected an image, by the reason counted in the metrics
+_SKIP_REASONS = {
+    'invalid': 'Invalid image.',
+    'non_rgb': 'Image isn\'t in RGB format.',
+}
+
+def skipped_message(image_path, reason):
+  """Returns the message of an image rejected for one of `_SKIP_REASONS`."""
+  return 'Skipped ' + image_path + '. ' + _SKIP_REASONS[reason]
+
+def decode_image(contents, max_long_side=None):
+  """Decodes JPEG/PNG file contents for MoveNet.
+
+  The header is checked before decoding, so files that aren't valid JPEG/PNG
+  images or aren't RGB are rejected without decoding any pixels. JPEG and PNG
+  files are told apart by their content rather than by their extension.
+
+  If `max_long_side` is set, larger images are scaled down so that their
+  longer side is that long. JPEG files are decoded at 1/2, 1/4 or 1/8 scale
+  straight from their DCT coefficients, which skips most of the decoding work
+  and memory, and what remains is resized with `cv2.INTER_AREA`. Use
+  `_landmark_scale` to map landmarks back to the original pixels.
+
+  Returns an (image, reason) tuple: the decoded uint8 RGB image tensor and
+  None, or None and the `_SKIP_REASONS` key saying why it was rejected. Callers
+  count the skipped images themselves.
+  """
+  header = read_image_header(contents)
+  if header is None or not header.width or not header.height:
+    return None, 'invalid'
+
+  # Skip images that isn't RGB because Movenet requires RGB images
+  if header.channels != 3:
+    return None, 'non_rgb'
+
+  ratio = 1
+  if max_long_side is not None and header.format == 'jpeg':
+    long_side = max(header.width, header.height)
+    ratio = next((r for r in _JPEG_DCT_RATIOS
+                  if long_side / r >= max_long_side), 1)
+
+  try:
+    if header.format == 'png':
+      image = tf.io.decode_png(contents, channels=3)
+    else:
+      image = tf.io.decode_jpeg(contents, channels=3, ratio=ratio)
+  except:
+    return None, 'invalid'
+
+  if max_long_side is not None:
+    height, width = int(image.shape[0]), int(image.shape[1])
+    if max(height, width) > max_long_side:
+      scale = max_long_side / max(height, width)
+      image = tf.convert_to_tensor(cv2.resize(
+          image.numpy(),
+          (max(1, round(width * scale)), max(1, round(height * scale))),
+          interpolation=cv2.INTER_AREA))
+  return image, None
+
+def _landmark_scale(contents, image):
+  """Returns the [x, y, score] factors from `image` to its original pixels.
+
+  `image` is the possibly scaled-down decoding of the file `contents`.
+  Multiplying landmarks detected on it by the factors maps them back onto the
+  full-size image, and the score by 1.
+  """
+  header = read_image_header(contents)
+  return np.array([header.width / int(image.shape[1]),
+                   header.height / int(image.shape[0]), 1], dtype=np.float32)
+
+def ingest_image(image_path, max_long_side=None):
+  """Reads and decodes an image file for MoveNet.
+
+  The file is read exactly once and decoded with `decode_image`, scaled down
+  to `max_long_side` if that is set.
+
+  Returns a (contents, image, reason) tuple: the raw file bytes, the decoded
+  uint8 RGB image tensor and None, or None for the image and the
+  `_SKIP_REASONS` key saying why it was rejected.
+  """
+  try:
+    contents = tf.io.read_file(image_path).numpy()
+  except:
+    return None, None, 'invalid'
+
+  image, reason = decode_image(contents, max_long_side)
+  return contents, image, reason
+
+class LandmarkCache(object):
+  """On-disk landmark cache keyed by image content and detection settings.
+
+  Each entry is a .npy file named after the SHA-256 of the image bytes, the
+  backend, the model variant and the detection parameters, so a hit can be
+  used in place of running pose detection. Reading an entry refreshes its
+  mtime, and `trim()` evicts the least recently used entries once the cache
+  grows past `max_bytes`.
+
+  The same cache directory can be shared by the MoveNet and MediaPipe
+  preprocessors since the backend is part of the key.
+  """
+
+  def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+    self._cache_dir = cache_dir
+    self._max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    os.makedirs(cache_dir, exist_ok=True)
+
+  def key(self, image_bytes, backend, model, **params):
+    """Returns the cache key of an image under the given detection settings."""
+    digest = hashlib.sha256(image_bytes)
+    settings = [backend, model] + ['{}={!r}'.format(name, value)
+                                   for name, value in sorted(params.items())]
+    digest.update('\0'.join(settings).encode('utf-8'))
+    return digest.hexdigest()
+
+  def _entry_path(self, key):
+    return os.path.join(self._cache_dir, key[:2], key + '.npy')
+
+  def get(self, key):
+    """Returns the cached landmarks for `key`, or None on a miss."""
+    entry_path = self._entry_path(key)
+    try:
+      landmarks = np.load(entry_path)
+      os.utime(entry_path)
+    except (OSError, ValueError):
+      return None
+    return landmarks
+
+  def put(self, key, landmarks):
+    """Stores the landmarks detected for `key`."""
+    entry_path = self._entry_path(key)
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+    # Write to a temp file first so that readers never see a partial entry
+    tmp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      np.save(f, landmarks)
+    os.replace(tmp_path, entry_path)
+
+  def record(self, hit):
+    """Counts a lookup made by this process or by a worker process."""
+    if hit:
+      self.hits += 1
+    else:
+      self.misses += 1
+
+  def _entries(self):
+    """Returns (mtime, size, path) for every entry in the cache."""
+    entries = []
+    for dirpath, _, filenames in os.walk(self._cache_dir):
+      for filename in filenames:
+        if not filename.endswith('.npy'):
+          continue
+        entry_path = os.path.join(dirpath, filename)
+        try:
+          stat = os.stat(entry_path)
+        except FileNotFoundError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, entry_path))
+    return entries
+
+  def trim(self):
+    """Evicts least recently used entries until the cache fits `max_bytes`."""
+    entries = sorted(self._entries())
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, entry_path in entries:
+      if total_bytes <= self._max_bytes:
+        break
+      try:
+        os.remove(entry_path)
+      except FileNotFoundError:
+        pass
+      total_bytes -= size
+      self.evictions += 1
+
+  def stats(self):
+    """Returns lookup counters and the current size of the cache."""
+    entries = self._entries()
+    lookups = self.hits + self.misses
+    return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / lookups if lookups else 0.0,
+        'evictions': self.evictions,
+        'entries': len(entries),
+        'size_bytes': sum(size for _, size, _ in entries),
+        'max_bytes': self._max_bytes,
+    }
+
+  def report(self):
+    """Formats `stats()` as a one-line summary."""
+    stats = self.stats()
+    return ('Landmark cache: {hits} hits, {misses} misses ({hit_rate:.1%}), '
+            '{evictions} evicted, {entries} entries, '
+            '{size_bytes} of {max_bytes} bytes'.format(**stats))
+
+def write_image(image_path, image):
+  """Writes an image file, raising an error if OpenCV fails to write it."""
+  if not cv2.imwrite(image_path, image):
+    raise IOError('Could not write ' + image_path)
+
+class AsyncWriter(object):
+  """Runs output writes on background threads behind a bounded queue.
+
+  `submit()` blocks once `max_pending` writes are waiting, so a slow disk
+  throttles the producer instead of filling up memory. A writer with a single
+  thread performs writes in submission order. The first error raised by a
+  write is re-raised by the next `submit()` or `flush()`, and later writes are
+  dropped.
+  """
+
+  def __init__(self, num_threads=1, max_pending=64):
+    self._queue = queue.Queue(max_pending)
+    self._error = None
+    self._threads = [threading.Thread(target=self._run, daemon=True)
+                     for _ in range(num_threads)]
+    for thread in self._threads:
+      thread.start()
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      try:
+        if item is None:
+          return
+        if self._error is None:
+          write, args = item
+          write(*args)
+      except Exception as e:
+        if self._error is None:
+          self._error = e
+      finally:
+        self._queue.task_done()
+
+  def _raise_error(self):
+    if self._error is not None:
+      raise RuntimeError('Background write failed.') from self._error
+
+  def submit(self, write, *args):
+    """Queues `write(*args)`, waiting while the queue is full."""
+    self._raise_error()
+    self._queue.put((write, args))
+
+  def flush(self):
+    """Waits until every queued write is done."""
+    self._queue.join()
+    self._raise_error()
+
+  def close(self):
+    """Stops the writer threads once the queued writes are done."""
+    for _ in self._threads:
+      self._queue.put(None)
+    for thread in self._threads:
+      thread.join()
+
+class LandmarkRowWriter(object):
+  """Appends landmark rows of one pose class to a pair of binary files.
+
+  Image names go to `<prefix>.names`, one per line, and landmarks to
+  `<prefix>.f32` as raw float32 rows, so they can be read back with
+  `read_landmark_rows` without any text parsing.
+  """
+
+  def __init__(self, path_prefix):
+    self._names_file = open(path_prefix + '.names', 'w')
+    self._landmarks_file = open(path_prefix + '.f32', 'wb')
+
+  def writerow(self, image_name, landmarks):
+    self._names_file.write(image_name + '\n')
+    self._landmarks_file.write(landmarks.astype(np.float32).tobytes())
+
+  def close(self):
+    self._names_file.close()
+    self._landmarks_file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+def read_landmark_rows(path_prefix, row_size):
+  """Reads back the (image names, landmarks) written by `LandmarkRowWriter`."""
+  with open(path_prefix + '.names') as names_file:
+    image_names = names_file.read().splitlines()
+  landmarks = np.fromfile(path_prefix + '.f32', dtype=np.float32)
+  return image_names, landmarks.reshape(-1, row_size)
+
+class RunManifest(object):
+  """Persistent record of the images of one pose class that were processed.
+
+  Every processed image gets a JSON line in `<prefix>.manifest` with its
+  mtime, size and SHA-256, and its outcome: 'kept' with its landmarks, or
+  'skipped' with the reason. Lines are appended and flushed as soon as an
+  image is done, so a run that is killed partway through keeps its work. An
+  image whose file didn't change since it was recorded can be reused instead
+  of being processed again. If only its mtime changed, its hash decides.
+
+  The first line holds the detection settings. Records made with other
+  settings are discarded.
+
+  `finish()` writes the kept landmarks in image-name order to
+  `<prefix>.names` and `<prefix>.f32` for `read_landmark_rows`, and compacts
+  the manifest.
+  """
+
+  def __init__(self, path_prefix, settings):
+    self._path_prefix = path_prefix
+    self._manifest_path = path_prefix + '.manifest'
+    self._settings = settings
+    self._records = {}
+
+    try:
+      with open(self._manifest_path) as manifest_file:
+        lines = manifest_file.read().splitlines()
+    except FileNotFoundError:
+      lines = []
+
+    if lines and self._parse(lines[0]) == {'settings': settings}:
+      for line in lines[1:]:
+        record = self._parse(line)
+        # A partly written last line is left by a run that was killed
+        if record is not None:
+          self._records[record['name']] = record
+
+    # Start over from the records read so far, without stale or partial lines
+    self._rewrite(self._records)
+    self._manifest_file = open(self._manifest_path, 'a')
+
+  @staticmethod
+  def _parse(line):
+    try:
+      return json.loads(line)
+    except ValueError:
+      return None
+
+  def _rewrite(self, records):
+    tmp_path = '{}.{}.tmp'.format(self._manifest_path, os.getpid())
+    with open(tmp_path, 'w') as manifest_file:
+      manifest_file.write(json.dumps({'settings': self._settings}) + '\n')
+      for record in records.values():
+        manifest_file.write(json.dumps(record) + '\n')
+    os.replace(tmp_path, self._manifest_path)
+
+  def _append(self, record):
+    self._records[record['name']] = record
+    self._manifest_file.write(json.dumps(record) + '\n')
+    self._manifest_file.flush()
+
+  def lookup(self, image_name, image_path, stat):
+    """Returns the record of an unchanged image, or None if it needs processing.
+
+    `stat` is the `os.stat` result of the image file.
+    """
+    record = self._records.get(image_name)
+    if record is None or record['size'] != stat.st_size:
+      return None
+    if record['mtime_ns'] != stat.st_mtime_ns:
+      with open(image_path, 'rb') as image_file:
+        digest = hashlib.sha256(image_file.read()).hexdigest()
+      if digest != record['sha256']:
+        return None
+      # Same contents, remember the new mtime to skip hashing next time
+      record = dict(record, mtime_ns=stat.st_mtime_ns)
+      self._append(record)
+    return record
+
+  def add(self, image_name, stat, digest, landmarks, message):
+    """Records the outcome of processing an image.
+
+    `landmarks` is None if the image was skipped, `message` then says why.
+    """
+    record = {'name': image_name, 'mtime_ns': stat.st_mtime_ns,
+              'size': stat.st_size, 'sha256': digest}
+    if landmarks is None:
+      record.update(outcome='skipped', reason=message)
+    else:
+      record.update(outcome='kept', landmarks=landmarks.tolist())
+    self._append(record)
+
+  def discard(self, image_name):
+    """Forgets the record of an image that can no longer be read."""
+    self._records.pop(image_name, None)
+
+  def finish(self, image_names, retained_names):
+    """Writes the landmark rows of `image_names` and compacts the manifest.
+
+    Records of images not in `retained_names`, e.g. deleted files, are
+    dropped.
+    """
+    with LandmarkRowWriter(self._path_prefix) as writer:
+      for image_name in image_names:
+        record = self._records.get(image_name)
+        if record is not None and record['outcome'] == 'kept':
+          writer.writerow(image_name, np.array(record['landmarks']))
+
+    self._manifest_file.close()
+    retained_names = set(retained_names)
+    self._records = {name: record for name, record in self._records.items()
+                     if name in retained_names}
+    self._rewrite(self._records)
+
+  def close(self):
+    self._manifest_file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+# Outcome of preprocessing one image. `landmarks` is the (17, 3) array of
+# pixel [x, y, score] rows to store, or None if the image was skipped, in which
+# case `message` explains why. `cache_hit` is None when no cache is used, and
+# `passes` is the number of MoveNet passes run, or None if none were run.
+# `digest` is the SHA-256 of the image file, or None if it couldn't be read.
+# `tier` is the `MovenetCascade` tier of the landmarks, or None outside the
+# cascade, and `detect_seconds` the time the cascade took on the image.
+PreprocessResult = collections.namedtuple(
+    'PreprocessResult',
+    ['landmarks', 'message', 'cache_hit', 'passes', 'digest', 'tier',
+     'detect_seconds'],
+    defaults=[None, None, None, None, None, None])
+
+def _init_movenet_worker(model_name, metrics_enabled=False):
+  """Loads a private MoveNet model for a preprocessing worker process.
+
+  Workers are spawned rather than forked, so they start without the parent's
+  TensorFlow runtime and only get the state passed in here. They import the
+  worker functions from this module, since a spawned process can't load
+  functions defined in the notebook. No model is loaded if `model_name` is
+  None, e.g. for the cascade, which loads its own.
+  """
+  if model_name is not None:
+    use_movenet(model_name)
+  # Start from empty metrics, recorded only if the parent records them
+  metrics.enable(metrics_enabled)
+  metrics.drain()
+
+
+def _finish_image(image_path, image_out_path, image, pose_landmarks,
+                  detection_threshold, cache_hit, passes,
+                  overlay_confidence=None, overlay_writer=None, scale=None):
+  """Applies the detection threshold to an image and writes its overlay.
+
+  No overlay is written if `image_out_path` is None, or if
+  `overlay_confidence` is set and every keypoint scores at least that much.
+  If an `AsyncWriter` is given, the overlay is written in the background.
+  `pose_landmarks` are in original image pixels. If `image` was scaled down,
+  `scale` holds the factors from `_landmark_scale` and the overlay is drawn
+  at the scaled size.
+  """
+  metrics.observe('keypoint_score', pose_landmarks[:, 2],
+                  Metrics.SCORE_BUCKETS)
+
+  # Save landmarks if all landmarks were detected
+  min_landmark_score = np.min(pose_landmarks[:, 2])
+  should_keep_image = min_landmark_score >= detection_threshold
+  if not should_keep_image:
+    metrics.count('images', outcome='skipped', reason='low_confidence')
+    return PreprocessResult(None, 'Skipped ' + image_path +
+                            '. No pose was confidentlly detected.',
+                            cache_hit, passes)
+
+  if image_out_path is not None and (overlay_confidence is None or
+                                     min_landmark_score < overlay_confidence):
+    with metrics.timer('overlay'):
+      # Draw the prediction result on top of the image for debugging later
+      overlay_landmarks = (pose_landmarks if scale is None
+                           else pose_landmarks / scale)
+      output_frame = skeleton_renderer.render(image.numpy(), overlay_landmarks,
+                                              cv2.COLOR_RGB2BGR)
+
+      # Write detection result into an image file. The frame lives in the
+      # renderer's buffer, so a background write needs its own copy.
+      if overlay_writer is None:
+        write_image(image_out_path, output_frame)
+      else:
+        overlay_writer.submit(write_image, image_out_path, output_frame.copy())
+
+  metrics.count('images', outcome='kept')
+  return PreprocessResult(pose_landmarks, None, cache_hit, passes)
+
+
+def _preprocess_images(tasks, detection_threshold, inference_count=3,
+                       cache=None, convergence_tolerance=None,
+                       batch_size=None, overlay_confidence=None,
+                       overlay_writer=None, model_name='movenet_thunder',
+                       cascade_threshold=None, max_long_side=None):
+  """Detects the poses in a chunk of images and writes their debug overlays.
+
+  `tasks` is a list of (image_path, image_out_path) pairs, and a
+  `PreprocessResult` is returned for each of them. See `_finish_image` for
+  when overlays are written.
+
+  If a `LandmarkCache` is given, landmarks stored for the same image and
+  settings are reused instead of running MoveNet. If `convergence_tolerance`
+  is set, up to `inference_count` passes are run with
+  `detect_until_converged`. If `batch_size` is set, the images of the chunk
+  that need detection are run together through `BatchedMovenet`.
+  `model_name` is the single-pose MoveNet variant to run. If
+  `cascade_threshold` is set, images go through `MovenetCascade` instead,
+  escalating those with a keypoint below that score. If `max_long_side` is
+  set, large images are detected on a scaled-down decoding, and their
+  landmarks are mapped back to the original pixels.
+  """
+  results = [None] * len(tasks)
+  digests = [None] * len(tasks)
+
+  # Images that still need pose detection, as (index, image, cache_key,
+  # scale)
+  pending = []
+  for index, (image_path, image_out_path) in enumerate(tasks):
+    with metrics.timer('ingest'):
+      contents, image, reason = ingest_image(image_path, max_long_side)
+    if contents is not None:
+      digests[index] = hashlib.sha256(contents).hexdigest()
+    if image is None:
+      metrics.count('images', outcome='skipped', reason=reason)
+      results[index] = PreprocessResult(None,
+                                        skipped_message(image_path, reason))
+      continue
+    scale = None
+    if max_long_side is not None:
+      scale = _landmark_scale(contents, image)
+
+    cache_key = None
+    if cache is not None:
+      params = {'inference_count': inference_count,
+                'detection_threshold': detection_threshold}
+      if convergence_tolerance is not None:
+        params['convergence_tolerance'] = convergence_tolerance
+      if max_long_side is not None:
+        params['max_long_side'] = max_long_side
+      if cascade_threshold is not None:
+        params['cascade_threshold'] = cascade_threshold
+        cache_key = cache.key(contents, 'movenet', 'movenet_cascade', **params)
+      else:
+        cache_key = cache.key(contents, 'movenet', model_name, **params)
+      pose_landmarks = cache.get(cache_key)
+      if pose_landmarks is not None:
+        results[index] = _finish_image(
+            image_path, image_out_path, image, pose_landmarks,
+            detection_threshold, cache_hit=True, passes=None,
+            overlay_confidence=overlay_confidence,
+            overlay_writer=overlay_writer, scale=scale)
+        continue
+    pending.append((index, image, cache_key, scale))
+
+  # Without batching, images run through this process's `movenet`, which is
+  # only loaded once an image needs detection
+  if pending and not batch_size and cascade_threshold is None:
+    use_movenet(model_name)
+
+  # Detections as (landmarks, tier, passes) in the order of `pending`, and
+  # the time the cascade took on each image
+  detect_seconds = [None] * len(pending)
+  if cascade_threshold is not None:
+    cascade = get_movenet_cascade(cascade_threshold, inference_count,
+                                  convergence_tolerance)
+    detections = []
+    for pending_index, (_, image, _, _) in enumerate(pending):
+      start_time = time.perf_counter()
+      detections.append(cascade.detect(image))
+      detect_seconds[pending_index] = time.perf_counter() - start_time
+  else:
+    if batch_size:
+      people = get_batched_movenet(batch_size, model_name).detect(
+          [image.numpy() for _, image, _, _ in pending], inference_count,
+          convergence_tolerance, detection_threshold)
+    elif convergence_tolerance is not None:
+      people = [detect_until_converged(image, inference_count,
+                                       convergence_tolerance,
+                                       detection_threshold)
+                for _, image, _, _ in pending]
+    else:
+      people = [(detect(image, inference_count), inference_count)
+                for _, image, _, _ in pending]
+    # Get landmarks and scale it to the same size as the input image
+    detections = [(_person_landmarks(person), None, passes)
+                  for person, passes in people]
+
+  for (index, image, cache_key, scale), (pose_landmarks, tier, passes), \
+      seconds in zip(pending, detections, detect_seconds):
+    image_path, image_out_path = tasks[index]
+    if scale is not None:
+      pose_landmarks = pose_landmarks * scale
+    if cache_key is not None:
+      cache.put(cache_key, pose_landmarks)
+    if tier is not None:
+      metrics.count('cascade_images', tier=tier)
+
+    results[index] = _finish_image(
+        image_path, image_out_path, image, pose_landmarks,
+        detection_threshold, cache_hit=False if cache is not None else None,
+        passes=passes, overlay_confidence=overlay_confidence,
+        overlay_writer=overlay_writer, scale=scale)._replace(
+            tier=tier, detect_seconds=seconds)
+
+  return [result._replace(digest=digest)
+          for result, digest in zip(results, digests)]
+
+
+def _preprocess_images_task(task):
+  """Unpacks a (tasks, options) chunk for `Pool.imap`."""
+  tasks, options = task
+  return _preprocess_images(tasks, **options)
+
+
+def _preprocess_images_in_worker(task):
+  """Runs `_preprocess_images_task` in a worker process.
+
+  Returns the results together with the metrics the worker recorded for them.
+  """
+  return _preprocess_images_task(task), metrics.drain()
+
+
+def _merge_worker_metrics(outcomes):
+  """Yields the results of worker outcomes after merging their metrics."""
+  for results, worker_metrics in outcomes:
+    metrics.merge(worker_metrics)
+    yield results
+
+
+def read_image_list(list_path):
+  """Reads an image list file written by `split_into_train_test`.
+
+  The file has one image path per line, and the name of the folder an image is
+  in is its class. Returns a dict of class name to image paths.
+  """
+  class_image_paths = collections.defaultdict(list)
+  with open(list_path) as list_file:
+    for image_path in list_file.read().splitlines():
+      if image_path:
+        class_name = os.path.basename(os.path.dirname(image_path))
+        class_image_paths[class_name].append(image_path)
+  return dict(class_image_paths)
+
+
+# Measured cost and yield of one MoveNet configuration on a calibration sample.
+# `ms_per_image` is the mean detection latency per image and `kept_rate` the
+# fraction of the sample whose keypoints all pass the detection threshold.
+ModelChoice = collections.namedtuple(
+    'ModelChoice',
+    ['model_name', 'input_size', 'inference_count', 'ms_per_image',
+     'kept_rate'])
+
+def calibrate_movenet(image_paths, detection_threshold=0.3,
+                      model_names=('movenet_lightning', 'movenet_thunder'),
+                      max_inference_count=3, max_long_side=None):
+  """Measures each MoveNet variant and pass count on a sample of images.
+
+  Every image is run through `max_inference_count` passes of each variant the
+  way `detect()` runs them, and the latency and outcome after each pass give
+  the `ModelChoice` of that pass count. Images are decoded like in
+  `_preprocess_images`, scaled down to `max_long_side` if that is set.
+  Returns the choices from the cheapest to the most expensive.
+  """
+  images = []
+  for image_path in image_paths:
+    _, image, _ = ingest_image(image_path, max_long_side)
+    if image is not None:
+      images.append(image.numpy())
+  if not images:
+    raise ValueError('No valid images to calibrate MoveNet on.')
+
+  choices = []
+  for model_name in model_names:
+    detector = load_movenet(model_name)
+    # Warm up the interpreter so the first image isn't charged for it
+    detector.detect(images[0], reset_crop_region=True)
+
+    elapsed = np.zeros(max_inference_count)
+    kept = np.zeros(max_inference_count)
+    for image in images:
+      start_time = time.perf_counter()
+      for pass_index in range(max_inference_count):
+        person = detector.detect(image, reset_crop_region=pass_index == 0)
+        elapsed[pass_index] += time.perf_counter() - start_time
+        kept[pass_index] += min(keypoint.score for keypoint
+                                in person.keypoints) >= detection_threshold
+
+    for pass_index in range(max_inference_count):
+      choices.append(ModelChoice(
+          model_name, MOVENET_INPUT_SIZES.get(model_name), pass_index + 1,
+          float(1000 * elapsed[pass_index] / len(images)),
+          float(kept[pass_index] / len(images))))
+  return sorted(choices, key=lambda choice: choice.ms_per_image)
+
+def select_movenet(choices, latency_budget_ms, kept_rate_tolerance=0.05):
+  """Picks the MoveNet configuration to run within a per-image latency budget.
+
+  Of the `choices` that fit the budget, those keeping at least the best
+  kept-image rate of all choices, less `kept_rate_tolerance`, qualify, and
+  the most expensive of them is picked since it refines the landmarks the
+  most. If none qualifies, the fitting choice keeping the most images is
+  picked, or the cheapest choice if none fits.
+  """
+  best_kept_rate = max(choice.kept_rate for choice in choices)
+  fitting = [choice for choice in choices
+             if choice.ms_per_image <= latency_budget_ms]
+  if not fitting:
+    return min(choices, key=lambda choice: choice.ms_per_image)
+  keeping = [choice for choice in fitting
+             if choice.kept_rate >= best_kept_rate - kept_rate_tolerance]
+  if keeping:
+    return max(keeping, key=lambda choice: choice.ms_per_image)
+  return max(fitting, key=lambda choice: (choice.kept_rate,
+                                          choice.ms_per_image))
+
+# Pose embeddings
+
+# Hip and shoulder indices of the MoveNet `BodyPart` layout
+MOVENET_HIPS = (11, 12)
+MOVENET_SHOULDERS = (5, 6)
+
+# Hip and shoulder indices of the 33-landmark MediaPipe layout, for models
+# trained on MediaPipe embeddings
+MEDIAPIPE_HIPS = (23, 24)
+MEDIAPIPE_SHOULDERS = (11, 12)
+
+def pose_embeddings(landmarks_and_scores, torso_size_multiplier=2.5,
+                    hips=MOVENET_HIPS, shoulders=MOVENET_SHOULDERS):
+  """Computes the pose embeddings of a batch of flat landmark rows with NumPy.
+
+  Does what `landmarks_to_embedding` does in the model, for any number of
+  [x, y, score] landmarks per row: 17 for MoveNet, or 33 for MediaPipe with
+  its hip and shoulder indices. The pose size is computed per sample.
+  Returns a float32 array of the flattened normalized (x, y) coordinates.
+  """
+  landmarks_and_scores = np.asarray(landmarks_and_scores, dtype=np.float32)
+  landmarks = landmarks_and_scores.reshape(
+      len(landmarks_and_scores), -1, 3)[:, :, :2]
+
+  # Move landmarks so that the hips center becomes (0,0)
+  hips_center = (landmarks[:, hips[0]] + landmarks[:, hips[1]]) * 0.5
+  shoulders_center = (landmarks[:, shoulders[0]] +
+                      landmarks[:, shoulders[1]]) * 0.5
+  landmarks = landmarks - hips_center[:, np.newaxis]
+
+  # Pose size is the larger of the scaled torso size and the maximum distance
+  # from the center to any landmark
+  torso_size = np.linalg.norm(shoulders_center - hips_center, axis=1)
+  max_dist = np.max(np.linalg.norm(landmarks, axis=2), axis=1)
+  pose_size = np.maximum(torso_size * torso_size_multiplier, max_dist)
+
+  # Avoid dividing by zero for rows without any landmark spread
+  pose_size = np.maximum(pose_size, np.finfo(np.float32).eps)
+  landmarks /= pose_size[:, np.newaxis, np.newaxis]
+
+  return landmarks.reshape(len(landmarks), -1)
+
+# Video
+
+class OneEuroFilter(object):
+  """One-Euro filter over the keypoint coordinates of a video.
+
+  Each coordinate is low-pass filtered with a cutoff frequency that rises with
+  its speed, so slow jitter is smoothed away while fast motion lags little.
+  `min_cutoff` and `derivative_cutoff` are in Hz and `beta` scales the speed,
+  in pixels per second, into extra cutoff. Keypoint scores aren't filtered.
+  """
+
+  def __init__(self, min_cutoff=1.0, beta=0.007, derivative_cutoff=1.0):
+    self._min_cutoff = min_cutoff
+    self._beta = beta
+    self._derivative_cutoff = derivative_cutoff
+    self._landmarks = None
+    self._velocity = None
+    self._timestamp = None
+
+  @staticmethod
+  def _alpha(cutoff, elapsed):
+    tau = 1 / (2 * np.pi * cutoff)
+    return 1 / (1 + tau / elapsed)
+
+  def __call__(self, landmarks, timestamp):
+    """Filters the (17, 3) landmarks detected at `timestamp` seconds."""
+    if self._landmarks is None:
+      self._landmarks = landmarks.copy()
+      self._velocity = np.zeros_like(landmarks[:, :2])
+      self._timestamp = timestamp
+      return self._landmarks.copy()
+
+    elapsed = max(timestamp - self._timestamp, 1e-6)
+    velocity = (landmarks[:, :2] - self._landmarks[:, :2]) / elapsed
+    alpha = self._alpha(self._derivative_cutoff, elapsed)
+    self._velocity += alpha * (velocity - self._velocity)
+
+    cutoff = self._min_cutoff + self._beta * np.abs(self._velocity)
+    alpha = self._alpha(cutoff, elapsed)
+    self._landmarks[:, :2] += alpha * (landmarks[:, :2] - self._landmarks[:, :2])
+    self._landmarks[:, 2] = landmarks[:, 2]
+    self._timestamp = timestamp
+    return self._landmarks.copy()
+
+  def predict(self, timestamp):
+    """Extrapolates the filtered landmarks to a frame without a detection."""
+    landmarks = self._landmarks.copy()
+    landmarks[:, :2] += self._velocity * (timestamp - self._timestamp)
+    return landmarks
+
+# Serving
+
+class MicroBatcher(object):
+  """Coalesces concurrent classification requests into batches.
+
+  `submit()` queues the input rows of one request and returns a Future of
+  their class probabilities. A worker thread runs the queued rows as a single
+  `classify_batch` call as soon as `max_batch_size` rows are waiting or the
+  oldest request has waited `max_wait_ms`.
+  """
+
+  def __init__(self, classify_batch, max_batch_size=64, max_wait_ms=5):
+    self._classify_batch = classify_batch
+    self._max_batch_size = max_batch_size
+    self._max_wait = max_wait_ms / 1000
+    self._queue = queue.Queue()
+    self.batch_count = 0
+    self.row_count = 0
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def submit(self, rows):
+    future = concurrent.futures.Future()
+    self._queue.put((rows, future))
+    return future
+
+  def _run(self):
+    stopping = False
+    while not stopping:
+      item = self._queue.get()
+      if item is None:
+        return
+      items = [item]
+      row_count = len(item[0])
+
+      # Wait for more requests until the batch is full or the wait is over
+      deadline = time.monotonic() + self._max_wait
+      while row_count < self._max_batch_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+          break
+        try:
+          item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+          break
+        if item is None:
+          stopping = True
+          break
+        items.append(item)
+        row_count += len(item[0])
+
+      try:
+        probabilities = self._classify_batch(
+            np.concatenate([rows for rows, _ in items]))
+      except Exception as e:
+        for _, future in items:
+          future.set_exception(e)
+        continue
+      self.batch_count += 1
+      self.row_count += row_count
+
+      start = 0
+      for rows, future in items:
+        future.set_result(probabilities[start:start + len(rows)])
+        start += len(rows)
+
+  def close(self):
+    """Stops the worker thread once the queued requests are done."""
+    self._queue.put(None)
+    self._thread.join()
@@ -8,21 +8,30 @@ Original file is located at
 """
 
 !pip install -q opencv-python
+!pip install -q mediapipe
 
 from google.colab import drive
 
 # This will prompt for authorization.
 drive.mount('/content/drive')
 
-import csv
+import collections
+import concurrent.futures
+import contextlib
 import cv2
+import http.server
 import itertools
+import json
+import multiprocessing
 import numpy as np
 import pandas as pd
 import os
 import sys
 import tempfile
+import threading
+import time
 import tqdm
+import urllib.request
 
 from matplotlib import pyplot as plt
 from matplotlib.collections import LineCollection
@@ -38,201 +47,596 @@ from sklearn.metrics import accuracy_score, classification_report, confusion_mat
 
 # Download model from TF Hub and check out inference code from GitHub
 !wget -q -O movenet_thunder.tflite https://tfhub.dev/google/lite-model/movenet/singlepose/thunder/tflite/float16/4?lite-format=tflite
+!wget -q -O movenet_lightning.tflite https://tfhub.dev/google/lite-model/movenet/singlepose/lightning/tflite/float16/4?lite-format=tflite
+!wget -q -O movenet_multipose.tflite https://tfhub.dev/google/lite-model/movenet/multipose/lightning/tflite/float16/1?lite-format=tflite
 !git clone https://github.com/tensorflow/examples.git
 pose_sample_rpi_path = os.path.join(os.getcwd(), 'examples/lite/examples/pose_estimation/raspberry_pi')
 sys.path.append(pose_sample_rpi_path)
 
-# Load MoveNet Thunder model
-import utils
+# Check out this repository for the pipeline module that preprocessing worker
+# processes import, and for the bundled datasets
+!git clone -q https://github.com/durgas4/Pose-Estimation-using-Movenet-and-Mediapipe.git
+REPO_PATH = os.path.join(os.getcwd(), 'Pose-Estimation-using-Movenet-and-Mediapipe')
+sys.path.append(os.path.join(REPO_PATH, 'movenet'))
+
 from data import BodyPart
 from ml import Movenet
-movenet = Movenet('movenet_thunder')
 
-# Define function to run pose estimation using MoveNet Thunder.
+import movenet_pipeline
+from movenet_pipeline import (
+    CASCADE_TIERS, IMAGE_EXTENSIONS, MEDIAPIPE_HIPS, MEDIAPIPE_SHOULDERS,
+    MOVENET_INPUT_SIZES, AsyncWriter, LandmarkCache, LandmarkRowWriter,
+    MicroBatcher, OneEuroFilter, RunManifest, _init_movenet_worker,
+    _landmark_scale, _merge_worker_metrics, _person_landmarks,
+    _preprocess_images_in_worker, _preprocess_images_task, calibrate_movenet,
+    decode_image, detect, ingest_image, metrics, pose_embeddings,
+    read_image_list, read_landmark_rows, select_movenet, skeleton_renderer,
+    skipped_message, use_movenet, write_image)
 
-def detect(input_tensor, inference_count=3):
-  image_height, image_width, channel = input_tensor.shape
+# Load MoveNet Thunder model
+use_movenet('movenet_thunder')
 
-  # Detect pose using the full input image
-  movenet.detect(input_tensor.numpy(), reset_crop_region=True)
+# One figure found by MoveNet MultiPose. `landmarks` is the (17, 3) array of
+# pixel [x, y, score] rows, `bounding_box` the pixel (x_min, y_min, x_max,
+# y_max) box and `score` the detection score of the figure.
+Figure = collections.namedtuple('Figure',
+                                ['landmarks', 'bounding_box', 'score'])
 
-  # Repeatedly using previous detection result to identify the region of
+class MultiPoseMovenet(object):
+  """MoveNet MultiPose detector that finds up to six figures in one pass.
 
-  for _ in range(inference_count - 1):
-    person = movenet.detect(input_tensor.numpy(),
-                            reset_crop_region=False)
+  The image is resized so that its longer side is `input_size` and both sides
+  are multiples of 32, as the model requires, and the interpreter input is
+  resized to match whenever the image shape changes. No crop refinement is
+  done, every figure comes from the same single inference.
+  """
 
-  return person
+  def __init__(self, model_name='movenet_multipose', input_size=256):
+    _, ext = os.path.splitext(model_name)
+    model_path = model_name if ext else model_name + '.tflite'
+    self._interpreter = tf.lite.Interpreter(model_path=model_path)
+    input_details = self._interpreter.get_input_details()[0]
+    self._input_index = input_details['index']
+    self._input_dtype = input_details['dtype']
+    self._output_index = self._interpreter.get_output_details()[0]['index']
+    self._input_size = input_size
+    self._input_shape = None
+
+  def _resized_shape(self, image_height, image_width):
+    scale = self._input_size / max(image_height, image_width)
+    return (max(32, int(round(image_height * scale / 32)) * 32),
+            max(32, int(round(image_width * scale / 32)) * 32))
+
+  def detect(self, image, score_threshold=0.2):
+    """Returns the `Figure`s in an RGB image scoring at least `score_threshold`.
+
+    Figures are sorted from left to right, so that figure indices follow the
+    reading order of a panel.
+    """
+    image_height, image_width, _ = image.shape
+    input_shape = self._resized_shape(image_height, image_width)
+    if input_shape != self._input_shape:
+      self._interpreter.resize_tensor_input(self._input_index,
+                                            [1, input_shape[0],
+                                             input_shape[1], 3])
+      self._interpreter.allocate_tensors()
+      self._input_shape = input_shape
+
+    input_image = cv2.resize(image, (input_shape[1], input_shape[0]))
+    with metrics.timer('movenet_multipose'):
+      self._interpreter.set_tensor(
+          self._input_index,
+          input_image[np.newaxis].astype(self._input_dtype))
+      self._interpreter.invoke()
+      detections = self._interpreter.get_tensor(self._output_index)[0]
+
+    # Each detection holds 17 [y, x, score] keypoints followed by the
+    # [y_min, x_min, y_max, x_max, score] box, all normalized to the image
+    figures = []
+    for detection in detections:
+      score = float(detection[-1])
+      if score < score_threshold:
+        continue
+      keypoints = detection[:len(BodyPart) * 3].reshape(len(BodyPart), 3)
+      landmarks = np.stack([keypoints[:, 1] * image_width,
+                            keypoints[:, 0] * image_height,
+                            keypoints[:, 2]], axis=1).astype(np.float32)
+      y_min, x_min, y_max, x_max = detection[len(BodyPart) * 3:-1]
+      figures.append(Figure(landmarks,
+                            (float(x_min * image_width),
+                             float(y_min * image_height),
+                             float(x_max * image_width),
+                             float(y_max * image_height)),
+                            score))
+    figures.sort(key=lambda figure: figure.bounding_box[0])
+    return figures
+
+# MultiPose detector of this process, created on first use
+multipose_movenet = None
+
+def get_multipose_movenet():
+  """Returns this process's `MultiPoseMovenet`, loading it if needed."""
+  global multipose_movenet
+  if multipose_movenet is None:
+    multipose_movenet = MultiPoseMovenet('movenet_multipose')
+  return multipose_movenet
 
 """#Pre-Processing"""
 
-def draw_prediction_on_image(
-    image, person, crop_region=None, close_figure=True,
-    keep_input_size=False):
-
-  # Draw the detection result on top of the image.
-  image_np = utils.visualize(image, [person])
-
-  # Plot the image with detection results.
-  height, width, channel = image.shape
-  aspect_ratio = float(width) / height
-  fig, ax = plt.subplots(figsize=(12 * aspect_ratio, 12))
-  im = ax.imshow(image_np)
-
-  if close_figure:
-    plt.close(fig)
-
-  if not keep_input_size:
-    image_np = utils.keep_aspect_ratio_resizer(image_np, (512, 512))
-
-  return image_np
 
 class MoveNetPreprocessor(object):
   def __init__(self,
                images_in_folder,
                images_out_folder,
-               csvs_out_path):
+               csvs_out_path,
+               work_dir=None):
     self._images_in_folder = images_in_folder
     self._images_out_folder = images_out_folder
     self._csvs_out_path = csvs_out_path
     self._messages = []
 
-    # Create a temp dir to store the pose CSVs per class
-    self._csvs_out_folder_per_class = tempfile.mkdtemp()
-
-    # Get list of pose classes and print image statistics
-    self._pose_class_names = sorted(
-        [n for n in os.listdir(self._images_in_folder) if not n.startswith('.')]
-        )
-
-  def process(self, per_pose_class_limit=None, detection_threshold=0.3):
-    for pose_class_name in self._pose_class_names:
-      print('Preprocessing', pose_class_name, file=sys.stderr)
-
-      # Paths for the pose class.
+    # Dir to store the pose landmarks and run manifest per class. Pass a
+    # persistent `work_dir` to resume or update a previous run, otherwise a
+    # temp dir is used.
+    if work_dir is None:
+      work_dir = tempfile.mkdtemp()
+    os.makedirs(work_dir, exist_ok=True)
+    self._landmarks_out_folder_per_class = work_dir
+
+    # Get list of pose classes and print image statistics. The images are
+    # either in a subfolder per class or listed in an image list file.
+    self._class_image_paths = None
+    if os.path.isfile(self._images_in_folder):
+      self._class_image_paths = read_image_list(self._images_in_folder)
+      self._pose_class_names = sorted(self._class_image_paths)
+    else:
+      self._pose_class_names = sorted(
+          [n for n in os.listdir(self._images_in_folder) if not n.startswith('.')]
+          )
+
+  def _class_images(self, pose_class_name):
+    """Returns the sorted (image name, image path) pairs of a pose class."""
+    if self._class_image_paths is not None:
+      image_paths = self._class_image_paths[pose_class_name]
+    else:
       images_in_folder = os.path.join(self._images_in_folder, pose_class_name)
-      images_out_folder = os.path.join(self._images_out_folder, pose_class_name)
-      csv_out_path = os.path.join(self._csvs_out_folder_per_class,
-                                  pose_class_name + '.csv')
-      if not os.path.exists(images_out_folder):
-        os.makedirs(images_out_folder)
-
-      # Detect landmarks in each image and write it to a CSV file
-      with open(csv_out_path, 'w') as csv_out_file:
-        csv_out_writer = csv.writer(csv_out_file,
-                                    delimiter=',',
-                                    quoting=csv.QUOTE_MINIMAL)
-        # Get list of images
-        image_names = sorted(
-            [n for n in os.listdir(images_in_folder) if not n.startswith('.')])
-        if per_pose_class_limit is not None:
-          image_names = image_names[:per_pose_class_limit]
-
-        valid_image_count = 0
-
-        # Detect pose landmarks from each image
-        for image_name in tqdm.tqdm(image_names):
-          image_path = os.path.join(images_in_folder, image_name)
-
-          try:
-            image = tf.io.read_file(image_path)
-            image = tf.io.decode_jpeg(image)
-          except:
-            self._messages.append('Skipped ' + image_path + '. Invalid image.')
-            continue
+      image_paths = [os.path.join(images_in_folder, n)
+                     for n in os.listdir(images_in_folder)
+                     if not n.startswith('.')]
+    return sorted((os.path.basename(image_path), image_path)
+                  for image_path in image_paths)
+
+  def _sample_images(self, sample_size):
+    """Returns up to `sample_size` image paths spread evenly over the classes."""
+    per_class_size = max(1, sample_size // len(self._pose_class_names))
+    image_paths = []
+    for pose_class_name in self._pose_class_names:
+      class_images = self._class_images(pose_class_name)
+      step = max(1, len(class_images) // per_class_size)
+      image_paths += [image_path for _, image_path
+                      in class_images[::step][:per_class_size]]
+    return image_paths
+
+  def process(self, per_pose_class_limit=None, detection_threshold=0.3,
+              num_workers=1, cache=None, convergence_tolerance=None,
+              batch_size=None, overlay_mode='all', overlay_every=10,
+              overlay_confidence=0.5, writer_threads=0,
+              model_name='movenet_thunder', inference_count=3,
+              latency_budget_ms=None, throughput=None, calibration_size=40,
+              cascade_threshold=None, max_long_side=None):
+    """Detects landmarks in every image and writes them to the output CSV.
+
+    Landmarks are detected with `inference_count` passes of the `model_name`
+    MoveNet variant. Alternatively, set a `latency_budget_ms` per image or a
+    `throughput` target in images per second over all workers, and the
+    variant and pass count are picked with `select_movenet` from a calibration
+    of Lightning and Thunder on `calibration_size` images of the dataset,
+    with `inference_count` as the most passes to consider.
+
+    If `cascade_threshold` is set, images go through a `MovenetCascade`
+    instead: a single Lightning pass is accepted when every keypoint scores at
+    least `cascade_threshold`, and other images are escalated to Thunder with
+    up to `inference_count` refinement passes, then to MediaPipe Pose. The
+    share of the cascaded images handled at each tier and their detection
+    throughput are reported at the end. The cascade can't be combined with
+    `batch_size` or a latency budget.
+
+    If `max_long_side` is set, images with a longer side than that are scaled
+    down before detection, with DCT-scaled decoding for JPEG files, and their
+    landmarks are mapped back to the original image pixels. Overlays are then
+    drawn at the scaled size.
+
+    The settings used, and the calibration if one was run, are written to
+    `<csvs_out_path>.meta.json` and returned.
+
+    With `num_workers` > 1 the images of each class are sharded over a pool of
+    worker processes, each of which loads its own MoveNet model. Results are
+    collected in image-name order, so the CSV output is the same as a serial
+    run.
+
+    The outcome of every image is recorded in a `RunManifest` per class in the
+    work dir as soon as it is known. With a persistent work dir, a rerun, e.g.
+    after a crash or once new images were added, only processes the images
+    that are new or changed since they were recorded.
+
+    If a `LandmarkCache` is given, images that were already processed with the
+    same settings skip pose detection.
+
+    If `convergence_tolerance` is set, MoveNet crop refinement stops as soon as
+    the keypoints move less than the tolerance between passes, and is skipped
+    for images whose full-frame pass is below `detection_threshold`. The
+    number of passes used per image is reported at the end.
+
+    If `batch_size` is set, images are processed in chunks of that size and
+    the MoveNet passes of a chunk run as batched invocations of
+    `BatchedMovenet`.
+
+    `overlay_mode` picks the kept images that get a debug overlay:
+      * 'all': every image.
+      * 'none': no image. Use `render_overlays` to draw them later.
+      * 'sample': every `overlay_every`-th image of each class.
+      * 'low_confidence': images with a keypoint scoring below
+        `overlay_confidence`.
+
+    With `writer_threads` > 0, overlays and manifest records are written by
+    background threads so that detection doesn't wait on output I/O. Pending
+    writes are flushed at the end of every class. Worker processes always write
+    their overlays themselves, only manifest records go through the writer
+    then.
+    """
+    if overlay_mode not in ('all', 'none', 'sample', 'low_confidence'):
+      raise ValueError('Unknown overlay mode: {}'.format(overlay_mode))
+    if cascade_threshold is not None and (
+        batch_size or latency_budget_ms is not None or throughput is not None):
+      raise ValueError('The cascade runs one image at a time with its own '
+                       'models, without batch_size or a latency budget.')
+
+    # Pick the MoveNet configuration that fits the tighter of the budgets
+    selection = None
+    if latency_budget_ms is not None or throughput is not None:
+      budgets = []
+      if latency_budget_ms is not None:
+        budgets.append(latency_budget_ms)
+      if throughput is not None:
+        # Workers detect in parallel, so each may spend longer per image
+        budgets.append(1000 * max(num_workers, 1) / throughput)
+      calibration = calibrate_movenet(self._sample_images(calibration_size),
+                                      detection_threshold,
+                                      max_inference_count=inference_count,
+                                      max_long_side=max_long_side)
+      choice = select_movenet(calibration, min(budgets))
+      model_name = choice.model_name
+      inference_count = choice.inference_count
+      print('Selected {} with {} passes: {:.1f} ms per image, {:.0%} kept '
+            '(budget {:.1f} ms)'.format(model_name, inference_count,
+                                        choice.ms_per_image, choice.kept_rate,
+                                        min(budgets)), file=sys.stderr)
+      selection = {'latency_budget_ms': latency_budget_ms,
+                   'throughput': throughput,
+                   'choice': choice._asdict(),
+                   'calibration': [c._asdict() for c in calibration]}
+
+    options = {'detection_threshold': detection_threshold,
+               'inference_count': inference_count,
+               'model_name': model_name,
+               'cascade_threshold': cascade_threshold,
+               'max_long_side': max_long_side,
+               'cache': cache,
+               'convergence_tolerance': convergence_tolerance,
+               'batch_size': batch_size,
+               'overlay_confidence': (overlay_confidence
+                                      if overlay_mode == 'low_confidence'
+                                      else None)}
+    detection_passes = collections.Counter()
+    cascade_tiers = collections.Counter()
+    # Time the cascade spent detecting poses, for its throughput
+    cascade_seconds = 0.0
+
+    # Manifest records made with other settings aren't reused
+    settings = {'model': model_name,
+                'inference_count': inference_count,
+                'detection_threshold': detection_threshold,
+                'convergence_tolerance': convergence_tolerance}
+    if cascade_threshold is not None:
+      settings.update(model='movenet_cascade',
+                      cascade_threshold=cascade_threshold)
+    if max_long_side is not None:
+      settings['max_long_side'] = max_long_side
+
+    pool = None
+    if num_workers > 1:
+      # Forking after TensorFlow started its runtime threads can deadlock the
+      # workers, so they are spawned and load the active model themselves.
+      # Spawned workers can't see functions defined in the notebook, so the
+      # initializer and the per-image work come from `movenet_pipeline`.
+      pool = multiprocessing.get_context('spawn').Pool(
+          num_workers, initializer=_init_movenet_worker,
+          initargs=(model_name if cascade_threshold is None else None,
+                    metrics.enabled))
+
+    # Manifest records need a single writer thread to keep their order
+    overlay_writer = None
+    row_writer = None
+    if writer_threads:
+      row_writer = AsyncWriter(num_threads=1)
+      if pool is None:
+        overlay_writer = AsyncWriter(num_threads=writer_threads)
+        options['overlay_writer'] = overlay_writer
+
+    try:
+      for pose_class_name in self._pose_class_names:
+        print('Preprocessing', pose_class_name, file=sys.stderr)
+
+        # Paths for the pose class.
+        images_out_folder = os.path.join(self._images_out_folder,
+                                         pose_class_name)
+        landmarks_out_prefix = os.path.join(
+            self._landmarks_out_folder_per_class, pose_class_name)
+        if overlay_mode != 'none' and not os.path.exists(images_out_folder):
+          os.makedirs(images_out_folder)
+
+        # Detect landmarks in each new or changed image and record them in
+        # the run manifest of the class
+        with RunManifest(landmarks_out_prefix, settings) as manifest:
+          # Get list of images
+          class_images = self._class_images(pose_class_name)
+          all_image_names = [image_name for image_name, _ in class_images]
+          if per_pose_class_limit is not None:
+            class_images = class_images[:per_pose_class_limit]
+          image_names = [image_name for image_name, _ in class_images]
+
+          # Reuse the outcome of images that didn't change since the last run
+          valid_image_count = 0
+          tasks = []
+          task_images = []
+          for image_index, (image_name, image_path) in enumerate(class_images):
+            try:
+              stat = os.stat(image_path)
+              record = manifest.lookup(image_name, image_path, stat)
+            except OSError as e:
+              # E.g. a file deleted since it was listed, or a dangling link
+              metrics.count('images', outcome='skipped', reason='invalid')
+              self._messages.append(
+                  'Skipped ' + image_path + '. ' + (e.strerror or str(e)) + '.')
+              manifest.discard(image_name)
+              continue
+            if record is not None:
+              metrics.count('images', outcome='reused')
+              if record['outcome'] == 'kept':
+                valid_image_count += 1
+              else:
+                self._messages.append(record['reason'])
+              continue
+
+            image_out_path = os.path.join(images_out_folder, image_name)
+            if overlay_mode == 'none' or (
+                overlay_mode == 'sample' and image_index % overlay_every):
+              image_out_path = None
+            tasks.append((image_path, image_out_path))
+            task_images.append((image_name, stat))
+          if len(tasks) < len(image_names):
+            print('Reusing {} unchanged images'.format(
+                len(image_names) - len(tasks)), file=sys.stderr)
+          chunk_size = batch_size or 1
+          chunks = [(tasks[start:start + chunk_size], options)
+                    for start in range(0, len(tasks), chunk_size)]
+
+          # Detect pose landmarks from each image. `imap` hands out contiguous
+          # shards to the workers but yields results in task order.
+          if pool is None:
+            results = map(_preprocess_images_task, chunks)
           else:
-            image = tf.io.read_file(image_path)
-            image = tf.io.decode_jpeg(image)
-            image_height, image_width, channel = image.shape
-
-          # Skip images that isn't RGB because Movenet requires RGB images
-          if channel != 3:
-            self._messages.append('Skipped ' + image_path +
-                                  '. Image isn\'t in RGB format.')
-            continue
-          person = detect(image)
-
-          # Save landmarks if all landmarks were detected
-          min_landmark_score = min(
-              [keypoint.score for keypoint in person.keypoints])
-          should_keep_image = min_landmark_score >= detection_threshold
-          if not should_keep_image:
-            self._messages.append('Skipped ' + image_path +
-                                  '. No pose was confidentlly detected.')
-            continue
-
-          valid_image_count += 1
-
-          # Draw the prediction result on top of the image for debugging later
-          output_overlay = draw_prediction_on_image(
-              image.numpy().astype(np.uint8), person,
-              close_figure=True, keep_input_size=True)
-
-          # Write detection result into an image file
-          output_frame = cv2.cvtColor(output_overlay, cv2.COLOR_RGB2BGR)
-          cv2.imwrite(os.path.join(images_out_folder, image_name), output_frame)
-
-          # Get landmarks and scale it to the same size as the input image
-          pose_landmarks = np.array(
-              [[keypoint.coordinate.x, keypoint.coordinate.y, keypoint.score]
-                for keypoint in person.keypoints],
-              dtype=np.float32)
-
-          # Write the landmark coordinates to its per-class CSV file
-          coordinates = pose_landmarks.flatten().astype(str).tolist()
-          csv_out_writer.writerow([image_name] + coordinates)
-
-        if not valid_image_count:
-          raise RuntimeError(
-              'No valid images found for the "{}" class.'
-              .format(pose_class_name))
+            chunksize = max(1, len(chunks) // (num_workers * 4))
+            results = _merge_worker_metrics(
+                pool.imap(_preprocess_images_in_worker, chunks, chunksize))
+          results = itertools.chain.from_iterable(results)
+
+          for (image_name, stat), result in zip(
+              task_images, tqdm.tqdm(results, total=len(tasks))):
+            if result.cache_hit is not None:
+              cache.record(result.cache_hit)
+            if result.passes is not None:
+              detection_passes[result.passes] += 1
+            if result.tier is not None:
+              cascade_tiers[result.tier] += 1
+              cascade_seconds += result.detect_seconds
+
+            # Record the outcome of the image in the manifest
+            if row_writer is None:
+              manifest.add(image_name, stat, result.digest, result.landmarks,
+                           result.message)
+            else:
+              row_writer.submit(manifest.add, image_name, stat, result.digest,
+                                result.landmarks, result.message)
+
+            if result.landmarks is None:
+              self._messages.append(result.message)
+              continue
+
+            valid_image_count += 1
+
+          # Finish the writes of this class before its manifest is closed
+          for writer in (overlay_writer, row_writer):
+            if writer is not None:
+              writer.flush()
+
+          # Write the landmark rows of the class in image-name order
+          manifest.finish(image_names, all_image_names)
+
+          # Keep the cache within its size limit
+          if cache is not None:
+            cache.trim()
+
+          if not valid_image_count:
+            raise RuntimeError(
+                'No valid images found for the "{}" class.'
+                .format(pose_class_name))
+    finally:
+      if pool is not None:
+        pool.terminate()
+      for writer in (overlay_writer, row_writer):
+        if writer is not None:
+          writer.close()
 
     # Print the error message collected during preprocessing.
     print('\n'.join(self._messages))
-
-    # Combine all per-class CSVs into a single output file
-    all_landmarks_df = self._all_landmarks_as_dataframe()
-    all_landmarks_df.to_csv(self._csvs_out_path, index=False)
+    if cache is not None:
+      print(cache.report())
+    if convergence_tolerance is not None:
+      print('MoveNet passes per image:', ', '.join(
+          '{} passes: {} images'.format(passes, count)
+          for passes, count in sorted(detection_passes.items())))
+
+    # Combine all per-class landmarks into a single output file, a binary
+    # landmark store if the output path ends with .npz or a CSV file otherwise
+    with metrics.timer('merge'):
+      if self._csvs_out_path.endswith('.npz'):
+        write_landmark_store(self._csvs_out_path,
+                             self._all_landmarks_as_dataframe())
+      else:
+        self._write_all_landmarks_csv(self._csvs_out_path)
+
+    # Record how the landmarks were made next to them
+    metadata = dict(settings,
+                    input_size=MOVENET_INPUT_SIZES.get(settings['model']))
+    if selection is not None:
+      metadata['selection'] = selection
+    if cascade_threshold is not None:
+      # Shares and throughput are both over the images the cascade detected,
+      # not cache hits, images reused from the manifest or decode failures
+      cascaded_count = sum(cascade_tiers.values())
+      tier_shares = {tier: (cascade_tiers[tier] / cascaded_count
+                            if cascaded_count else 0.0)
+                     for tier in CASCADE_TIERS}
+      images_per_second = (cascaded_count / cascade_seconds
+                           if cascade_seconds else 0.0)
+      print('Cascade tiers: {}; {:.1f} images/s of detection'.format(
+          ', '.join('{} {:.0%} ({} images)'.format(tier, share,
+                                                   cascade_tiers[tier])
+                    for tier, share in tier_shares.items()),
+          images_per_second))
+      metadata['cascade'] = {'tier_images': dict(cascade_tiers),
+                             'tier_shares': tier_shares,
+                             'images_per_second': images_per_second}
+    with open(self._csvs_out_path + '.meta.json', 'w') as metadata_file:
+      json.dump(metadata, metadata_file, indent=2)
+    return metadata
 
   def class_names(self):
     """List of classes found in the training dataset."""
     return self._pose_class_names
 
-  def _all_landmarks_as_dataframe(self):
-    """Merge all per-class CSVs into a single dataframe."""
-    total_df = None
+  def _landmarks_header(self):
+    """Column names of the merged landmarks."""
+    header_name = ['file_name']
+    for bodypart in BodyPart:
+      header_name += [bodypart.name + '_x', bodypart.name + '_y',
+                      bodypart.name + '_score']
+    return header_name + ['class_no', 'class_name']
+
+  def _per_class_landmarks(self):
+    """Yields the landmarks of each class as a dataframe with the full header."""
+    header_name = self._landmarks_header()
     for class_index, class_name in enumerate(self._pose_class_names):
-      csv_out_path = os.path.join(self._csvs_out_folder_per_class,
-                                  class_name + '.csv')
-      per_class_df = pd.read_csv(csv_out_path, header=None)
+      landmarks_out_prefix = os.path.join(self._landmarks_out_folder_per_class,
+                                          class_name)
+      image_names, landmarks = read_landmark_rows(landmarks_out_prefix,
+                                                  len(BodyPart) * 3)
+      per_class_df = pd.DataFrame(landmarks, columns=header_name[1:-2])
+
+      # Prepend the folder name to the file names
+      per_class_df.insert(0, 'file_name',
+                          [os.path.join(class_name, image_name)
+                           for image_name in image_names])
 
       # Add the labels
-      per_class_df['class_no'] = [class_index]*len(per_class_df)
-      per_class_df['class_name'] = [class_name]*len(per_class_df)
+      per_class_df['class_no'] = class_index
+      per_class_df['class_name'] = class_name
 
-      # Append the folder name to the filename column (first column)
-      per_class_df[per_class_df.columns[0]] = (os.path.join(class_name, '')
-        + per_class_df[per_class_df.columns[0]].astype(str))
+      yield per_class_df
 
-      if total_df is None:
-        # For the first class, assign its data to the total dataframe
-        total_df = per_class_df
-      else:
-        # Concatenate each class's data into the total dataframe
-        total_df = pd.concat([total_df, per_class_df], axis=0)
+  def _all_landmarks_as_dataframe(self):
+    """Merge all per-class landmarks into a single dataframe."""
+    # A single concat copies each class once, rather than once per later class
+    return pd.concat(self._per_class_landmarks(), ignore_index=True)
 
-    list_name = [[bodypart.name + '_x', bodypart.name + '_y',
-                  bodypart.name + '_score'] for bodypart in BodyPart]
-    header_name = []
-    for columns_name in list_name:
-      header_name += columns_name
-    header_name = ['file_name'] + header_name
-    header_map = {total_df.columns[i]: header_name[i]
-                  for i in range(len(header_name))}
+  def _write_all_landmarks_csv(self, csv_path):
+    """Writes the merged landmarks to a CSV file one class at a time."""
+    with open(csv_path, 'w', newline='') as csv_file:
+      for class_index, per_class_df in enumerate(self._per_class_landmarks()):
+        per_class_df.to_csv(csv_file, header=class_index == 0, index=False)
 
-    total_df.rename(header_map, axis=1, inplace=True)
+def write_landmark_store(path, dataframe):
+  """Writes a merged landmark dataframe as a columnar .npz file.
 
-    return total_df
+  The landmarks are stored as one float32 matrix next to the file name and
+  class columns, so `read_landmark_store` loads them without any parsing.
+  """
+  landmark_columns = list(dataframe.columns[1:-2])
+  np.savez(path,
+           file_name=dataframe['file_name'].to_numpy(dtype=str),
+           landmarks=dataframe[landmark_columns].to_numpy(dtype=np.float32),
+           landmark_columns=np.array(landmark_columns),
+           class_no=dataframe['class_no'].to_numpy(dtype=np.int32),
+           class_name=dataframe['class_name'].to_numpy(dtype=str))
+
+def read_landmark_store(path):
+  """Loads a .npz landmark store into a dataframe laid out like the CSV."""
+  with np.load(path) as store:
+    dataframe = pd.DataFrame(store['landmarks'],
+                             columns=store['landmark_columns'])
+    dataframe.insert(0, 'file_name', store['file_name'])
+    dataframe['class_no'] = store['class_no']
+    dataframe['class_name'] = store['class_name']
+  return dataframe
+
+def read_landmarks(path):
+  """Loads the landmarks written by `MoveNetPreprocessor`, store or CSV."""
+  if path.endswith('.npz'):
+    return read_landmark_store(path)
+  return pd.read_csv(path)
+
+def render_overlays(csv_path, images_in_folder, images_out_folder,
+                    file_names=None):
+  """Draws debug overlays from the landmarks written by `MoveNetPreprocessor`.
+
+  No pose detection is run, the stored landmarks are drawn onto the original
+  images. `images_in_folder` is the image folder or image list file the
+  landmarks were extracted from. `file_names` restricts rendering to the given
+  `file_name` values, e.g. the misclassified test images.
+  """
+  # Landmarks of listed images are stored under their class and file name
+  listed_image_paths = None
+  if os.path.isfile(images_in_folder):
+    listed_image_paths = {
+        os.path.join(class_name, os.path.basename(image_path)): image_path
+        for class_name, image_paths in read_image_list(images_in_folder).items()
+        for image_path in image_paths}
+
+  dataframe = read_landmarks(csv_path)
+  if file_names is not None:
+    dataframe = dataframe[dataframe['file_name'].isin(set(file_names))]
+  landmarks = dataframe.iloc[:, 1:1 + len(BodyPart) * 3].to_numpy(
+      dtype=np.float32).reshape(-1, len(BodyPart), 3)
+
+  for file_name, pose_landmarks in zip(dataframe['file_name'], landmarks):
+    if listed_image_paths is None:
+      image_path = os.path.join(images_in_folder, file_name)
+    elif file_name in listed_image_paths:
+      image_path = listed_image_paths[file_name]
+    else:
+      print('Skipped ' + file_name + '. Not in the image list.')
+      continue
+    _, image, reason = ingest_image(image_path)
+    if image is None:
+      print(skipped_message(image_path, reason))
+      continue
+
+    image_out_path = os.path.join(images_out_folder, file_name)
+    os.makedirs(os.path.dirname(image_out_path), exist_ok=True)
+    output_frame = skeleton_renderer.render(image.numpy(), pose_landmarks,
+                                            cv2.COLOR_RGB2BGR)
+    write_image(image_out_path, output_frame)
 
 df = pd.read_excel('/content/drive/MyDrive/final project/sit-stand/annotate.xlsx')
 
@@ -247,34 +651,76 @@ import os
 import random
 import shutil
 
-def split_into_train_test(images_origin, images_dest, test_split):
+def _link_or_copy(source, destination):
+  """Hardlinks a file, falling back to a symlink and then to a copy."""
+  if os.path.lexists(destination):
+    os.remove(destination)
+  try:
+    os.link(source, destination)
+  except OSError:
+    try:
+      os.symlink(os.path.abspath(source), destination)
+    except OSError:
+      shutil.copyfile(source, destination)
+
+def split_into_train_test(images_origin, images_dest, test_split, mode='copy'):
+  """Splits the images of each class folder into train and test sets.
+
+  `mode` picks how the split is written to `images_dest`:
+    * 'copy': copies the images into `train/<class>` and `test/<class>`.
+    * 'link': same layout, but with hardlinks, or symlinks where hardlinks
+      aren't supported, so that no image data is duplicated.
+    * 'list': writes the image paths to `train.txt` and `test.txt` image list
+      files, which the preprocessors take in place of an images folder.
+  """
+  if mode not in ('copy', 'link', 'list'):
+    raise ValueError(f'Unknown split mode: {mode}')
   _, dirs, _ = next(os.walk(images_origin))
 
   TRAIN_DIR = os.path.join(images_dest, 'train')
   TEST_DIR = os.path.join(images_dest, 'test')
-  os.makedirs(TRAIN_DIR, exist_ok=True)
-  os.makedirs(TEST_DIR, exist_ok=True)
+  if mode == 'list':
+    os.makedirs(images_dest, exist_ok=True)
+    train_paths = []
+    test_paths = []
+  else:
+    os.makedirs(TRAIN_DIR, exist_ok=True)
+    os.makedirs(TEST_DIR, exist_ok=True)
 
   for dir in dirs:
     # Get all filenames for this dir, filtered by filetype
     filenames = os.listdir(os.path.join(images_origin, dir))
     filenames = [os.path.join(images_origin, dir, f) for f in filenames if (
-        f.endswith('.png') or f.endswith('.jpg') or f.endswith('.jpeg') or f.endswith('.bmp'))]
+        os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS)]
     # Shuffle the files, deterministically
     filenames.sort()
     random.seed(42)
     random.shuffle(filenames)
+    test_count = int(len(filenames) * test_split)
+    if mode == 'list':
+      test_paths += [os.path.abspath(file) for file in filenames[:test_count]]
+      train_paths += [os.path.abspath(file) for file in filenames[test_count:]]
+      print(f'Listed {test_count} of {len(filenames)} from class "{dir}" for test.')
+      continue
     # Divide them into train/test dirs
     os.makedirs(os.path.join(TEST_DIR, dir), exist_ok=True)
     os.makedirs(os.path.join(TRAIN_DIR, dir), exist_ok=True)
-    test_count = int(len(filenames) * test_split)
     for i, file in enumerate(filenames):
       if i < test_count:
         destination = os.path.join(TEST_DIR, dir, os.path.split(file)[1])
       else:
         destination = os.path.join(TRAIN_DIR, dir, os.path.split(file)[1])
-      shutil.copyfile(file, destination)
+      if mode == 'link':
+        _link_or_copy(file, destination)
+      else:
+        shutil.copyfile(file, destination)
     print(f'Moved {test_count} of {len(filenames)} from class "{dir}" into test.')
+
+  if mode == 'list':
+    for list_name, image_paths in (('train.txt', train_paths),
+                                   ('test.txt', test_paths)):
+      with open(os.path.join(images_dest, list_name), 'w') as list_file:
+        list_file.write(''.join(image_path + '\n' for image_path in image_paths))
   print(f'Your split dataset is in "{images_dest}"')
 
 dataset_in = '/content/drive/MyDrive/final project/sit-stand'
@@ -291,39 +737,79 @@ IMAGES_ROOT = '/content/split_/content/drive/MyDrive/final project/sit-stand'
 
 """Train"""
 
+# Record stage timings and image outcomes, written out after the evaluation
+metrics.enable()
+
 images_in_train_folder = os.path.join(IMAGES_ROOT, 'train')
 images_out_train_folder = 'poses_images_out_train'
-csvs_out_train_path = 'train_data.csv'
+# Landmarks go to the binary landmark store, CSV files are only exported below
+landmarks_out_train_path = 'train_data.npz'
+# Per-class landmarks and run manifests, kept so that a rerun only processes
+# new or changed images
+landmarks_work_train_dir = 'train_data_work'
+
+# Per-image detection budget in ms, e.g. 40 on an edge box, or None to always
+# run MoveNet Thunder with 3 passes
+LATENCY_BUDGET_MS = None
+
+# Keypoint score above which a single MoveNet Lightning pass is accepted, e.g.
+# 0.5, or None to run every image through the full model. Only one of this and
+# the latency budget can be set.
+CASCADE_THRESHOLD = None
+
+# Longer side that large photos are scaled down to before detection, e.g.
+# 1024, or None to detect on the full-size images. Scaling down is faster but
+# changes the extracted landmarks and so the training data.
+MAX_LONG_SIDE = None
 
 preprocessor = MoveNetPreprocessor(
       images_in_folder=images_in_train_folder,
       images_out_folder=images_out_train_folder,
-      csvs_out_path=csvs_out_train_path,
+      csvs_out_path=landmarks_out_train_path,
+      work_dir=landmarks_work_train_dir,
   )
 
-preprocessor.process(per_pose_class_limit=None)
+train_settings = preprocessor.process(per_pose_class_limit=None,
+                                      latency_budget_ms=LATENCY_BUDGET_MS,
+                                      cascade_threshold=CASCADE_THRESHOLD,
+                                      max_long_side=MAX_LONG_SIDE)
 
 """Test"""
 
 images_in_test_folder = os.path.join(IMAGES_ROOT, 'test')
 images_out_test_folder = 'poses_images_out_test'
-csvs_out_test_path = 'test_data.csv'
+landmarks_out_test_path = 'test_data.npz'
+landmarks_work_test_dir = 'test_data_work'
 
 preprocessor = MoveNetPreprocessor(
       images_in_folder=images_in_test_folder,
       images_out_folder=images_out_test_folder,
-      csvs_out_path=csvs_out_test_path,
+      csvs_out_path=landmarks_out_test_path,
+      work_dir=landmarks_work_test_dir,
   )
 
-preprocessor.process(per_pose_class_limit=None)
-
-# Download the preprocessed CSV files
-csvs_out_train_path = 'train_data.csv'
-csvs_out_test_path = 'test_data.csv'
-
-def load_pose_landmarks(csv_path):
-  # Load the CSV file
-  dataframe = pd.read_csv(csv_path)
+# Test landmarks must come from the same MoveNet setup as the training ones
+preprocessor.process(per_pose_class_limit=None,
+                     model_name=train_settings['model'],
+                     inference_count=train_settings['inference_count'],
+                     cascade_threshold=train_settings.get('cascade_threshold'),
+                     max_long_side=train_settings.get('max_long_side'))
+
+# Export the landmark stores as CSV files for download
+read_landmark_store(landmarks_out_train_path).to_csv('train_data.csv',
+                                                      index=False)
+read_landmark_store(landmarks_out_test_path).to_csv('test_data.csv',
+                                                    index=False)
+
+def load_pose_landmarks(csv_path, embeddings=False):
+  """Loads landmarks for training and evaluation.
+
+  With `embeddings`, X holds the `pose_embeddings` of the landmarks rather
+  than the landmarks. They are cached in `<csv_path>.embeddings.npy` and only
+  recomputed when the landmarks file is newer than the cache.
+  """
+  # Load the CSV file or the .npz landmark store
+  dataframe = read_landmarks(csv_path)
   df_to_process = dataframe.copy()
 
   # Drop the file_name columns as you don't need it during training.
@@ -336,20 +822,40 @@ def load_pose_landmarks(csv_path):
   y = df_to_process.pop('class_no')
 
   # Convert the input features and labels into the correct format for training.
-  X = df_to_process.astype('float64')
+  # The landmark store is already float32, which is what the model runs on.
+  if not csv_path.endswith('.npz'):
+    df_to_process = df_to_process.astype('float64')
+  X = df_to_process
   y = keras.utils.to_categorical(y)
 
+  if embeddings:
+    embeddings_path = csv_path + '.embeddings.npy'
+    if (os.path.exists(embeddings_path) and
+        os.path.getmtime(embeddings_path) >= os.path.getmtime(csv_path)):
+      X = np.load(embeddings_path)
+    else:
+      X = pose_embeddings(X.to_numpy(dtype=np.float32))
+      np.save(embeddings_path, X)
+
   return X, y, classes, dataframe
 
+# Set to train on embeddings computed once at load time instead of normalizing
+# the landmarks inside the model on every training step. This changes the
+# input of the exported pose_classifier.tflite from the raw 51 keypoint values
+# to the embedding, which consumers such as the RPi `Classifier` don't expect.
+TRAIN_ON_EMBEDDINGS = False
+
 # Load the train data
-X, y, class_names, _ = load_pose_landmarks(csvs_out_train_path)
+X, y, class_names, _ = load_pose_landmarks(landmarks_out_train_path,
+                                           embeddings=TRAIN_ON_EMBEDDINGS)
 
 # Split training data (X, y) into (X_train, y_train) and (X_val, y_val)
 X_train, X_val, y_train, y_val = train_test_split(X, y,
                                                   test_size=0.15)
 
 # Load the test data
-X_test, y_test, _, df_test = load_pose_landmarks(csvs_out_test_path)
+X_test, y_test, _, df_test = load_pose_landmarks(landmarks_out_test_path,
+                                                 embeddings=TRAIN_ON_EMBEDDINGS)
 
 def get_center_point(landmarks, left_bodypart, right_bodypart):
   """Calculates the center point of the two given landmarks."""
@@ -375,8 +881,8 @@ def get_pose_size(landmarks, torso_size_multiplier=2.5):
   shoulders_center = get_center_point(landmarks, BodyPart.LEFT_SHOULDER,
                                       BodyPart.RIGHT_SHOULDER)
 
-  # Torso size as the minimum body size
-  torso_size = tf.linalg.norm(shoulders_center - hips_center)
+  # Torso size as the minimum body size, per sample
+  torso_size = tf.linalg.norm(shoulders_center - hips_center, axis=1)
 
   # Pose center
   pose_center_new = get_center_point(landmarks, BodyPart.LEFT_HIP,
@@ -388,15 +894,14 @@ def get_pose_size(landmarks, torso_size_multiplier=2.5):
                                     [tf.size(landmarks) // (17*2), 17, 2])
 
   # Dist to pose center
-  d = tf.gather(landmarks - pose_center_new, 0, axis=0,
-                name="dist_to_pose_center")
-  # Max dist to pose center
-  max_dist = tf.reduce_max(tf.linalg.norm(d, axis=0))
+  d = landmarks - pose_center_new
+  # Max dist to pose center of each sample
+  max_dist = tf.reduce_max(tf.linalg.norm(d, axis=2), axis=1)
 
-  # Normalize scale
+  # Normalize scale, shaped to divide the (batch, 17, 2) landmarks
   pose_size = tf.maximum(torso_size * torso_size_multiplier, max_dist)
 
-  return pose_size
+  return tf.reshape(pose_size, [-1, 1, 1])
 
 
 def normalize_pose_landmarks(landmarks):
@@ -440,9 +945,12 @@ from tensorflow import keras
 
 # Define the model
 class CustomModel(tf.keras.Model):
-    def __init__(self, input_shape=(51), num_classes=None):
+    def __init__(self, input_shape=(51), num_classes=None,
+                 precomputed_embeddings=False):
         super(CustomModel, self).__init__()
 
+        # With precomputed embeddings the inputs are `pose_embeddings` output
+        self.precomputed_embeddings = precomputed_embeddings
         self.embedding = landmarks_to_embedding
         self.dense1 = keras.layers.Dense(128, activation=tf.nn.relu6)
         self.dropout1 = keras.layers.Dropout(0.5)
@@ -451,7 +959,7 @@ class CustomModel(tf.keras.Model):
         self.outputs = keras.layers.Dense(num_classes, activation="softmax")
 
     def call(self, inputs):
-        x = self.embedding(inputs)
+        x = inputs if self.precomputed_embeddings else self.embedding(inputs)
         x = self.dense1(x)
         x = self.dropout1(x)
         x = self.dense2(x)
@@ -460,10 +968,11 @@ class CustomModel(tf.keras.Model):
         return x
 
 # Create an instance of the custom model
-model = CustomModel(input_shape=(51), num_classes=len(class_names))
+model = CustomModel(input_shape=(51), num_classes=len(class_names),
+                    precomputed_embeddings=TRAIN_ON_EMBEDDINGS)
 
 # Display a clean model summary without custom TensorFlow operations
-model.build(input_shape=(None, 51))
+model.build(input_shape=(None, X.shape[1]))
 model.summary()
 
 # Compile the model
@@ -485,11 +994,12 @@ earlystopping = keras.callbacks.EarlyStopping(monitor='val_accuracy',
                                               patience=20)
 
 # Start training
-history = model.fit(X_train, y_train,
-                    epochs=200,
-                    batch_size=16,
-                    validation_data=(X_val, y_val),
-                    callbacks=[checkpoint, earlystopping])
+with metrics.timer('train', len(X_train)):
+  history = model.fit(X_train, y_train,
+                      epochs=200,
+                      batch_size=16,
+                      validation_data=(X_val, y_val),
+                      callbacks=[checkpoint, earlystopping])
 
 # Save the model in the SavedModel format
 model.save("custom_model_saved_model")
@@ -645,9 +1155,32 @@ for i, id_in_df in enumerate(false_predict):
   plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
 plt.show()
 
-converter = tf.lite.TFLiteConverter.from_keras_model(model)
-converter.optimizations = [tf.lite.Optimize.DEFAULT]
-tflite_model = converter.convert()
+def convert_classifier(model, mode='dynamic', representative_data=None):
+  """Converts the classifier to a TFLite model.
+
+  `mode` picks the quantization:
+    * 'dynamic': int8 weights, float activations.
+    * 'int8': full-integer model with int8 inputs and outputs. Activation
+      ranges are calibrated on the `representative_data` rows.
+    * 'float16': float16 weights.
+  """
+  converter = tf.lite.TFLiteConverter.from_keras_model(model)
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  if mode == 'int8':
+    def representative_dataset():
+      for row in np.asarray(representative_data, dtype=np.float32):
+        yield [row[np.newaxis]]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+  elif mode == 'float16':
+    converter.target_spec.supported_types = [tf.float16]
+  elif mode != 'dynamic':
+    raise ValueError('Unknown quantization mode: {}'.format(mode))
+  return converter.convert()
+
+tflite_model = convert_classifier(model)
 
 print('Model size: %dKB' % (len(tflite_model) / 1024))
 
@@ -657,37 +1190,170 @@ with open('pose_classifier.tflite', 'wb') as f:
 with open('pose_labels.txt', 'w') as f:
   f.write('\n'.join(class_names))
 
-def evaluate_model(interpreter, X, y_true):
-  """Evaluates the given TFLite model and return its accuracy."""
-  input_index = interpreter.get_input_details()[0]["index"]
-  output_index = interpreter.get_output_details()[0]["index"]
+# Outcome of `evaluate_model`. Latencies are in milliseconds per interpreter
+# invocation, which covers `batch_size` rows when the evaluation is batched.
+EvaluationResult = collections.namedtuple(
+    'EvaluationResult',
+    ['accuracy', 'rows_per_second', 'latency_p50', 'latency_p99', 'batch_size'])
 
-  # Run predictions on all given poses.
-  y_pred = []
-  for i in range(len(y_true)):
-    # Pre-processing: add batch dimension and convert to float32 to match with
-    # the model's input data format.
-    test_image = X[i: i + 1].astype('float32')
-    interpreter.set_tensor(input_index, test_image)
+def quantize_classifier_input(input_details, inputs):
+  """Converts float32 rows to the input type of a TFLite classifier.
 
-    # Run inference.
+  Full-integer models take int8 rows, quantized with the scale and zero point
+  of their input tensor. Float models take the rows unchanged.
+  """
+  inputs = np.asarray(inputs, dtype=np.float32)
+  if input_details['dtype'] != np.int8:
+    return inputs
+  scale, zero_point = input_details['quantization']
+  return np.clip(np.round(inputs / scale + zero_point), -128,
+                 127).astype(np.int8)
+
+def dequantize_classifier_output(output_details, outputs):
+  """Converts TFLite classifier outputs back to float32 probabilities."""
+  if output_details['dtype'] != np.int8:
+    return outputs
+  scale, zero_point = output_details['quantization']
+  return (outputs.astype(np.float32) - zero_point) * scale
+
+def _run_classifier(interpreter, input_index, output_index, inputs):
+  """Runs one interpreter invocation, returning (predictions, latency in ms)."""
+  start_time = time.perf_counter()
+  with metrics.timer('classify', len(inputs)):
+    interpreter.set_tensor(input_index, inputs)
     interpreter.invoke()
-
-    # Post-processing: remove batch dimension and find the class with highest
-    # probability.
-    output = interpreter.tensor(output_index)
-    predicted_label = np.argmax(output()[0])
-    y_pred.append(predicted_label)
+    predictions = np.argmax(interpreter.get_tensor(output_index), axis=1)
+  return predictions, (time.perf_counter() - start_time) * 1000
+
+def evaluate_model(interpreter, X, y_true, batch_size=256, model_content=None,
+                   num_threads=4):
+  """Evaluates the given TFLite model and returns an `EvaluationResult`.
+
+  The interpreter input is resized to `batch_size` rows so that each
+  invocation classifies a whole batch. If the model is fixed at batch 1, rows
+  are classified one at a time instead, spread over `num_threads` threads
+  with an interpreter each when the `model_content` is given. Inputs of
+  full-integer models are quantized up front.
+  """
+  X = np.asarray(X, dtype=np.float32)
+  y_true = np.argmax(y_true, axis=1)
+  input_details = interpreter.get_input_details()[0]
+  input_index = input_details['index']
+  output_index = interpreter.get_output_details()[0]['index']
+  X = quantize_classifier_input(input_details, X)
+
+  batched = input_details['shape_signature'][0] == -1
+  if batched:
+    try:
+      interpreter.resize_tensor_input(input_index, [batch_size, X.shape[1]])
+      interpreter.allocate_tensors()
+    except (ValueError, RuntimeError):
+      batched = False
+      interpreter.resize_tensor_input(input_index, [1, X.shape[1]])
+      interpreter.allocate_tensors()
+
+  start_time = time.perf_counter()
+  if batched:
+    y_pred = []
+    latencies = []
+    for start in range(0, len(X), batch_size):
+      batch = X[start:start + batch_size]
+      rows = len(batch)
+      # Pad the last batch up to the input size
+      if rows < batch_size:
+        batch = np.concatenate(
+            [batch, np.zeros((batch_size - rows, X.shape[1]), X.dtype)])
+      predictions, latency = _run_classifier(interpreter, input_index,
+                                             output_index, batch)
+      y_pred.append(predictions[:rows])
+      latencies.append(latency)
+    y_pred = np.concatenate(y_pred) if y_pred else np.zeros(0, np.int64)
+  else:
+    batch_size = 1
+    if model_content is None or num_threads <= 1:
+      outcomes = [_run_classifier(interpreter, input_index, output_index,
+                                  X[i:i + 1])
+                  for i in range(len(X))]
+    else:
+      # An interpreter can't be shared between threads, give each its own
+      local = threading.local()
+      def classify_row(i):
+        if not hasattr(local, 'interpreter'):
+          local.interpreter = tf.lite.Interpreter(model_content=model_content)
+          local.interpreter.allocate_tensors()
+        return _run_classifier(local.interpreter, input_index, output_index,
+                               X[i:i + 1])
+      with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        outcomes = list(executor.map(classify_row, range(len(X))))
+    y_pred = np.array([predictions[0] for predictions, _ in outcomes])
+    latencies = [latency for _, latency in outcomes]
+  elapsed = time.perf_counter() - start_time
 
   # Compare prediction results with ground truth labels to calculate accuracy.
-  y_pred = keras.utils.to_categorical(y_pred)
-  return accuracy_score(y_true, y_pred)
-
-# Evaluate the accuracy of the converted TFLite model
+  p50, p99 = np.percentile(latencies, [50, 99]) if latencies else (0.0, 0.0)
+  return EvaluationResult(accuracy_score(y_true, y_pred),
+                          len(X) / elapsed if elapsed else 0.0,
+                          p50, p99, batch_size)
+
+def print_evaluation(name, result):
+  """Prints an `EvaluationResult`."""
+  print('%s: accuracy %.4f, %.0f rows/s, latency p50 %.3f ms, p99 %.3f ms '
+        '(batch size %d)' % (name, result.accuracy, result.rows_per_second,
+                             result.latency_p50, result.latency_p99,
+                             result.batch_size))
+
+# Evaluate the converted TFLite model
 classifier_interpreter = tf.lite.Interpreter(model_content=tflite_model)
 classifier_interpreter.allocate_tensors()
-print('Accuracy of TFLite model: %s' %
-      evaluate_model(classifier_interpreter, X_test, y_test))
+print_evaluation('TFLite model',
+                 evaluate_model(classifier_interpreter, X_test, y_test,
+                                model_content=tflite_model))
+
+# Export the pipeline metrics recorded since preprocessing started
+metrics.write('metrics.prom', 'metrics.json')
+
+def compare_classifier_variants(model, X_train, X_test, y_test,
+                                modes=('dynamic', 'int8', 'float16'),
+                                representative_count=200,
+                                report_path='tflite_variants_report.csv'):
+  """Exports the classifier in each quantization mode and compares them.
+
+  Each variant is written to `pose_classifier_<mode>.tflite`. The report holds
+  its size, test accuracy and single-row latency, and the error of any
+  variant that failed to convert. The int8 variant is calibrated on
+  `representative_count` random training rows.
+  """
+  X_train = np.asarray(X_train, dtype=np.float32)
+  rng = np.random.default_rng(42)
+  representative_data = X_train[rng.permutation(len(X_train))[
+      :representative_count]]
+
+  report = []
+  for mode in modes:
+    try:
+      variant = convert_classifier(model, mode, representative_data)
+    except Exception as e:
+      report.append({'mode': mode, 'error': str(e)})
+      continue
+    with open('pose_classifier_%s.tflite' % mode, 'wb') as f:
+      f.write(variant)
+
+    interpreter = tf.lite.Interpreter(model_content=variant)
+    interpreter.allocate_tensors()
+    result = evaluate_model(interpreter, X_test, y_test, batch_size=1)
+    report.append({'mode': mode,
+                   'size_kb': len(variant) / 1024,
+                   'accuracy': result.accuracy,
+                   'latency_p50_ms': result.latency_p50,
+                   'latency_p99_ms': result.latency_p99})
+
+  report = pd.DataFrame(report)
+  report.to_csv(report_path, index=False)
+  return report
+
+# Compare the quantized variants to pick the cheapest one that is accurate
+# enough for the target device
+print(compare_classifier_variants(model, X_train, X_test, y_test))
 
 !zip pose_classifier.zip pose_labels.txt pose_classifier.tflite
 
@@ -698,14 +1364,695 @@ try:
 except:
   pass
 
-model1 = model.load_weights
+"""#Video"""
 
-model1 = model.load_weights("/content/pose_classifier.tflite")
-img = ["/content/stand (285).jpg"]
-pred=model1.predict(img)
+class PoseClassifier(object):
+  """Classifies single poses with the trained Keras model or TFLite model.
 
-# Step 5: Interpret the Output
-# Interpret predictions based on your problem (classification, regression, etc.)
+  `model` is a Keras model, the TFLite model content or a .tflite file path.
+  """
 
-# Step 6: Evaluate Model Performance (Optional)
-# If you have ground truth labels, evaluate model performance
\ No newline at end of file
+  def __init__(self, model, class_names):
+    self.class_names = list(class_names)
+    self._keras_model = None
+    if isinstance(model, keras.Model):
+      self._keras_model = model
+      self._embedding_inputs = getattr(model, 'precomputed_embeddings', False)
+      return
+    if isinstance(model, bytes):
+      self._interpreter = tf.lite.Interpreter(model_content=model)
+    else:
+      self._interpreter = tf.lite.Interpreter(model_path=model)
+    self._interpreter.allocate_tensors()
+    self._input_details = self._interpreter.get_input_details()[0]
+    self._output_details = self._interpreter.get_output_details()[0]
+    # Models trained on embeddings take (x, y) pairs rather than triples
+    self._embedding_inputs = (
+        self._input_details['shape'][-1] == len(BodyPart) * 2)
+
+  def classify(self, landmarks):
+    """Returns the class probabilities of a (17, 3) landmark array."""
+    inputs = landmarks.astype(np.float32).reshape(1, -1)
+    if self._embedding_inputs:
+      inputs = pose_embeddings(inputs)
+    with metrics.timer('classify'):
+      if self._keras_model is not None:
+        return self._keras_model(inputs, training=False).numpy()[0]
+      self._interpreter.set_tensor(
+          self._input_details['index'],
+          quantize_classifier_input(self._input_details, inputs))
+      self._interpreter.invoke()
+      return dequantize_classifier_output(
+          self._output_details,
+          self._interpreter.get_tensor(self._output_details['index']))[0]
+
+def read_frames(source):
+  """Yields (frame index, timestamp in seconds, RGB frame) from a video.
+
+  `source` is a video file path or the index of a capture device. Video files
+  are timestamped with their own clock, capture devices with the time since
+  the first frame.
+  """
+  capture = cv2.VideoCapture(source)
+  if not capture.isOpened():
+    raise IOError('Could not open video source {!r}'.format(source))
+  live = isinstance(source, int)
+  start_time = time.monotonic()
+  try:
+    frame_index = 0
+    while True:
+      ok, frame = capture.read()
+      if not ok:
+        break
+      if live:
+        timestamp = time.monotonic() - start_time
+      else:
+        timestamp = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+      yield frame_index, timestamp, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+      frame_index += 1
+  finally:
+    capture.release()
+
+# Label of one video frame. `label` and `confidence` are None when no pose was
+# confidently detected in the frame. `detected` tells whether MoveNet ran on
+# the frame or its keypoints were carried over from earlier frames.
+FrameLabel = collections.namedtuple(
+    'FrameLabel',
+    ['frame_index', 'timestamp', 'label', 'confidence', 'detected'])
+
+# Size of the grayscale thumbnails that frame motion is measured on
+_MOTION_THUMBNAIL_SIZE = (64, 36)
+
+def classify_stream(source, classifier, detection_threshold=0.3,
+                    model_name='movenet_thunder', keyframe_interval=1,
+                    motion_threshold=None, landmark_filter=None):
+  """Classifies the pose in every frame of a video or capture device.
+
+  A private MoveNet model tracks the person across frames: only the first
+  frame is run from the full image, later frames reuse the crop region found
+  in the previous one, so each frame takes a single MoveNet pass instead of
+  the three `detect` uses on still images. MoveNet falls back to the full
+  image by itself once the torso is lost.
+
+  With `keyframe_interval` > 1, MoveNet only runs on every
+  `keyframe_interval`-th frame. If `motion_threshold` is set, it also runs as
+  soon as the frame differs from the last detected one by more than the
+  threshold, as the mean absolute difference of 0-255 gray levels. Frames in
+  between reuse the keypoints of the last detection, extrapolated by
+  `landmark_filter` if a `OneEuroFilter` is given. The filter also smooths
+  the detected keypoints.
+
+  Yields a `FrameLabel` per frame.
+  """
+  tracker = Movenet(model_name)
+  landmarks = None
+  keyframe_thumbnail = None
+  frames_since_keyframe = 0
+  for frame_index, timestamp, frame in read_frames(source):
+    thumbnail = None
+    if motion_threshold is not None:
+      thumbnail = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY),
+                             _MOTION_THUMBNAIL_SIZE,
+                             interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    detected = (landmarks is None or
+                frames_since_keyframe + 1 >= keyframe_interval or
+                (thumbnail is not None and
+                 np.mean(np.abs(thumbnail - keyframe_thumbnail)) >
+                 motion_threshold))
+    if detected:
+      person = tracker.detect(frame, reset_crop_region=frame_index == 0)
+      landmarks = np.array(
+          [[keypoint.coordinate.x, keypoint.coordinate.y, keypoint.score]
+           for keypoint in person.keypoints], dtype=np.float32)
+      if landmark_filter is not None:
+        landmarks = landmark_filter(landmarks, timestamp)
+      keyframe_thumbnail = thumbnail
+      frames_since_keyframe = 0
+    else:
+      frames_since_keyframe += 1
+      if landmark_filter is not None:
+        landmarks = landmark_filter.predict(timestamp)
+
+    if np.min(landmarks[:, 2]) < detection_threshold:
+      yield FrameLabel(frame_index, timestamp, None, None, detected)
+      continue
+
+    probabilities = classifier.classify(landmarks)
+    class_index = int(np.argmax(probabilities))
+    yield FrameLabel(frame_index, timestamp, classifier.class_names[class_index],
+                     float(probabilities[class_index]), detected)
+
+# Classify the gallery walkthrough footage frame by frame
+video_path = '/content/drive/MyDrive/final project/walkthrough.mp4'
+if os.path.exists(video_path):
+  pose_classifier = PoseClassifier(tflite_model, class_names)
+  start_time = time.monotonic()
+  frame_labels = pd.DataFrame(classify_stream(
+      video_path, pose_classifier, keyframe_interval=5, motion_threshold=8.0,
+      landmark_filter=OneEuroFilter()))
+  print('Classified %d frames at %.1f fps, detector duty cycle %.0f%%' %
+        (len(frame_labels), len(frame_labels) / (time.monotonic() - start_time),
+         100 * frame_labels['detected'].mean()))
+  frame_labels.to_csv('video_labels.csv', index=False)
+
+"""#Multi-person"""
+
+def _figures_header(class_names=None):
+  """Column names of the figure rows written by `extract_figures`."""
+  header_name = ['file_name', 'figure', 'bbox_x_min', 'bbox_y_min',
+                 'bbox_x_max', 'bbox_y_max', 'figure_score']
+  for bodypart in BodyPart:
+    header_name += [bodypart.name + '_x', bodypart.name + '_y',
+                    bodypart.name + '_score']
+  if class_names is not None:
+    header_name += ['class_name', 'class_score']
+  return header_name
+
+def extract_figures(images_in_folder, csv_out_path, classifier=None,
+                    score_threshold=0.2, images_out_folder=None):
+  """Detects every figure in the images of a folder with MoveNet MultiPose.
+
+  Each image takes a single MultiPose inference, no matter how many figures
+  it holds. One row per figure is written to `csv_out_path`, with the figure
+  index from left to right, its pixel bounding box and score, and its
+  landmarks laid out like the rows of `MoveNetPreprocessor`. If a
+  `PoseClassifier` is given, each figure is classified and its class and
+  probability are added to the row. Overlays with all figures are written to
+  `images_out_folder` if it is set.
+
+  Returns the rows as a dataframe.
+  """
+  detector = get_multipose_movenet()
+  if images_out_folder is not None:
+    os.makedirs(images_out_folder, exist_ok=True)
+
+  rows = []
+  messages = []
+  image_names = sorted(
+      n for n in os.listdir(images_in_folder)
+      if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS)
+  for image_name in tqdm.tqdm(image_names):
+    image_path = os.path.join(images_in_folder, image_name)
+    with metrics.timer('ingest'):
+      _, image, reason = ingest_image(image_path)
+    if image is None:
+      messages.append(skipped_message(image_path, reason))
+      continue
+
+    image = image.numpy()
+    figures = detector.detect(image, score_threshold)
+    metrics.count('figures', len(figures))
+    if not figures:
+      messages.append('Skipped ' + image_path + '. No figure was detected.')
+      continue
+
+    for figure_index, figure in enumerate(figures):
+      row = [image_name, figure_index] + list(figure.bounding_box)
+      row += [figure.score] + figure.landmarks.flatten().tolist()
+      if classifier is not None:
+        probabilities = classifier.classify(figure.landmarks)
+        class_index = int(np.argmax(probabilities))
+        row += [classifier.class_names[class_index],
+                float(probabilities[class_index])]
+      rows.append(row)
+
+    if images_out_folder is not None:
+      with metrics.timer('overlay'):
+        output_frame = skeleton_renderer.render(
+            image, np.stack([figure.landmarks for figure in figures]),
+            cv2.COLOR_RGB2BGR)
+        write_image(os.path.join(images_out_folder, image_name), output_frame)
+
+  print('\n'.join(messages))
+  figures_df = pd.DataFrame(rows, columns=_figures_header(
+      classifier.class_names if classifier is not None else None))
+  figures_df.to_csv(csv_out_path, index=False)
+  return figures_df
+
+# Classify every figure of the temple panel photos
+panels_folder = '/content/drive/MyDrive/final project/panels'
+if os.path.isdir(panels_folder):
+  panel_figures = extract_figures(
+      panels_folder, 'panel_figures.csv',
+      classifier=PoseClassifier(tflite_model, class_names),
+      images_out_folder='panel_figures_out')
+  print('Found %d figures in %d panels' %
+        (len(panel_figures), panel_figures['file_name'].nunique()))
+
+"""#Benchmark"""
+
+class StageTimer(object):
+  """Collects the wall time of named pipeline stages.
+
+  Use `with timer.stage(name, items):` around one run of a stage, where
+  `items` is the number of images or rows that run handled.
+  """
+
+  def __init__(self):
+    self._durations = collections.defaultdict(list)
+    self._items = collections.Counter()
+
+  @contextlib.contextmanager
+  def stage(self, name, items=1):
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      self._durations[name].append(time.perf_counter() - start_time)
+      self._items[name] += items
+
+  def summary(self):
+    """Returns the throughput and latency percentiles of every stage."""
+    summary = {}
+    for name, durations in self._durations.items():
+      total = sum(durations)
+      p50, p90, p99 = np.percentile(durations, [50, 90, 99]) * 1000
+      summary[name] = {'runs': len(durations),
+                       'items': self._items[name],
+                       'total_seconds': total,
+                       'items_per_second': (self._items[name] / total
+                                            if total else 0.0),
+                       'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99}
+    return summary
+
+def benchmark_image_paths(image_folders, limit=None):
+  """Lists the images in the given folders and their subfolders.
+
+  Raises a ValueError if a folder doesn't exist or if none of them holds any
+  images, so that a benchmark never silently measures nothing. Folders
+  without images, such as the Dataset2 placeholder, are reported and skipped.
+  """
+  image_paths = []
+  for image_folder in image_folders:
+    if not os.path.isdir(image_folder):
+      raise ValueError('Benchmark folder {} does not exist.'.format(
+          image_folder))
+    folder_image_paths = []
+    for dirpath, dirnames, filenames in os.walk(image_folder):
+      dirnames.sort()
+      folder_image_paths += [os.path.join(dirpath, filename)
+                             for filename in sorted(filenames)
+                             if os.path.splitext(filename)[1].lower()
+                             in IMAGE_EXTENSIONS]
+    if not folder_image_paths:
+      print('Benchmark folder {} holds no images, skipping it.'.format(
+          image_folder), file=sys.stderr)
+    image_paths += folder_image_paths
+  if not image_paths:
+    raise ValueError('None of the benchmark folders {} holds images.'.format(
+        ', '.join(image_folders)))
+  return image_paths[:limit]
+
+def compare_benchmark(results, baseline_path, tolerance=0.2):
+  """Checks benchmark results against a stored baseline.
+
+  Returns a message for every stage whose p50 latency grew, or whose
+  throughput dropped, by more than `tolerance` relative to the baseline.
+  """
+  with open(baseline_path) as baseline_file:
+    baseline = json.load(baseline_file)
+  regressions = []
+  for name, stage in baseline['stages'].items():
+    current = results['stages'].get(name)
+    if current is None:
+      continue
+    if current['p50_ms'] > stage['p50_ms'] * (1 + tolerance):
+      regressions.append('{}: p50 {:.3f} ms vs {:.3f} ms'.format(
+          name, current['p50_ms'], stage['p50_ms']))
+    if current['items_per_second'] < stage['items_per_second'] * (1 - tolerance):
+      regressions.append('{}: {:.1f} items/s vs {:.1f} items/s'.format(
+          name, current['items_per_second'], stage['items_per_second']))
+  return regressions
+
+def benchmark_pipeline(image_folders, classifier_model=None, limit=None,
+                       inference_count=3,
+                       results_path='benchmark_movenet.json',
+                       baseline_path=None, tolerance=0.2):
+  """Times each stage of the MoveNet pipeline over the given image folders.
+
+  The stages are file read, decode, each MoveNet pass, overlay rendering,
+  image write, landmark row write, merge into a CSV, embedding and, if a
+  `classifier_model` for `PoseClassifier` is given, classifier inference.
+  Outputs go to a temp dir. The results are written as JSON to
+  `results_path`. If `baseline_path` is given, a RuntimeError is raised when
+  a stage regressed by more than `tolerance`, see `compare_benchmark`.
+  """
+  timer = StageTimer()
+  image_paths = benchmark_image_paths(image_folders, limit)
+  output_folder = tempfile.mkdtemp()
+  landmarks_out_prefix = os.path.join(output_folder, 'landmarks')
+  start_time = time.perf_counter()
+
+  with LandmarkRowWriter(landmarks_out_prefix) as landmarks_out_writer:
+    for image_index, image_path in enumerate(image_paths):
+      with timer.stage('read'):
+        contents = tf.io.read_file(image_path).numpy()
+      with timer.stage('decode'):
+        image, _ = decode_image(contents)
+      if image is None:
+        continue
+      image = image.numpy()
+
+      for pass_index in range(inference_count):
+        with timer.stage('detect_pass_{}'.format(pass_index + 1)):
+          person = movenet_pipeline.movenet.detect(
+              image, reset_crop_region=pass_index == 0)
+      pose_landmarks = np.array(
+          [[keypoint.coordinate.x, keypoint.coordinate.y, keypoint.score]
+           for keypoint in person.keypoints], dtype=np.float32)
+
+      with timer.stage('render'):
+        output_frame = skeleton_renderer.render(image, pose_landmarks,
+                                                cv2.COLOR_RGB2BGR)
+      with timer.stage('write_image'):
+        write_image(os.path.join(output_folder, '{}.jpg'.format(image_index)),
+                    output_frame)
+      with timer.stage('write_row'):
+        landmarks_out_writer.writerow(os.path.basename(image_path),
+                                      pose_landmarks)
+
+  image_names, landmarks = read_landmark_rows(landmarks_out_prefix,
+                                              len(BodyPart) * 3)
+  with timer.stage('merge', len(landmarks)):
+    header_name = ['file_name'] + [
+        bodypart.name + suffix for bodypart in BodyPart
+        for suffix in ('_x', '_y', '_score')]
+    merged_df = pd.DataFrame(landmarks, columns=header_name[1:])
+    merged_df.insert(0, 'file_name', image_names)
+    merged_df.to_csv(os.path.join(output_folder, 'landmarks.csv'), index=False)
+
+  # Nothing is left to embed or classify if no image could be decoded
+  if len(landmarks):
+    with timer.stage('embedding', len(landmarks)):
+      pose_embeddings(landmarks)
+
+  if classifier_model is not None and len(landmarks):
+    # Only the probabilities are timed, so no class names are needed
+    classifier = PoseClassifier(classifier_model, class_names=())
+    for pose_landmarks in landmarks:
+      with timer.stage('classify'):
+        classifier.classify(pose_landmarks)
+
+  results = {'backend': 'movenet',
+             'image_folders': list(image_folders),
+             'images': len(image_paths),
+             'kept_images': len(landmarks),
+             'total_seconds': time.perf_counter() - start_time,
+             'stages': timer.summary()}
+  with open(results_path, 'w') as results_file:
+    json.dump(results, results_file, indent=2)
+
+  if baseline_path is not None and os.path.exists(baseline_path):
+    regressions = compare_benchmark(results, baseline_path, tolerance)
+    if regressions:
+      raise RuntimeError('Benchmark regressed against {}:\n{}'.format(
+          baseline_path, '\n'.join(regressions)))
+  return results
+
+# Benchmark the pipeline on the images bundled with the repository checkout.
+# Copy a run's results to the baseline file to make it the reference for later
+# runs.
+BENCHMARK_IMAGE_FOLDERS = [
+    os.path.join(REPO_PATH, folder)
+    for folder in ('Dataset', 'Dataset1', 'Dataset2')]
+benchmark_results = benchmark_pipeline(
+    BENCHMARK_IMAGE_FOLDERS,
+    classifier_model=tflite_model,
+    baseline_path='benchmark_movenet_baseline.json')
+for stage_name, stage in benchmark_results['stages'].items():
+  print('%-14s %8.1f items/s  p50 %8.3f ms  p99 %8.3f ms' %
+        (stage_name, stage['items_per_second'], stage['p50_ms'],
+         stage['p99_ms']))
+
+"""#Serving"""
+
+class TFLiteBatchClassifier(object):
+  """Runs the TFLite pose classifier on batches of input rows.
+
+  The interpreter input is resized to `max_batch_size` rows once, and smaller
+  batches are padded. Models fixed at batch 1 classify one row at a time.
+  Not thread-safe, calls have to come from a single thread.
+  """
+
+  def __init__(self, model_path, max_batch_size=64):
+    self._interpreter = tf.lite.Interpreter(model_path=model_path)
+    input_details = self._interpreter.get_input_details()[0]
+    self._input_details = input_details
+    self._output_details = self._interpreter.get_output_details()[0]
+    self._input_index = input_details['index']
+    self.input_size = int(input_details['shape'][-1])
+
+    self._batch_size = 1
+    if input_details['shape_signature'][0] == -1:
+      try:
+        self._interpreter.resize_tensor_input(
+            self._input_index, [max_batch_size, self.input_size])
+        self._interpreter.allocate_tensors()
+        self._batch_size = max_batch_size
+      except (ValueError, RuntimeError):
+        self._interpreter.resize_tensor_input(self._input_index,
+                                              [1, self.input_size])
+    self._interpreter.allocate_tensors()
+
+  def __call__(self, rows):
+    """Returns the class probabilities of a (rows, input_size) array."""
+    probabilities = []
+    rows = quantize_classifier_input(self._input_details, rows)
+    for start in range(0, len(rows), self._batch_size):
+      batch = rows[start:start + self._batch_size]
+      row_count = len(batch)
+      if row_count < self._batch_size:
+        batch = np.concatenate([batch, np.zeros(
+            (self._batch_size - row_count, self.input_size), rows.dtype)])
+      with metrics.timer('classify', row_count):
+        self._interpreter.set_tensor(self._input_index, batch)
+        self._interpreter.invoke()
+        probabilities.append(dequantize_classifier_output(
+            self._output_details,
+            self._interpreter.get_tensor(
+                self._output_details['index'])[:row_count]))
+    return np.concatenate(probabilities)
+
+def movenet_extractor(detection_threshold=0.3, inference_count=3,
+                      model_name='movenet_thunder', max_long_side=None):
+  """Returns a function that detects the MoveNet landmarks in image bytes.
+
+  Pass the settings the training landmarks were made with, e.g. those
+  returned by `MoveNetPreprocessor.process`, so that served images are
+  processed the same way: the `model_name` variant with `inference_count`
+  passes, on images scaled down to `max_long_side` if that is set.
+
+  The function returns the flat 51 [x, y, score] values in original image
+  pixels, and raises a ValueError if the image is invalid or no pose is
+  confidently detected. Detections are serialized since they share the
+  global MoveNet model.
+  """
+  lock = threading.Lock()
+
+  def extract(contents):
+    image, reason = decode_image(contents, max_long_side)
+    if image is None:
+      raise ValueError(skipped_message('image', reason))
+    with lock:
+      use_movenet(model_name)
+      person = detect(image, inference_count)
+    landmarks = _person_landmarks(person)
+    if max_long_side is not None:
+      landmarks *= _landmark_scale(contents, image)
+    if np.min(landmarks[:, 2]) < detection_threshold:
+      raise ValueError('No pose was confidently detected.')
+    return landmarks.reshape(-1)
+
+  return extract
+
+class PoseClassificationService(object):
+  """Classifies poses sent over HTTP with the exported TFLite classifier.
+
+  Endpoints:
+    * POST /classify: a JSON body {"landmarks": [...]} with one or more rows
+      of 51 MoveNet or 99 MediaPipe landmark values, or an image body, which
+      needs an `extractor` such as `movenet_extractor()`. Returns the label,
+      confidence and class probabilities of each pose.
+    * GET /healthz: liveness check.
+    * GET /metrics: request, batch and latency counters as JSON.
+
+  Requests from concurrent connections are classified together in
+  micro-batches, see `MicroBatcher`.
+  """
+
+  def __init__(self, model_path='pose_classifier.tflite',
+               labels_path='pose_labels.txt', extractor=None,
+               max_batch_size=64, max_wait_ms=5):
+    with open(labels_path) as labels_file:
+      self.class_names = labels_file.read().splitlines()
+    self._classifier = TFLiteBatchClassifier(model_path, max_batch_size)
+    self._batcher = MicroBatcher(self._classifier, max_batch_size,
+                                 max_wait_ms)
+    self._extractor = extractor
+    self._start_time = time.monotonic()
+    self._lock = threading.Lock()
+    self._request_count = 0
+    self._error_count = 0
+    self._latencies = collections.deque(maxlen=1000)
+    self._server = None
+
+  def _model_inputs(self, landmark_rows):
+    """Turns landmark rows into the inputs the classifier was trained on."""
+    row_size = landmark_rows.shape[1]
+    if row_size not in (len(BodyPart) * 3, 33 * 3):
+      raise ValueError('Expected rows of 51 or 99 landmark values, got '
+                       '{}.'.format(row_size))
+    if self._classifier.input_size == row_size:
+      return landmark_rows
+    if self._classifier.input_size == row_size // 3 * 2:
+      if row_size == len(BodyPart) * 3:
+        return pose_embeddings(landmark_rows)
+      return pose_embeddings(landmark_rows, hips=MEDIAPIPE_HIPS,
+                             shoulders=MEDIAPIPE_SHOULDERS)
+    raise ValueError('The classifier takes {} inputs, not {} landmark '
+                     'values.'.format(self._classifier.input_size, row_size))
+
+  def classify(self, content_type, body):
+    """Classifies the poses of a request body.
+
+    Raises a ValueError if the request is invalid, or a RuntimeError if the
+    classifier failed on it.
+    """
+    start_time = time.perf_counter()
+    try:
+      if content_type == 'application/json':
+        try:
+          landmarks = json.loads(body)['landmarks']
+          landmark_rows = np.array(landmarks, dtype=np.float32)
+        except (ValueError, KeyError, TypeError):
+          raise ValueError('Expected a JSON object with a "landmarks" list.')
+      elif self._extractor is not None:
+        landmark_rows = self._extractor(body)
+      else:
+        raise ValueError('Image requests need a landmark extractor.')
+      if landmark_rows.ndim == 1:
+        landmark_rows = landmark_rows[np.newaxis]
+      if landmark_rows.ndim != 2 or not len(landmark_rows):
+        raise ValueError('Expected one or more rows of landmark values.')
+      model_inputs = self._model_inputs(landmark_rows)
+    except ValueError:
+      with self._lock:
+        self._request_count += 1
+        self._error_count += 1
+      raise
+
+    # Failures of the classifier itself are server errors, not bad requests
+    try:
+      probabilities = self._batcher.submit(model_inputs).result()
+    except Exception as e:
+      with self._lock:
+        self._request_count += 1
+        self._error_count += 1
+      raise RuntimeError('Classification failed: {}'.format(e)) from e
+
+    predictions = []
+    for row_probabilities in probabilities:
+      class_index = int(np.argmax(row_probabilities))
+      predictions.append({
+          'label': self.class_names[class_index],
+          'confidence': float(row_probabilities[class_index]),
+          'probabilities': dict(zip(self.class_names,
+                                    row_probabilities.tolist()))})
+    with self._lock:
+      self._request_count += 1
+      self._latencies.append((time.perf_counter() - start_time) * 1000)
+    return predictions
+
+  def metrics(self):
+    """Returns the service counters and recent request latencies."""
+    with self._lock:
+      latencies = list(self._latencies)
+      stats = {'uptime_seconds': time.monotonic() - self._start_time,
+               'requests': self._request_count,
+               'errors': self._error_count}
+    batch_count = self._batcher.batch_count
+    stats.update(
+        batches=batch_count,
+        rows=self._batcher.row_count,
+        mean_batch_rows=(self._batcher.row_count / batch_count
+                         if batch_count else 0.0))
+    if latencies:
+      p50, p99 = np.percentile(latencies, [50, 99])
+      stats.update(latency_p50_ms=p50, latency_p99_ms=p99)
+    return stats
+
+  def serve(self, host='127.0.0.1', port=8000):
+    """Starts serving on a background thread and returns the HTTP server."""
+    self._server = http.server.ThreadingHTTPServer((host, port),
+                                                   _PoseRequestHandler)
+    self._server.service = self
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    return self._server
+
+  def close(self):
+    """Stops the HTTP server and the micro-batcher."""
+    if self._server is not None:
+      self._server.shutdown()
+      self._server.server_close()
+    self._batcher.close()
+
+class _PoseRequestHandler(http.server.BaseHTTPRequestHandler):
+  """HTTP front end of `PoseClassificationService`."""
+
+  def _send_json(self, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path == '/healthz':
+      self._send_json(200, {'status': 'ok'})
+    elif self.path == '/metrics':
+      self._send_json(200, self.server.service.metrics())
+    else:
+      self._send_json(404, {'error': 'Not found.'})
+
+  def do_POST(self):
+    if self.path != '/classify':
+      self._send_json(404, {'error': 'Not found.'})
+      return
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    try:
+      predictions = self.server.service.classify(
+          self.headers.get_content_type(), body)
+    except ValueError as e:
+      self._send_json(400, {'error': str(e)})
+      return
+    except Exception as e:
+      self._send_json(500, {'error': str(e)})
+      return
+    self._send_json(200, {'predictions': predictions})
+
+  def log_message(self, format, *args):
+    # Keep request logs out of the notebook output
+    pass
+
+# Serve the exported classifier, with MoveNet set up like for the training
+# landmarks for image requests
+pose_service = PoseClassificationService(
+    'pose_classifier.tflite', 'pose_labels.txt',
+    extractor=movenet_extractor(
+        detection_threshold=train_settings['detection_threshold'],
+        inference_count=train_settings['inference_count'],
+        model_name=(train_settings['model']
+                    if train_settings['model'] in MOVENET_INPUT_SIZES
+                    else 'movenet_thunder'),
+        max_long_side=train_settings.get('max_long_side')))
+pose_service.serve(port=8000)
+
+# Classify a test image through the service
+sample_image_path = benchmark_image_paths([images_in_test_folder], limit=1)[0]
+with open(sample_image_path, 'rb') as f:
+  request = urllib.request.Request('http://127.0.0.1:8000/classify',
+                                   data=f.read(),
+                                   headers={'Content-Type': 'image/jpeg'})
+print(json.loads(urllib.request.urlopen(request).read()))
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The pipeline modules are imported from their folders, as the notebooks do
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('movenet', 'mediapipe'):
+    sys.path.append(os.path.join(REPO_PATH, folder))
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('mediapipe.python.solutions.pose')
+
+from mediapipe_pipeline import (
+    AsyncWriter, ImageHeader, LandmarkCache, ingest_image, pose_embeddings, read_image_header)
+
+
+def _encode(extension, image):
+    ok, encoded = cv2.imencode(extension, image)
+    assert ok
+    return encoded.tobytes()
+
+
+def test_read_image_header():
+    image = np.zeros((48, 64, 3), np.uint8)
+    assert read_image_header(_encode('.jpg', image)) == ImageHeader('jpeg', 64, 48)
+    assert read_image_header(_encode('.png', image)) == ImageHeader('png', 64, 48)
+    assert read_image_header(_encode('.jpg', image)[:20]) is None
+    assert read_image_header(b'GIF89a' + bytes(32)) is None
+
+
+def test_ingest_image_keeps_the_original_size(tmp_path):
+    image_path = str(tmp_path / 'pose.jpg')
+    with open(image_path, 'wb') as image_file:
+        image_file.write(_encode('.jpg', np.zeros((480, 640, 3), np.uint8)))
+
+    contents, image, original_size = ingest_image(image_path)
+    assert image.shape == (480, 640, 3)
+    assert original_size == (640, 480)
+
+    # JPEG files are decoded at a reduced scale, then resized to the long side
+    _, image, original_size = ingest_image(image_path, max_long_side=200)
+    assert image.shape == (150, 200, 3)
+    assert original_size == (640, 480)
+
+
+def test_ingest_image_of_an_unreadable_file(tmp_path):
+    assert ingest_image(str(tmp_path / 'missing.jpg')) == (None, None, None)
+    image_path = str(tmp_path / 'broken.jpg')
+    with open(image_path, 'wb') as image_file:
+        image_file.write(b'not an image')
+    assert ingest_image(image_path) == (b'not an image', None, None)
+
+
+def test_pose_embeddings_center_hips_of_mediapipe_layout():
+    rows = np.random.default_rng(0).uniform(0, 640, (3, 99))
+    embeddings = pose_embeddings(rows)
+    assert embeddings.shape == (3, 66)
+    points = embeddings.reshape(3, 33, 2)
+    np.testing.assert_allclose(points[:, 23] + points[:, 24], 0, atol=1e-6)
+    assert np.max(np.linalg.norm(points, axis=2)) <= 1 + 1e-6
+
+
+def test_pose_embeddings_match_the_movenet_pipeline():
+    movenet_pipeline = pytest.importorskip('movenet_pipeline')
+    rows = np.random.default_rng(1).uniform(0, 640, (4, 99))
+    np.testing.assert_allclose(
+        pose_embeddings(rows),
+        movenet_pipeline.pose_embeddings(rows, hips=movenet_pipeline.MEDIAPIPE_HIPS,
+                                         shoulders=movenet_pipeline.MEDIAPIPE_SHOULDERS))
+
+
+def test_landmark_cache_is_shared_with_movenet(tmp_path):
+    cache = LandmarkCache(str(tmp_path))
+    mediapipe_key = cache.key(b'image', 'mediapipe', 'pose_model_complexity_1', detection_threshold=0.1)
+    movenet_key = cache.key(b'image', 'movenet', 'pose_model_complexity_1', detection_threshold=0.1)
+    assert mediapipe_key != movenet_key
+    landmarks = np.ones((33, 4), np.float32)
+    cache.put(mediapipe_key, landmarks)
+    np.testing.assert_array_equal(cache.get(mediapipe_key), landmarks)
+    assert cache.get(movenet_key) is None
+
+
+def test_async_writer_reraises_the_first_error():
+    def write(value):
+        raise IOError('disk full')
+
+    writer = AsyncWriter(num_threads=2)
+    writer.submit(write, 0)
+    with pytest.raises(RuntimeError) as error:
+        writer.flush()
+    assert isinstance(error.value.__cause__, IOError)
+    writer.close()
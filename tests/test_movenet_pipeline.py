@@ -0,0 +1,403 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('tensorflow')
+
+import movenet_pipeline
+from movenet_pipeline import (
+    AsyncWriter, ImageHeader, LandmarkCache, Metrics, MicroBatcher, ModelChoice,
+    OneEuroFilter, RunManifest, pose_embeddings, read_image_header,
+    read_landmark_rows, select_movenet)
+
+def _encode(extension, image):
+  ok, encoded = cv2.imencode(extension, image)
+  assert ok
+  return encoded.tobytes()
+
+# read_image_header
+
+def test_read_image_header_png():
+  image = np.zeros((5, 7, 3), np.uint8)
+  assert read_image_header(_encode('.png', image)) == ImageHeader(
+      'png', 7, 5, 3)
+  assert read_image_header(_encode('.png', image[:, :, 0])) == ImageHeader(
+      'png', 7, 5, 1)
+
+def test_read_image_header_jpeg():
+  image = np.zeros((48, 64, 3), np.uint8)
+  assert read_image_header(_encode('.jpg', image)) == ImageHeader(
+      'jpeg', 64, 48, 3)
+  assert read_image_header(_encode('.jpg', image[:, :, 0])) == ImageHeader(
+      'jpeg', 64, 48, 1)
+
+def test_read_image_header_malformed():
+  jpeg = _encode('.jpg', np.zeros((48, 64, 3), np.uint8))
+  assert read_image_header(b'') is None
+  assert read_image_header(b'GIF89a' + bytes(32)) is None
+  assert read_image_header(jpeg[:20]) is None
+  # Start of scan before any frame header
+  assert read_image_header(b'\xff\xd8\xff\xda\x00\x02' + bytes(16)) is None
+  png = _encode('.png', np.zeros((5, 7, 3), np.uint8))
+  assert read_image_header(png[:20]) is None
+
+# pose_embeddings
+
+def _random_poses(count, seed=0):
+  rng = np.random.default_rng(seed)
+  landmarks = rng.uniform(0, 256, (count, 17, 3)).astype(np.float32)
+  landmarks[:, :, 2] = rng.uniform(0, 1, (count, 17))
+  return landmarks.reshape(count, -1)
+
+def test_pose_embeddings_center_hips_and_drop_scores():
+  embeddings = pose_embeddings(_random_poses(4))
+  assert embeddings.shape == (4, 34)
+  assert embeddings.dtype == np.float32
+  points = embeddings.reshape(4, 17, 2)
+  hips = movenet_pipeline.MOVENET_HIPS
+  np.testing.assert_allclose((points[:, hips[0]] + points[:, hips[1]]) / 2, 0,
+                             atol=1e-6)
+  assert np.max(np.linalg.norm(points, axis=2)) <= 1 + 1e-6
+
+def test_pose_embeddings_ignore_position_and_scale():
+  rows = _random_poses(3)
+  moved = rows.reshape(3, 17, 3).copy()
+  moved[:, :, :2] = moved[:, :, :2] * 2.5 + [40, -15]
+  moved[:, :, 2] = 0
+  np.testing.assert_allclose(pose_embeddings(moved.reshape(3, -1)),
+                             pose_embeddings(rows), atol=1e-5)
+
+def test_pose_embeddings_of_a_collapsed_pose_are_finite():
+  embeddings = pose_embeddings(np.ones((1, 51), np.float32))
+  np.testing.assert_array_equal(embeddings, 0)
+
+def test_pose_embeddings_with_mediapipe_layout():
+  rows = np.random.default_rng(1).uniform(0, 1, (2, 99))
+  embeddings = pose_embeddings(rows, hips=movenet_pipeline.MEDIAPIPE_HIPS,
+                               shoulders=movenet_pipeline.MEDIAPIPE_SHOULDERS)
+  assert embeddings.shape == (2, 66)
+  points = embeddings.reshape(2, 33, 2)
+  np.testing.assert_allclose(points[:, 23] + points[:, 24], 0, atol=1e-6)
+
+# RunManifest
+
+SETTINGS = {'model': 'movenet_thunder', 'inference_count': 3}
+
+def _write_image(path, contents):
+  with open(path, 'wb') as image_file:
+    image_file.write(contents)
+  return os.stat(path)
+
+def test_run_manifest_round_trip(tmp_path):
+  prefix = str(tmp_path / 'sit')
+  kept_path, skipped_path = str(tmp_path / 'a.jpg'), str(tmp_path / 'b.jpg')
+  kept_stat = _write_image(kept_path, b'kept')
+  skipped_stat = _write_image(skipped_path, b'skipped')
+  landmarks = np.arange(51, dtype=np.float32).reshape(17, 3)
+
+  with RunManifest(prefix, SETTINGS) as manifest:
+    assert manifest.lookup('a.jpg', kept_path, kept_stat) is None
+    manifest.add('a.jpg', kept_stat, 'digest-a', landmarks, None)
+    manifest.add('b.jpg', skipped_stat, 'digest-b', None, 'No pose.')
+
+  with RunManifest(prefix, SETTINGS) as manifest:
+    record = manifest.lookup('a.jpg', kept_path, kept_stat)
+    assert record['outcome'] == 'kept'
+    np.testing.assert_array_equal(record['landmarks'], landmarks)
+    record = manifest.lookup('b.jpg', skipped_path, skipped_stat)
+    assert record['outcome'] == 'skipped'
+    assert record['reason'] == 'No pose.'
+    manifest.finish(['a.jpg', 'b.jpg'], ['a.jpg', 'b.jpg'])
+
+  image_names, rows = read_landmark_rows(prefix, 51)
+  assert image_names == ['a.jpg']
+  np.testing.assert_array_equal(rows, landmarks.reshape(1, -1))
+
+def test_run_manifest_discards_records_of_other_settings(tmp_path):
+  prefix = str(tmp_path / 'sit')
+  image_path = str(tmp_path / 'a.jpg')
+  stat = _write_image(image_path, b'image')
+  with RunManifest(prefix, SETTINGS) as manifest:
+    manifest.add('a.jpg', stat, 'digest', np.zeros((17, 3)), None)
+  with RunManifest(prefix, dict(SETTINGS, inference_count=1)) as manifest:
+    assert manifest.lookup('a.jpg', image_path, stat) is None
+
+def test_run_manifest_checks_the_hash_of_touched_images(tmp_path):
+  prefix = str(tmp_path / 'sit')
+  image_path = str(tmp_path / 'a.jpg')
+  stat = _write_image(image_path, b'image')
+  digest = movenet_pipeline.hashlib.sha256(b'image').hexdigest()
+  with RunManifest(prefix, SETTINGS) as manifest:
+    manifest.add('a.jpg', stat, digest, np.zeros((17, 3)), None)
+
+  os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+  touched_stat = os.stat(image_path)
+  with RunManifest(prefix, SETTINGS) as manifest:
+    assert manifest.lookup('a.jpg', image_path, touched_stat) is not None
+
+  changed_stat = _write_image(image_path, b'IMAGE')
+  with RunManifest(prefix, SETTINGS) as manifest:
+    assert manifest.lookup('a.jpg', image_path, changed_stat) is None
+
+def test_run_manifest_ignores_a_partly_written_line(tmp_path):
+  prefix = str(tmp_path / 'sit')
+  image_path = str(tmp_path / 'a.jpg')
+  stat = _write_image(image_path, b'image')
+  with RunManifest(prefix, SETTINGS) as manifest:
+    manifest.add('a.jpg', stat, 'digest', np.zeros((17, 3)), None)
+  with open(prefix + '.manifest', 'a') as manifest_file:
+    manifest_file.write('{"name": "b.jp')
+  with RunManifest(prefix, SETTINGS) as manifest:
+    assert manifest.lookup('a.jpg', image_path, stat) is not None
+
+# AsyncWriter
+
+def test_async_writer_flush_waits_for_writes_in_order():
+  written = []
+
+  def write(value):
+    time.sleep(0.001)
+    written.append(value)
+
+  writer = AsyncWriter(num_threads=1, max_pending=4)
+  for value in range(20):
+    writer.submit(write, value)
+  writer.flush()
+  assert written == list(range(20))
+  writer.close()
+
+def test_async_writer_reraises_the_first_error():
+  written = []
+
+  def write(value):
+    if value == 3:
+      raise IOError('disk full')
+    written.append(value)
+
+  writer = AsyncWriter(num_threads=1)
+  for value in range(6):
+    writer.submit(write, value)
+  with pytest.raises(RuntimeError) as error:
+    writer.flush()
+  assert isinstance(error.value.__cause__, IOError)
+  # Writes after the failed one are dropped
+  assert written == [0, 1, 2]
+  with pytest.raises(RuntimeError):
+    writer.submit(write, 6)
+  writer.close()
+
+# LandmarkCache
+
+def test_landmark_cache_keys_depend_on_settings(tmp_path):
+  cache = LandmarkCache(str(tmp_path))
+  key = cache.key(b'image', 'movenet', 'movenet_thunder', inference_count=3)
+  assert key == cache.key(b'image', 'movenet', 'movenet_thunder',
+                          inference_count=3)
+  assert len({
+      key,
+      cache.key(b'other', 'movenet', 'movenet_thunder', inference_count=3),
+      cache.key(b'image', 'mediapipe', 'movenet_thunder', inference_count=3),
+      cache.key(b'image', 'movenet', 'movenet_lightning', inference_count=3),
+      cache.key(b'image', 'movenet', 'movenet_thunder', inference_count=1),
+  }) == 5
+
+def test_landmark_cache_round_trip(tmp_path):
+  cache = LandmarkCache(str(tmp_path))
+  key = cache.key(b'image', 'movenet', 'movenet_thunder')
+  assert cache.get(key) is None
+  landmarks = np.random.default_rng(0).uniform(size=(17, 3)).astype(
+      np.float32)
+  cache.put(key, landmarks)
+  np.testing.assert_array_equal(cache.get(key), landmarks)
+  # An empty array records an image without a pose
+  empty_key = cache.key(b'empty', 'movenet', 'movenet_thunder')
+  cache.put(empty_key, np.zeros((0, 3), np.float32))
+  assert cache.get(empty_key).shape == (0, 3)
+
+def test_landmark_cache_trim_evicts_least_recently_used(tmp_path):
+  landmarks = np.zeros((17, 3), np.float32)
+  cache = LandmarkCache(str(tmp_path))
+  keys = [cache.key(str(i).encode(), 'movenet', 'movenet_thunder')
+          for i in range(3)]
+  for i, key in enumerate(keys):
+    cache.put(key, landmarks)
+    entry_path = cache._entry_path(key)
+    os.utime(entry_path, (1000 + i, 1000 + i))
+  entry_size = os.path.getsize(cache._entry_path(keys[0]))
+
+  # Reading the oldest entry makes it the most recently used one
+  cache.get(keys[0])
+  cache = LandmarkCache(str(tmp_path), max_bytes=2 * entry_size)
+  cache.trim()
+  assert cache.get(keys[1]) is None
+  assert cache.get(keys[0]) is not None
+  assert cache.get(keys[2]) is not None
+  stats = cache.stats()
+  assert stats['evictions'] == 1
+  assert stats['entries'] == 2
+
+def test_landmark_cache_stats_count_lookups(tmp_path):
+  cache = LandmarkCache(str(tmp_path))
+  for hit in (True, False, True, True):
+    cache.record(hit)
+  stats = cache.stats()
+  assert (stats['hits'], stats['misses'], stats['hit_rate']) == (3, 1, 0.75)
+
+# select_movenet
+
+CHOICES = [
+    ModelChoice('movenet_lightning', 192, 1, 10.0, 0.80),
+    ModelChoice('movenet_lightning', 192, 3, 25.0, 0.90),
+    ModelChoice('movenet_thunder', 256, 1, 40.0, 0.92),
+    ModelChoice('movenet_thunder', 256, 3, 100.0, 0.95),
+]
+
+def test_select_movenet_picks_the_most_refined_choice_within_budget():
+  assert select_movenet(CHOICES, 1000) == CHOICES[3]
+  assert select_movenet(CHOICES, 50) == CHOICES[2]
+
+def test_select_movenet_keeps_the_most_images_if_none_qualifies():
+  assert select_movenet(CHOICES, 30, kept_rate_tolerance=0.0) == CHOICES[1]
+
+def test_select_movenet_falls_back_to_the_cheapest_choice():
+  assert select_movenet(CHOICES, 5) == CHOICES[0]
+
+# Metrics
+
+def test_metrics_record_nothing_until_enabled():
+  metrics = Metrics()
+  metrics.count('images', outcome='kept')
+  with metrics.timer('detect'):
+    pass
+  assert metrics.drain() is None
+  assert 'pose_images_total' not in metrics.to_prometheus()
+
+def test_metrics_to_prometheus():
+  metrics = Metrics()
+  metrics.enable()
+  metrics.count('images', outcome='kept')
+  metrics.count('images', 2, outcome='kept')
+  metrics.count('images', outcome='skipped', reason='say "hi"\\')
+  metrics.observe('keypoint_score', [0.05, 0.35, 0.35, 2.0], (0.1, 0.5))
+  lines = metrics.to_prometheus().splitlines()
+
+  assert lines.count('# TYPE pose_images_total counter') == 1
+  assert 'pose_images_total{outcome="kept"} 3' in lines
+  assert ('pose_images_total{outcome="skipped",reason="say \\"hi\\"\\\\"} 1'
+          in lines)
+  assert '# TYPE pose_keypoint_score histogram' in lines
+  assert 'pose_keypoint_score_bucket{le="0.1"} 1' in lines
+  assert 'pose_keypoint_score_bucket{le="0.5"} 3' in lines
+  assert 'pose_keypoint_score_bucket{le="+Inf"} 4' in lines
+  assert 'pose_keypoint_score_sum 2.75' in lines
+  assert 'pose_keypoint_score_count 4' in lines
+  assert any(line.startswith('pose_peak_rss_bytes{process="self"} ')
+             for line in lines)
+
+def test_metrics_merge_drained_worker_metrics():
+  worker = Metrics()
+  worker.enable()
+  worker.count('images', outcome='kept')
+  worker.observe('keypoint_score', 0.35, (0.1, 0.5))
+  parent = Metrics()
+  parent.enable()
+  parent.count('images', outcome='kept')
+  parent.merge(worker.drain())
+  parent.merge(worker.drain())
+  lines = parent.to_prometheus().splitlines()
+  assert 'pose_images_total{outcome="kept"} 2' in lines
+  assert 'pose_keypoint_score_count 1' in lines
+
+# OneEuroFilter
+
+def test_one_euro_filter_passes_the_first_frame_through():
+  landmarks = np.random.default_rng(0).uniform(0, 100, (17, 3))
+  filtered = OneEuroFilter()(landmarks, 0.0)
+  np.testing.assert_array_equal(filtered, landmarks)
+  assert filtered is not landmarks
+
+def test_one_euro_filter_smooths_jitter_but_not_scores():
+  rng = np.random.default_rng(0)
+  still = np.full((17, 3), 50.0)
+  landmark_filter = OneEuroFilter()
+  raw_error = filtered_error = 0
+  for frame_index in range(60):
+    landmarks = still.copy()
+    landmarks[:, :2] += rng.normal(0, 2, (17, 2))
+    landmarks[:, 2] = rng.uniform(0, 1, 17)
+    filtered = landmark_filter(landmarks, frame_index / 30)
+    np.testing.assert_array_equal(filtered[:, 2], landmarks[:, 2])
+    if frame_index >= 10:
+      raw_error += np.abs(landmarks[:, :2] - 50).mean()
+      filtered_error += np.abs(filtered[:, :2] - 50).mean()
+  assert filtered_error < raw_error / 2
+
+def test_one_euro_filter_follows_and_extrapolates_motion():
+  landmark_filter = OneEuroFilter(beta=1.0)
+  for frame_index in range(30):
+    landmarks = np.zeros((17, 3))
+    landmarks[:, 0] = 300 * frame_index / 30
+    filtered = landmark_filter(landmarks, frame_index / 30)
+  # With a high beta fast motion lags little
+  assert filtered[0, 0] > landmarks[0, 0] - 10
+  predicted = landmark_filter.predict(30 / 30)
+  assert predicted[0, 0] > filtered[0, 0]
+  np.testing.assert_allclose(predicted[:, 1], 0)
+
+# MicroBatcher
+
+def test_micro_batcher_coalesces_concurrent_requests():
+  calls = []
+
+  def classify_batch(rows):
+    calls.append(len(rows))
+    return rows * 10
+
+  batcher = MicroBatcher(classify_batch, max_batch_size=6, max_wait_ms=1000)
+  requests = [np.full((2, 1), value, np.float32) for value in range(3)]
+  start = threading.Barrier(3)
+  futures = [None] * 3
+
+  def submit(index):
+    start.wait()
+    futures[index] = batcher.submit(requests[index])
+
+  threads = [threading.Thread(target=submit, args=(index,))
+             for index in range(3)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  for rows, future in zip(requests, futures):
+    np.testing.assert_array_equal(future.result(timeout=5), rows * 10)
+  batcher.close()
+  assert calls == [6]
+  assert (batcher.batch_count, batcher.row_count) == (1, 6)
+
+def test_micro_batcher_runs_a_partial_batch_after_the_wait():
+  batcher = MicroBatcher(lambda rows: rows + 1, max_batch_size=64,
+                         max_wait_ms=1)
+  result = batcher.submit(np.zeros((3, 2))).result(timeout=5)
+  np.testing.assert_array_equal(result, np.ones((3, 2)))
+  batcher.close()
+
+def test_micro_batcher_fails_every_request_of_a_failed_batch():
+  def classify_batch(rows):
+    if np.any(rows < 0):
+      raise ValueError('bad input')
+    return rows
+
+  batcher = MicroBatcher(classify_batch, max_batch_size=4, max_wait_ms=1000)
+  futures = [batcher.submit(np.full((2, 1), value)) for value in (1, -1)]
+  for future in futures:
+    with pytest.raises(ValueError):
+      future.result(timeout=5)
+
+  # The batcher keeps serving later requests
+  np.testing.assert_array_equal(
+      batcher.submit(np.ones((1, 1))).result(timeout=5), np.ones((1, 1)))
+  batcher.close()